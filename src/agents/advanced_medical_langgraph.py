@@ -6,6 +6,7 @@ import logging
 from typing import Dict, List, Any, Optional, Annotated
 import json
 import asyncio
+import threading
 from datetime import datetime
 
 from langchain_openai import ChatOpenAI
@@ -19,7 +20,7 @@ from src.models.advanced_medical_models import (
     AdvancedMedicalState, MedicalQualityMetrics, ClinicalContext,
     MedicalRecommendations
 )
-from src.models.data_models import UserQuery, AgentResponse, ConsensusResponse
+from src.models.data_models import HISTORY_SUMMARY_SENDER, UserQuery, AgentResponse, ConsensusResponse
 from src.agents.agent_factory import AgentFactory
 from src.services.llm_service import LLMService
 from src.utils.helpers import detect_medical_emergencies
@@ -27,6 +28,9 @@ from src.config.config import MEDICAL_SPECIALTIES
 
 logger = logging.getLogger(__name__)
 
+# Especialidades más consultadas, cuyos agentes se crean en segundo plano al arrancar
+PREWARM_SPECIALTIES = ("internal_medicine", "cardiology", "pediatrics", "dermatology", "emergency_medicine")
+
 class AdvancedMedicalLangGraph:
     """
     Sistema médico avanzado con LangGraph que implementa:
@@ -38,6 +42,12 @@ class AdvancedMedicalLangGraph:
     - MODO RÁPIDO para respuestas inmediatas
     """
     
+    # Los agentes no dependen del modo ni de la instancia, así que se comparten entre todas
+    # las instancias y se precalientan una sola vez por proceso
+    _specialty_agents: Dict[str, Any] = {}
+    _specialty_agents_lock = threading.Lock()
+    _prewarm_started = False
+    
     def __init__(self, fast_mode: bool = False):
         """Initialize the advanced medical LangGraph system."""
         self.llm_service = LLMService()
@@ -47,8 +57,8 @@ class AdvancedMedicalLangGraph:
         # Configurar modelos especializados para diferentes componentes
         self._setup_specialized_llms()
         
-        # Cache de agentes especializados
-        self.specialty_agents = {}
+        # Cache de agentes especializados (compartido entre instancias y con el hilo de precalentamiento)
+        self.specialty_agents = AdvancedMedicalLangGraph._specialty_agents
         
         # Configurar memoria para aprendizaje continuo
         self.memory = MemorySaver()
@@ -58,6 +68,33 @@ class AdvancedMedicalLangGraph:
             self.workflow = self._build_fast_workflow()
         else:
             self.workflow = self._build_advanced_workflow()
+        
+        # Precalentar agentes en segundo plano para que la primera consulta no pague su construcción
+        with AdvancedMedicalLangGraph._specialty_agents_lock:
+            start_prewarm = not AdvancedMedicalLangGraph._prewarm_started
+            AdvancedMedicalLangGraph._prewarm_started = True
+        if start_prewarm:
+            threading.Thread(target=self._prewarm_specialty_agents, daemon=True).start()
+    
+    def _prewarm_specialty_agents(self):
+        """Crear por adelantado los agentes de las especialidades más consultadas"""
+        for specialty in PREWARM_SPECIALTIES:
+            try:
+                self._get_specialty_agent(specialty)
+            except Exception as e:
+                logger.warning(f"No se pudo precalentar el agente de {specialty}: {e}")
+        logger.info(f"✅ Agentes especializados precalentados: {len(self.specialty_agents)}")
+    
+    def _get_specialty_agent(self, specialty: str):
+        """Obtener (o crear una sola vez) el agente de una especialidad"""
+        agent = self.specialty_agents.get(specialty)
+        if agent is None:
+            with self._specialty_agents_lock:
+                agent = self.specialty_agents.get(specialty)
+                if agent is None:
+                    agent = self.agent_factory.create_agent(specialty)
+                    self.specialty_agents[specialty] = agent
+        return agent
     
     def _setup_specialized_llms(self):
         """Configurar modelos LLM especializados para cada componente"""
@@ -241,7 +278,7 @@ class AdvancedMedicalLangGraph:
                 "medical_keywords": ["consulta", "general"],
                 "suspected_conditions": [],
                 "requires_emergency": False,
-                "router_confidence": 0.5,
+                "router_confidence": None,  # El router no decidió: la especialidad es un respaldo
                 "attempt_count": 0,
                 "max_attempts": 3,
                 "is_complete": False,
@@ -333,10 +370,7 @@ class AdvancedMedicalLangGraph:
         try:
             # Consultar cada especialista
             for specialty in specialties_to_consult:
-                if specialty not in self.specialty_agents:
-                    self.specialty_agents[specialty] = self.agent_factory.create_agent(specialty)
-                
-                agent = self.specialty_agents[specialty]
+                agent = self._get_specialty_agent(specialty)
                 
                 # Crear prompt mejorado con contexto clínico
                 enhanced_prompt = self._create_enhanced_medical_prompt(
@@ -661,6 +695,8 @@ class AdvancedMedicalLangGraph:
                 content = msg.get('content', '')
                 if sender == 'user':
                     conversation_history += f"\nPaciente: {content}"
+                elif sender == HISTORY_SUMMARY_SENDER:
+                    conversation_history += f"\nResumen de mensajes anteriores del paciente: {content}"
                 elif sender == 'system':
                     conversation_history += f"\nSistema: {content}"
                 elif sender in ['neurology', 'cardiology', 'internal_medicine', 'emergency_medicine', 
@@ -760,7 +796,7 @@ class AdvancedMedicalLangGraph:
                 "medical_keywords": [],
                 "suspected_conditions": [],
                 "requires_emergency": False,
-                "router_confidence": 0.0,
+                "router_confidence": None,
                 "agent_responses": {},
                 "current_response": "",
                 "active_agent": "",
@@ -798,7 +834,12 @@ class AdvancedMedicalLangGraph:
             if not final_state.get("consensus_response"):
                 raise ValueError("No se generó respuesta de consenso médico")
             
-            return final_state["consensus_response"]
+            # Exponer la decisión del router junto a la respuesta para que el llamador no tenga que clasificar de nuevo
+            consensus_response = final_state["consensus_response"]
+            if consensus_response.router_confidence is None:
+                consensus_response.router_confidence = final_state.get("router_confidence")
+            
+            return consensus_response
             
         except Exception as e:
             logger.error(f"Error en workflow médico avanzado: {e}", exc_info=True)
@@ -829,7 +870,7 @@ class AdvancedMedicalLangGraph:
         if user_query.context and 'conversation_history' in user_query.context:
             conversation_context = "\n\nCONTEXTO PREVIO:"
             for msg in user_query.context['conversation_history']:
-                if msg.get('sender') == 'user':
+                if msg.get('sender') in ('user', HISTORY_SUMMARY_SENDER):
                     conversation_context += f" {msg.get('content', '')}"
             conversation_context += f"\n\nNUEVA CONSULTA: {query_text}"
         else:
@@ -899,10 +940,7 @@ class AdvancedMedicalLangGraph:
         
         try:
             # Obtener agente especialista
-            if primary_specialty not in self.specialty_agents:
-                self.specialty_agents[primary_specialty] = self.agent_factory.create_agent(primary_specialty)
-            
-            agent = self.specialty_agents[primary_specialty]
+            agent = self._get_specialty_agent(primary_specialty)
             
             # Construir historial conversacional si existe en el contexto
             conversation_history = ""
@@ -916,6 +954,9 @@ class AdvancedMedicalLangGraph:
                     if sender == 'user':
                         conversation_history += f"\nPaciente: {content}"
                         patient_symptoms.append(content)
+                    elif sender == HISTORY_SUMMARY_SENDER:
+                        conversation_history += f"\nResumen de mensajes anteriores del paciente: {content}"
+                        patient_symptoms.append(content)
                     elif sender in ['neurology', 'cardiology', 'internal_medicine', 'emergency_medicine', 
                                    'pediatrics', 'oncology', 'dermatology', 'psychiatry', 'ophthalmology']:
                         conversation_history += f"\nDr. {sender.title()}: {content}"
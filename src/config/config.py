@@ -125,6 +125,11 @@ PERFORMANCE_TRACKING = os.getenv("PERFORMANCE_TRACKING", "True").lower() in ("tr
 CACHE_TYPE = os.getenv("CACHE_TYPE", "simple")
 CACHE_DEFAULT_TIMEOUT = int(os.getenv("CACHE_DEFAULT_TIMEOUT", 300))  # 5 minutos
 
+# Cache persistente de respuestas LLM (SQLite, compartido entre procesos), p. ej. data/llm_cache.sqlite3.
+# Desactivado por defecto: guardaría en disco las respuestas a consultas de pacientes
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", "")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))  # 7 días
+
 def get_config_summary() -> Dict[str, Any]:
     """Obtener resumen de configuración para debugging."""
     return {
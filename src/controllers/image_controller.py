@@ -2,15 +2,19 @@
 Controlador Flask para gestionar el análisis de imágenes médicas.
 Proporciona endpoints para la carga y análisis de imágenes.
 """
+import asyncio
 import os
 from pathlib import Path
 import uuid
 import logging
 from datetime import datetime
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify, session
 from werkzeug.utils import secure_filename
 from src.services.image_analysis_service import MedicalImageAnalyzer
+from src.services.emotion_analysis_service import EmotionAnalysisService
+from src.services.llm_service import LLMService
 from src.utils.auth_middleware import login_required
+from src.utils.async_utils import async_route
 
 # Configurar logging
 logging.basicConfig(
@@ -22,15 +26,23 @@ logger = logging.getLogger(__name__)
 # Crear el blueprint para rutas relacionadas con imágenes
 image_bp = Blueprint('image', __name__, url_prefix='/images')
 
-# Inicializar el analizador de imágenes
+# Inicializar el analizador de imágenes (comparte conexiones HTTP con el servicio LLM si está disponible)
 try:
-    image_analyzer = MedicalImageAnalyzer()
+    try:
+        llm_service = LLMService()
+    except Exception as e:
+        logger.warning(f"LLMService no disponible, el analizador usará su propio cliente: {e}")
+        llm_service = None
+    image_analyzer = MedicalImageAnalyzer(llm_service=llm_service)
     logger.info("Analizador de imágenes médicas inicializado correctamente")
 except Exception as e:
     logger.error(f"Error al inicializar el analizador de imágenes: {e}")
     image_analyzer = None
     logger.warning("El análisis de imágenes no estará disponible hasta que se configure correctamente")
 
+# Análisis emocional de la descripción que acompaña a la imagen
+emotion_service = EmotionAnalysisService()
+
 # Extensiones de imagen permitidas
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'webp'}
 
@@ -182,19 +194,19 @@ def analyze():
             }
             specialty = specialty_map.get(body_part, 'medicina_general')
             
-            # Verificar si la imagen es de contenido médico apropiado
-            if not image_analyzer.is_medical_image(file_path):
+            # Verificar si la imagen es de contenido médico y analizarla en una sola llamada
+            result = image_analyzer.classify_and_analyze(
+                file_path,
+                patient_context=description,
+                specialty=specialty
+            )
+            if not result['is_medical']:
                 # Eliminar la imagen inapropiada
                 os.remove(file_path)
                 flash('La imagen no parece ser de contenido médico.', 'warning')
                 return redirect(request.url)
             
-            # Analizar la imagen
-            analysis_result = image_analyzer.analyze_image(
-                file_path,
-                patient_context=description,
-                specialty=specialty
-            )
+            analysis_result = result['analysis']
             
             # URL relativa para mostrar la imagen en la plantilla
             image_url = url_for('static', filename=f'uploads/images/{filename}')
@@ -226,7 +238,8 @@ def analyze():
 
 @image_bp.route('/api/analyze', methods=['POST'])
 @login_required
-def api_analyze():
+@async_route
+async def api_analyze():
     """API endpoint para análisis de imágenes (JSON)"""
     # Verificar si el analizador está disponible
     if image_analyzer is None:
@@ -288,28 +301,34 @@ def api_analyze():
         specialty = request.form.get('specialty', 'medicina_general')
         conversation_id = request.form.get('conversation_id', None)
         
-        # Verificar si la imagen es médica antes del análisis
-        try:
-            is_medical = image_analyzer.is_medical_image(file_path)
-            if not is_medical:
-                # Eliminar la imagen no médica
-                os.remove(file_path)
-                return jsonify({
-                    'error': 'La imagen no parece ser de contenido médico',
-                    'details': 'Por favor, suba una imagen relacionada con medicina o síntomas médicos'
-                }), 400
-        except Exception as medical_check_error:
-            logger.warning(f"No se pudo verificar si la imagen es médica: {medical_check_error}")
-            # Continuar con el análisis aunque falle la verificación
-        
-        # Analizar la imagen
+        # Verificar si la imagen es médica y analizarla en una sola llamada
+        # (si falla la verificación, se continúa con el análisis)
         logger.info(f"Iniciando análisis de imagen con especialidad: {specialty}")
-        analysis_result = image_analyzer.analyze_image(
+        image_analysis = image_analyzer.aclassify_and_analyze(
             file_path,
             patient_context=description,
             specialty=specialty
         )
         
+        # El análisis emocional de la descripción se ejecuta mientras se espera al modelo de visión
+        emotional_analysis = None
+        if description.strip():
+            result, emotional_analysis = await asyncio.gather(
+                image_analysis,
+                emotion_service.aanalyze_message_emotions(description, conversation_id or f"user-{session['user_id']}")
+            )
+        else:
+            result = await image_analysis
+        if not result['is_medical']:
+            # Eliminar la imagen no médica
+            os.remove(file_path)
+            return jsonify({
+                'error': 'La imagen no parece ser de contenido médico',
+                'details': 'Por favor, suba una imagen relacionada con medicina o síntomas médicos'
+            }), 400
+        
+        analysis_result = result['analysis']
+        
         if not analysis_result or "Error" in analysis_result:
             logger.error(f"El análisis de imagen falló o retornó error: {analysis_result}")
             return jsonify({
@@ -337,11 +356,14 @@ def api_analyze():
                 # No falla la operación si no se puede guardar en la conversación
         
         logger.info(f"Análisis de imagen completado exitosamente para: {filename}")
-        return jsonify({
+        response_data = {
             'success': True,
             'analysis': analysis_result,
             'image_url': image_url
-        })
+        }
+        if emotional_analysis and 'error' not in emotional_analysis:
+            response_data['emotional_analysis'] = emotional_analysis
+        return jsonify(response_data)
         
     except FileNotFoundError as fnf_error:
         logger.error(f"Archivo no encontrado durante análisis: {str(fnf_error)}")
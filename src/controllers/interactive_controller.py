@@ -31,6 +31,9 @@ def ensure_serializable(obj):
         return {k: ensure_serializable(v) for k, v in obj.items()}
     elif isinstance(obj, list):
         return [ensure_serializable(i) for i in obj]
+    elif hasattr(obj, 'cached_dict') and callable(getattr(obj, 'cached_dict')):
+        # Conversations keep their messages pre-serialized
+        return ensure_serializable(obj.cached_dict())
     elif hasattr(obj, 'dict') and callable(getattr(obj, 'dict')):
         return ensure_serializable(obj.dict())
     elif hasattr(obj, 'isoformat') and callable(getattr(obj, 'isoformat')):
@@ -130,7 +133,7 @@ async def send_message():
         response = await conversation_service.process_message(conversation_id, message)
         
         # Get the updated conversation
-        conversation = conversation_service.get_conversation(conversation_id)
+        conversation = await conversation_service.get_conversation_async(conversation_id)
         
         # Return the response with serialized data
         return jsonify({
@@ -190,7 +193,7 @@ async def generate_report():
             return jsonify({"error": "No active conversation"}), 400
         
         # Get the conversation
-        conversation = conversation_service.get_conversation(conversation_id)
+        conversation = await conversation_service.get_conversation_async(conversation_id)
         if not conversation:
             return jsonify({"error": "Conversation not found"}), 404
         
@@ -240,7 +243,7 @@ async def download_report():
         logger.info(f"Generating PDF report for conversation: {conversation_id}")
         
         # Generate the report for this conversation
-        conversation = conversation_service.get_conversation(conversation_id)
+        conversation = await conversation_service.get_conversation_async(conversation_id)
         if not conversation:
             logger.error(f"Conversation {conversation_id} not found")
             return jsonify({"error": "Conversation not found"}), 404
@@ -46,20 +46,21 @@ def get_medications(conversation_id):
 def get_consultations():
     """Obtener historial de consultas del usuario"""
     try:
-        # Obtener todas las conversaciones del usuario
-        conversations = conversation_service.get_all_conversations()
+        # Resúmenes de todas las conversaciones, servidos desde el índice sin leer cada conversación
+        summaries = conversation_service.get_conversation_summaries()
         
         consultations = []
-        for conv in conversations:
-            if conv.messages:  # Solo incluir conversaciones con mensajes
+        for summary in summaries:
+            message_count = summary['message_count']
+            if message_count:  # Solo incluir conversaciones con mensajes
                 consultation_data = {
-                    'id': conv.conversation_id,
-                    'specialty': conv.active_specialty,
-                    'date': conv.created_at.strftime('%d/%m/%Y') if hasattr(conv, 'created_at') else datetime.now().strftime('%d/%m/%Y'),
-                    'duration': calculate_consultation_duration(conv),
-                    'summary': generate_consultation_summary(conv),
-                    'status': 'completed' if len(conv.messages) > 4 else 'in_progress',
-                    'message_count': len(conv.messages)
+                    'id': summary['conversation_id'],
+                    'specialty': summary['active_specialty'],
+                    'date': datetime.fromisoformat(summary['created_at']).strftime('%d/%m/%Y'),
+                    'duration': calculate_consultation_duration(message_count),
+                    'summary': generate_consultation_summary(summary['preview'], message_count),
+                    'status': 'completed' if message_count > 4 else 'in_progress',
+                    'message_count': message_count
                 }
                 consultations.append(consultation_data)
         
@@ -457,10 +458,8 @@ def extract_lab_notes_from_text(text, test_name):
         return f'{test_name.title()} por debajo de los valores normales'
     return 'Sin observaciones adicionales'
 
-def calculate_consultation_duration(conversation):
-    """Calcular duración estimada de la consulta"""
-    message_count = len(conversation.messages)
-    
+def calculate_consultation_duration(message_count):
+    """Calcular duración estimada de la consulta a partir de su número de mensajes"""
     if message_count < 5:
         return '10-15 minutos'
     elif message_count < 10:
@@ -470,16 +469,11 @@ def calculate_consultation_duration(conversation):
     else:
         return '40+ minutos'
 
-def generate_consultation_summary(conversation):
-    """Generar resumen de la consulta"""
-    message_count = len(conversation.messages)
-    user_messages = [m for m in conversation.messages if m.sender == 'user']
-    
-    if not user_messages:
+def generate_consultation_summary(first_message, message_count):
+    """Generar resumen de la consulta a partir del primer mensaje del paciente (ya recortado)"""
+    if first_message is None:
         return 'Consulta sin síntomas específicos reportados'
     
-    first_message = user_messages[0].content[:100] + '...' if len(user_messages[0].content) > 100 else user_messages[0].content
-    
     return f"Consulta sobre: {first_message}. Total de intercambios: {message_count}"
 
 def generate_lab_requests_from_conversation(conversation):
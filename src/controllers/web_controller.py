@@ -36,6 +36,9 @@ def ensure_serializable(obj):
         return {k: ensure_serializable(v) for k, v in obj.items()}
     elif isinstance(obj, list):
         return [ensure_serializable(i) for i in obj]
+    elif hasattr(obj, 'cached_dict') and callable(getattr(obj, 'cached_dict')):
+        # Conversations keep their messages pre-serialized
+        return ensure_serializable(obj.cached_dict())
     elif hasattr(obj, 'dict') and callable(getattr(obj, 'dict')):
         return ensure_serializable(obj.dict())
     elif hasattr(obj, 'isoformat') and callable(getattr(obj, 'isoformat')):
@@ -211,7 +214,7 @@ async def send_message():
         response = await conversation_service.process_message(conversation_id, message)
         
         # Get the updated conversation
-        conversation = conversation_service.get_conversation(conversation_id)
+        conversation = await conversation_service.get_conversation_async(conversation_id)
         
         # Return the response with serialized data
         return jsonify({
@@ -248,7 +251,7 @@ async def switch_specialty():
         response = await conversation_service.switch_specialty(conversation_id, new_specialty)
         
         # Get the updated conversation
-        conversation = conversation_service.get_conversation(conversation_id)
+        conversation = await conversation_service.get_conversation_async(conversation_id)
         
         # Return the response with serialized data
         return jsonify({
@@ -137,7 +137,7 @@ class AdvancedMedicalState(TypedDict):
     medical_keywords: List[str]
     suspected_conditions: List[str]
     requires_emergency: bool
-    router_confidence: float
+    router_confidence: Optional[float]  # None si el router no llegó a decidir
     
     # Respuestas de agentes especializados
     agent_responses: Dict[str, AgentResponse]
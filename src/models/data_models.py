@@ -1,7 +1,10 @@
-from pydantic import BaseModel, Field
-from typing import Dict, List, Optional, Union, Any
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import Dict, List, Optional, Tuple, Union, Any
 from datetime import datetime
 
+# Sender of the history entry that condenses the patient messages older than the LLM history window
+HISTORY_SUMMARY_SENDER = "history_summary"
+
 
 class UserQuery(BaseModel):
     """Model representing a user query to the medical system."""
@@ -78,6 +81,7 @@ class ConsensusResponse(BaseModel):
     additional_insights: Dict[str, str] = {}
     created_at: datetime = Field(default_factory=datetime.now)
     patient_recommendations: List[str] = []
+    router_confidence: Optional[float] = None  # Confidence of the router that chose primary_specialty, if one ran
     
     def dict(self, **kwargs):
         data = super().dict(**kwargs)
@@ -128,6 +132,16 @@ class MessageType(BaseModel):
     sender: str  # 'user', 'system', or a specialty name like 'cardiology'
     timestamp: datetime = Field(default_factory=datetime.now)
     
+    # Lowercased content, computed on first use; messages are never edited once appended
+    _content_lower: Optional[str] = PrivateAttr(default=None)
+    
+    @property
+    def content_lower(self) -> str:
+        """Lowercased content, cached after the first access."""
+        if self._content_lower is None:
+            self._content_lower = self.content.lower()
+        return self._content_lower
+    
     def dict(self, **kwargs):
         """Custom dict method to handle datetime serialization."""
         data = super().dict(**kwargs)
@@ -150,9 +164,23 @@ class InteractiveConversation(BaseModel):
     created_at: datetime = Field(default_factory=datetime.now)
     updated_at: datetime = Field(default_factory=datetime.now)
     
+    # Serialized messages, kept in sync with `messages` so history can be sliced without re-serializing
+    _message_dicts: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    # (cutoff, digest pieces, entry) summarizing the messages that fell out of the LLM history window
+    _history_summary: Optional[Tuple[int, List[str], Dict[str, Any]]] = PrivateAttr(default=None)
+    
+    def model_post_init(self, __context: Any) -> None:
+        """Serialize messages loaded from disk once, at construction time."""
+        self._message_dicts = [msg.dict() for msg in self.messages]
+    
+    def _append_message(self, message: MessageType) -> None:
+        """Append a message together with its serialized form."""
+        self.messages.append(message)
+        self._message_dicts.append(message.dict())
+    
     def add_message(self, content: str, sender: str) -> None:
         """Add a new message to the conversation."""
-        self.messages.append(MessageType(content=content, sender=sender))
+        self._append_message(MessageType(content=content, sender=sender))
         self.updated_at = datetime.now()
         
         # Update specialties if necessary
@@ -168,7 +196,7 @@ class InteractiveConversation(BaseModel):
     
     def add_system_note(self, content: str) -> None:
         """Add a system note to the conversation."""
-        self.messages.append(MessageType(content=content, sender='system'))
+        self._append_message(MessageType(content=content, sender='system'))
         self.updated_at = datetime.now()
     
     def dict(self, **kwargs):
@@ -196,6 +224,19 @@ class InteractiveConversation(BaseModel):
         
         return data
     
+    def cached_dict(self) -> Dict[str, Any]:
+        """Equivalent of `dict()` that reuses the pre-serialized messages instead of re-serializing them."""
+        data = self.header_dict()
+        data['messages'] = list(self._message_dicts)
+        return data
+    
+    def header_dict(self) -> Dict[str, Any]:
+        """Serialize every field except the messages (see `_message_dicts` for those).
+        
+        Only the small top-level fields go through Pydantic, so the cost does not grow with the history.
+        """
+        return self.dict(exclude={'messages'})
+    
     def _handle_dict_serialization(self, d):
         """Recursively handle dictionary serialization."""
         result = {}
@@ -115,6 +115,7 @@ class EmotionalState:
     contradictory_emotions: List[str] = field(default_factory=list)
     confidence: float = 0.0
     triggers: List[str] = field(default_factory=list)
+    contradiction_mask: int = 0  # Tipos de contradicción como bits (ver AdvancedEmotionAnalyzer.contradiction_bits)
     
     def to_dict(self) -> dict:
         return {
@@ -1,138 +1,530 @@
 import logging
 import asyncio
-from typing import Dict, List, Optional, Any
-from datetime import datetime, timedelta
-import json
+import atexit
+from typing import Deque, Dict, List, Optional, Any
+from collections import OrderedDict, deque
+import gzip
 import os
-import traceback
+from pathlib import Path
+import re
+import threading
+import time
 
-from src.models.data_models import InteractiveConversation, MessageType, UserQuery
+import orjson
+
+from src.models.data_models import (
+    HISTORY_SUMMARY_SENDER, ConsensusResponse, InteractiveConversation, MessageType, UserQuery
+)
 from src.utils.helpers import generate_id
 from src.agents.medical_system_integration import MedicalSystemManager
-from src.services.llm_service import LLMService
+from src.services.llm_service import LLMService, ClassificationCache
 from src.config.config import BASE_DIR
 
 logger = logging.getLogger(__name__)
 
+# Límite de cambios automáticos de especialidad: no más de 2 cambios en los últimos 5 minutos
+MAX_SPECIALTY_SWITCHES = 2
+SWITCH_BLOCK_WINDOW = 300.0  # segundos, reloj monotónico
+
+# Mensaje de bienvenida de toda conversación nueva
+WELCOME_MESSAGE_TEMPLATE = (
+    "Bienvenido a la consulta médica interactiva. Estás hablando con un especialista en {specialty}. "
+    "¿En qué puedo ayudarte hoy? (El sistema automáticamente te dirigirá al especialista más adecuado según tu consulta)"
+)
+
+# Palabras clave que indican que el especialista está pidiendo información adicional
+FOLLOW_UP_INDICATORS = [
+    "podrías describirme", "me gustaría preguntarte", "necesito que me des",
+    "¿podrías", "¿has notado", "¿tienes", "¿existe", "¿hay algo",
+    "más información", "más detalles", "cuéntame más", "dime si",
+    "responde", "pregunta", "información adicional"
+]
+
+# Palabras clave que indican que el paciente está respondiendo/proporcionando información
+PATIENT_RESPONSE_INDICATORS = [
+    "es un dolor", "tengo", "siento", "me duele", "principalemnte", "principalmente",
+    "no tengo", "sí", "no", "desde hace", "hace", "cuando", "al", "con",
+    "irrada", "irradia", "hacia", "en", "también", "además", "pero",
+    "vision borrosa", "visión", "trabajo", "pantalla", "nada mas", "nada más"
+]
+
+# Cada lista compilada en una sola alternancia: una pasada en C en lugar de un `in` por palabra clave
+FOLLOW_UP_INDICATORS_RE = re.compile("|".join(map(re.escape, FOLLOW_UP_INDICATORS)))
+PATIENT_RESPONSE_INDICATORS_RE = re.compile("|".join(map(re.escape, PATIENT_RESPONSE_INDICATORS)))
+
+# orjson serializa datetime de forma nativa; las claves no string del contexto se convierten como hacía json
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
 class ConversationService:
     """Service to manage interactive conversations with medical specialists (Singleton)."""
     
     _instance = None
     _initialized = False
+    _lock = threading.Lock()
     
     def __new__(cls):
         """Ensure only one instance of ConversationService exists."""
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
         return cls._instance
     
     def __init__(self):
         """Initialize the conversation service (only once)."""
-        # Only initialize once
-        if ConversationService._initialized:
-            return
-            
-        self.conversations: Dict[str, InteractiveConversation] = {}
-        self.medical_system = MedicalSystemManager(use_advanced_system=True, fast_mode=True)
-        self.conversation_dir = BASE_DIR / "data" / "conversations"
-        self.llm_service = LLMService()  # Para clasificación de especialidad
+        # Only initialize once, even if several threads construct the service concurrently
+        with ConversationService._lock:
+            if ConversationService._initialized:
+                return
+            self._initialize()
+            # Mark as initialized
+            ConversationService._initialized = True
+        logger.info("ConversationService singleton initialized with ADVANCED medical system")
+    
+    def _initialize(self, conversation_dir: Optional[Path] = None,
+                    medical_system: Optional[MedicalSystemManager] = None,
+                    llm_service: Optional[LLMService] = None,
+                    start_writer: bool = True):
+        """Build the service state; called exactly once under the class lock.
+        
+        The arguments replace the defaults (the conversations directory under BASE_DIR, the
+        advanced medical system and the LLM service). With `start_writer=False` no background
+        writer runs and saves stay queued until `_flush_pending_saves` is called.
+        """
+        # Conversaciones en memoria, de la menos a la más recientemente usada; las expulsadas siguen en disco
+        self.conversations: "OrderedDict[str, InteractiveConversation]" = OrderedDict()
+        self.max_conversations_in_memory = 2048
+        self.medical_system = medical_system or MedicalSystemManager(use_advanced_system=True, fast_mode=True)
+        self.conversation_dir = Path(conversation_dir) if conversation_dir else BASE_DIR / "data" / "conversations"
+        self.llm_service = llm_service or LLMService()  # Para clasificación de especialidad
         
         # Umbral de confianza para cambios automáticos de especialidad (valor muy estricto para evitar cambios innecesarios)
         self.specialty_confidence_threshold = 0.95
         
-        # Tracking para cambios de especialidad
-        self.specialty_changes = {}  # Dict[conversation_id, Dict[info]]
+        # Clasificaciones de especialidad evitadas por detectar mensajes de seguimiento
+        self.classifications_avoided = 0
+        
+        # Número máximo de mensajes recientes enviados como historial al LLM
+        self.history_window = 12
+        # Tamaño máximo del resumen de mensajes anteriores a la ventana, en caracteres
+        self.history_summary_chars = 1200
+        self.history_summary_message_chars = 240  # por mensaje del paciente
+        
+        # Tracking para cambios de especialidad: instantes de los últimos cambios de cada conversación,
+        # ordenadas por su último cambio para poder descartar las que ya no pueden bloquear uno nuevo
+        self.specialty_changes: "OrderedDict[str, Deque[float]]" = OrderedDict()
         
         # Ensure directory exists
         os.makedirs(self.conversation_dir, exist_ok=True)
         
-        # Clean up any corrupted files from previous runs
-        self._cleanup_corrupted_files()
+        # Cache de clasificaciones de especialidad (persistido junto a las conversaciones)
+        self.classification_cache = ClassificationCache(self.conversation_dir / "_clf_cache.json")
         
-        # Load any existing conversations
-        self._load_conversations()
+        # Conversations are stored as JSONL logs: a "header" record with the conversation
+        # metadata and one "message" record per message. Compaction writes every message plus
+        # the header to a gzip body ({id}.jsonl.gz); later saves append the new messages and a
+        # fresh header to a raw tail ({id}.jsonl) that starts with a "base" record holding the
+        # position of its first message. Enough stale headers trigger the next compaction.
+        self.log_compact_after = 32  # header records before compaction
+        self.log_compress_level = 6  # gzip level for compacted bodies
+        self._log_state: Dict[str, List[int]] = {}  # conversation_id -> [persisted messages, header records]
         
-        # Mark as initialized
-        ConversationService._initialized = True
-        logger.info("ConversationService singleton initialized with ADVANCED medical system")
+        # Write-behind persistence: saves are queued as snapshots and written by a
+        # background thread, which wakes on the first queued save and waits a short
+        # window so repeated saves of the same conversation coalesce into one write.
+        # Logs appended since the last sync are fsynced together in one pass (group commit)
+        # every N writes or T seconds; compactions fsync their temp file before the rename.
+        self.save_flush_interval = 0.2  # seconds to batch saves before writing
+        self.save_sync_every = 50  # writes between forced syncs
+        self.save_sync_interval = 10.0  # max seconds between forced syncs
+        self._pending_saves: Dict[str, Dict[str, Any]] = {}
+        self._save_lock = threading.Lock()
+        self._save_event = threading.Event()
+        self._write_lock = threading.RLock()  # re-entrant: loads hold it across flush and read
+        self._writes_since_sync = 0
+        self._last_sync = time.monotonic()
+        self._unsynced_paths: set = set()  # logs appended to since the last sync
+        self._dir_unsynced = False  # files created, renamed or removed since the last sync
+        
+        # Index existing conversations by file name only; they are parsed on first access
+        self._known_ids = self._index_conversations()
+        
+        # Lightweight header index (see `_index_entry`) so conversations can be listed without reading
+        # their logs. It is updated on every save and persisted like the logs: changed entries are
+        # appended to _index.jsonl and the file is rewritten once most of its lines are stale.
+        self._index_path = self.conversation_dir / "_index.jsonl"
+        self._conversation_index: Dict[str, Dict[str, Any]] = {}
+        self._index_pending: Dict[str, Dict[str, Any]] = {}  # entries changed since the last flush
+        self._index_lines = 0
+        self._load_conversation_index()
+        
+        # Start the background writer (it also cleans up corrupted files from previous runs)
+        if start_writer:
+            threading.Thread(target=self._save_worker, daemon=True).start()
+            atexit.register(self._flush_pending_saves, True)
     
     def _cleanup_corrupted_files(self):
         """Clean up any corrupted files from previous runs."""
         try:
             count = 0
-            for filename in os.listdir(self.conversation_dir):
-                if '.corrupted.' in filename:
-                    try:
-                        file_path = self.conversation_dir / filename
-                        os.remove(file_path)
-                        count += 1
-                    except Exception as e:
-                        logger.error(f"Failed to delete corrupted file {filename}: {e}")
+            with os.scandir(self.conversation_dir) as entries:
+                for entry in entries:
+                    if '.corrupted.' in entry.name:
+                        try:
+                            os.remove(entry.path)
+                            count += 1
+                        except Exception as e:
+                            logger.error(f"Failed to delete corrupted file {entry.name}: {e}")
             if count > 0:
                 logger.info(f"Deleted {count} corrupted conversation files from previous runs")
         except Exception as e:
             logger.error(f"Error cleaning up corrupted files: {e}")
     
-    def _load_conversations(self):
-        """Load conversations from disk."""
+    def _index_conversations(self) -> set:
+        """List the IDs of the conversations stored on disk without parsing them."""
+        conversation_ids = set()
+        try:
+            with os.scandir(self.conversation_dir) as entries:
+                for entry in entries:
+                    filename = entry.name
+                    if filename.startswith('_') or not entry.is_file():
+                        continue
+                    if filename.endswith('.jsonl'):
+                        conversation_ids.add(filename[:-len('.jsonl')])
+                    elif filename.endswith('.jsonl.gz'):
+                        conversation_ids.add(filename[:-len('.jsonl.gz')])
+                    elif filename.endswith('.json'):
+                        conversation_ids.add(filename[:-len('.json')])
+            logger.info(f"Indexed {len(conversation_ids)} conversations on disk")
+        except Exception as e:
+            logger.error(f"Error indexing conversations: {e}")
+        return conversation_ids
+    
+    def _load_conversation_index(self):
+        """Read the persisted header index; later lines supersede earlier ones for the same conversation."""
         try:
-            for filename in os.listdir(self.conversation_dir):
-                if filename.endswith('.json'):
-                    file_path = self.conversation_dir / filename
+            with open(self._index_path, 'rb') as f:
+                for line in f:
                     try:
-                        with open(file_path, 'r') as f:
-                            data = json.load(f)
-                            conv = InteractiveConversation(**data)
-                            self.conversations[conv.conversation_id] = conv
-                            logger.info(f"Loaded conversation {conv.conversation_id} from disk")
-                    except json.JSONDecodeError as e:
-                        # Delete corrupted files rather than renaming them repeatedly
-                        try:
-                            os.remove(file_path)
-                            logger.error(f"Deleted corrupted conversation file {file_path}: {e}")
-                        except Exception as remove_err:
-                            logger.error(f"Failed to delete corrupted file {file_path}: {remove_err}")
-                    except Exception as e:
-                        logger.error(f"Error loading conversation from {file_path}: {e}")
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # A write was interrupted: the missing entries are rebuilt on the next listing
+                        break
+                    self._conversation_index[entry["conversation_id"]] = entry
+                    self._index_lines += 1
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logger.error(f"Error loading conversations: {e}")
+            logger.error(f"Error loading conversation index: {e}")
+    
+    @staticmethod
+    def _index_entry(conversation: InteractiveConversation, count: int,
+                     previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Header index entry for a conversation with `count` messages; the preview never changes once set."""
+        preview = previous.get("preview") if previous else None
+        if preview is None:
+            first_user_message = next(
+                (msg['content'] for msg in conversation._message_dicts[:count] if msg['sender'] == 'user'), None
+            )
+            if first_user_message is not None:
+                preview = first_user_message[:100] + '...' if len(first_user_message) > 100 else first_user_message
+        return {
+            "conversation_id": conversation.conversation_id,
+            "active_specialty": conversation.active_specialty,
+            "created_at": conversation.created_at.isoformat(),
+            "updated_at": conversation.updated_at.isoformat(),
+            "message_count": count,
+            "preview": preview,
+        }
     
-    def _save_conversation(self, conversation_id: str):
-        """Save a conversation to disk with improved error handling."""
+    def _write_conversation_index(self, entries: Dict[str, Dict[str, Any]]):
+        """Append changed index entries, rewriting the index when most lines are stale (writer lock held)."""
         try:
-            conv = self.conversations.get(conversation_id)
-            if not conv:
-                logger.error(f"Cannot save conversation {conversation_id}: not found in memory")
-                return False
+            with self._save_lock:
+                compact = self._index_lines + len(entries) > max(64, 2 * len(self._conversation_index))
+                if compact:
+                    entries = dict(self._conversation_index)
+            data = b"".join(orjson.dumps(entry) + b"\n" for entry in entries.values())
+            
+            if compact:
+                temp_path = self._index_path.with_suffix('.tmp')
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                temp_path.replace(self._index_path)
+                self._dir_unsynced = True
+                self._index_lines = len(entries)
+            else:
+                with open(self._index_path, 'ab') as f:
+                    f.write(data)
+                self._unsynced_paths.add(self._index_path)
+                self._index_lines += len(entries)
+        except Exception as e:
+            logger.error(f"Error saving conversation index: {e}")
+    
+    def _read_conversation(self, conversation_id: str) -> Optional[InteractiveConversation]:
+        """Read a conversation from its JSONL log, falling back to a legacy JSON snapshot."""
+        body_path = self.conversation_dir / f"{conversation_id}.jsonl.gz"
+        log_path = self.conversation_dir / f"{conversation_id}.jsonl"
+        if body_path.exists() or log_path.exists():
+            try:
+                header = None
+                messages = []
+                header_records = 0
+                torn = False
+                
+                # The compressed body is written atomically, so any error in it is a real failure
+                if body_path.exists():
+                    with gzip.open(body_path, 'rb') as f:
+                        for line in f:
+                            record = orjson.loads(line)
+                            if 'message' in record:
+                                messages.append(record['message'])
+                            elif 'header' in record:
+                                header = record['header']
+                                header_records += 1
+                
+                if log_path.exists():
+                    # Tail messages already in the body (left behind by an interrupted compaction)
+                    # are skipped; a tail without a "base" record is a full uncompressed log
+                    body_count = len(messages)
+                    position = 0
+                    with open(log_path, 'rb') as f:
+                        for line in f:
+                            try:
+                                record = orjson.loads(line)
+                            except orjson.JSONDecodeError:
+                                # A write was interrupted: keep what was committed before it
+                                torn = True
+                                break
+                            if 'message' in record:
+                                if position >= body_count:
+                                    messages.append(record['message'])
+                                position += 1
+                            elif 'header' in record:
+                                header = record['header']
+                                header_records += 1
+                            elif 'base' in record:
+                                position = record['base']
+                
+                if header is None:
+                    raise ValueError("log has no header record")
                 
-            file_path = self.conversation_dir / f"{conversation_id}.json"
+                conv = InteractiveConversation(**header, messages=messages)
+                with self._write_lock:
+                    if torn:
+                        # Force a compaction on the next save so the torn tail gets rewritten
+                        logger.warning(f"Discarded torn tail of conversation log {log_path}")
+                        self._log_state.pop(conversation_id, None)
+                    else:
+                        self._log_state[conversation_id] = [len(messages), header_records]
+                return conv
+            except Exception as e:
+                logger.error(f"Error loading conversation {conversation_id} from its log: {e}")
+                return None
+        
+        file_path = self.conversation_dir / f"{conversation_id}.json"
+        if file_path.exists():
+            try:
+                with open(file_path, 'rb') as f:
+                    data = orjson.loads(f.read())
+                return InteractiveConversation(**data)
+            except orjson.JSONDecodeError as e:
+                # Delete corrupted files rather than renaming them repeatedly
+                try:
+                    os.remove(file_path)
+                    logger.error(f"Deleted corrupted conversation file {file_path}: {e}")
+                except Exception as remove_err:
+                    logger.error(f"Failed to delete corrupted file {file_path}: {remove_err}")
+            except Exception as e:
+                logger.error(f"Error loading conversation from {file_path}: {e}")
+        return None
+    
+    def _save_conversation(self, conversation_id: str, conversation: Optional[InteractiveConversation] = None):
+        """Queue a snapshot of a conversation to be written to disk by the background writer.
+        
+        Pass the conversation itself when holding it, so a save still works if it was evicted from memory meanwhile.
+        """
+        conv = conversation or self.conversations.get(conversation_id)
+        if not conv:
+            logger.error(f"Cannot save conversation {conversation_id}: not found in memory")
+            return False
+        
+        try:
+            # Snapshot the metadata now, so later mutations don't leak into the write.
+            # The message dicts list is append-only, so remembering its length is enough.
+            snapshot = {
+                "header": conv.header_dict(),
+                "messages": conv._message_dicts,
+                "count": len(conv._message_dicts)
+            }
+        except Exception as e:
+            logger.error(f"Error serializing conversation {conversation_id}: {e}")
+            return False
+        
+        with self._save_lock:
+            self._pending_saves[conversation_id] = snapshot
+            entry = self._index_entry(conv, snapshot["count"], self._conversation_index.get(conversation_id))
+            self._conversation_index[conversation_id] = entry
+            self._index_pending[conversation_id] = entry
+        self._save_event.set()
+        return True
+    
+    async def flush(self):
+        """Write and sync every queued save; await where a change must be durable."""
+        await asyncio.to_thread(self._flush_pending_saves, True)
+    
+    def _save_worker(self):
+        """Background loop that flushes queued conversation saves in batches."""
+        # Startup housekeeping runs here so it does not delay service initialization
+        self._cleanup_corrupted_files()
+        
+        while True:
+            # Idle wake-ups still let a pending sync happen once its interval elapses
+            if self._save_event.wait(self.save_sync_interval):
+                time.sleep(self.save_flush_interval)
+                self._save_event.clear()
+            try:
+                self._flush_pending_saves()
+            except Exception as e:
+                logger.error(f"Error flushing queued conversation saves: {e}")
+    
+    def _flush_pending_saves(self, force_sync: bool = False) -> int:
+        """Write every queued snapshot and sync the filesystem when the cadence is due."""
+        # Taking the snapshots under the writer lock keeps a concurrent load from seeing them
+        # neither queued nor written yet
+        with self._write_lock:
+            with self._save_lock:
+                pending, self._pending_saves = self._pending_saves, {}
+                index_pending, self._index_pending = self._index_pending, {}
             
-            # Convert the conversation to a dict first, which will handle datetime serialization
-            conversation_dict = conv.dict()
+            written = 0
+            for conversation_id, snapshot in pending.items():
+                if self._write_conversation_log(conversation_id, snapshot):
+                    written += 1
+            self._writes_since_sync += written
+            if index_pending:
+                self._write_conversation_index(index_pending)
             
-            # Create a custom JSON encoder to handle datetime objects
-            class DateTimeEncoder(json.JSONEncoder):
-                def default(self, obj):
-                    if hasattr(obj, 'isoformat'):
-                        return obj.isoformat()
-                    return super().default(obj)
+            now = time.monotonic()
+            sync_due = (force_sync
+                        or self._writes_since_sync >= self.save_sync_every
+                        or now - self._last_sync >= self.save_sync_interval)
+            self.classification_cache.flush()
             
-            # Save to a temporary file first to avoid corruption
-            temp_file_path = file_path.with_suffix('.tmp')
+            if self._writes_since_sync and sync_due:
+                self._sync_written_files()
+                self._writes_since_sync = 0
+                self._last_sync = now
+        
+        return written
+    
+    def _sync_written_files(self):
+        """fsync every log written since the last sync, then the directory (writer lock held)."""
+        for path in self._unsynced_paths:
+            try:
+                with open(path, 'rb') as f:
+                    os.fsync(f.fileno())
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error syncing conversation log {path}: {e}")
+        self._unsynced_paths.clear()
+        
+        if self._dir_unsynced:
+            # New and renamed entries are only durable once the directory itself is synced
+            try:
+                dir_fd = os.open(self.conversation_dir, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError as e:
+                logger.debug(f"Could not sync conversation directory: {e}")
+            self._dir_unsynced = False
+    
+    def _write_conversation_log(self, conversation_id: str, snapshot: Dict[str, Any]) -> bool:
+        """Append a conversation snapshot to its log, compacting it when due (writer lock held)."""
+        body_path = self.conversation_dir / f"{conversation_id}.jsonl.gz"
+        log_path = self.conversation_dir / f"{conversation_id}.jsonl"
+        state = self._log_state.get(conversation_id)
+        
+        try:
+            tail_exists = log_path.exists()
+            if (state is None or state[1] >= self.log_compact_after
+                    or not (tail_exists or body_path.exists())):
+                return self._compact_conversation_log(conversation_id, snapshot)
             
-            with open(temp_file_path, 'w', encoding='utf-8') as f:
-                json.dump(conversation_dict, f, indent=2, cls=DateTimeEncoder, ensure_ascii=False)
+            persisted, count = state[0], snapshot["count"]
+            records = [{"message": message} for message in snapshot["messages"][persisted:count]]
+            records.append({"header": snapshot["header"]})
+            if not tail_exists:
+                # First append since the last compaction starts a new tail
+                records.insert(0, {"base": persisted})
+            data = b"".join(orjson.dumps(record, option=ORJSON_OPTIONS) + b"\n" for record in records)
             
-            # Move the temporary file to the final location
-            temp_file_path.replace(file_path)
+            with open(log_path, 'ab') as f:
+                f.write(data)
+            self._unsynced_paths.add(log_path)
             
+            state[0] = max(persisted, count)
+            state[1] += 1
             logger.info(f"Saved conversation {conversation_id} to disk")
             return True
             
+        except Exception as e:
+            logger.error(f"Error saving conversation {conversation_id}: {e}")
+            # Rewrite the whole log next time rather than appending after a partial write
+            self._log_state.pop(conversation_id, None)
+            return False
+    
+    def _compact_conversation_log(self, conversation_id: str, snapshot: Dict[str, Any]) -> bool:
+        """Rewrite a conversation log as a compressed body with a single header and every message."""
+        body_path = self.conversation_dir / f"{conversation_id}.jsonl.gz"
+        log_path = self.conversation_dir / f"{conversation_id}.jsonl"
+        
+        # Save to a temporary file first to avoid corruption
+        temp_file_path = log_path.with_suffix('.tmp')
+        
+        try:
+            count = snapshot["count"]
+            records = [{"header": snapshot["header"]}]
+            records.extend({"message": message} for message in snapshot["messages"][:count])
+            data = b"".join(orjson.dumps(record, option=ORJSON_OPTIONS) + b"\n" for record in records)
+            
+            with open(temp_file_path, 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=self.log_compress_level))
+                replacing = body_path.exists() or log_path.exists()
+                if replacing:
+                    # The contents must be on disk before the rename can replace the old log
+                    f.flush()
+                    os.fsync(f.fileno())
+            
+            # Move the temporary file to the final location, then drop the tail it absorbed
+            temp_file_path.replace(body_path)
+            if log_path.exists():
+                log_path.unlink()
+            self._unsynced_paths.discard(log_path)
+            if replacing:
+                self._unsynced_paths.discard(body_path)
+            else:
+                # A brand-new log has nothing to lose: it is synced with the next group
+                self._unsynced_paths.add(body_path)
+            self._dir_unsynced = True
+            self._log_state[conversation_id] = [count, 1]
+            
+            # The log supersedes any legacy JSON snapshot
+            legacy_path = self.conversation_dir / f"{conversation_id}.json"
+            if legacy_path.exists():
+                legacy_path.unlink()
+            
+            logger.info(f"Saved conversation {conversation_id} to disk (compacted log)")
+            return True
+            
         except Exception as e:
             logger.error(f"Error saving conversation {conversation_id}: {e}")
             # Clean up temporary file if it exists
-            temp_file_path = self.conversation_dir / f"{conversation_id}.tmp"
             if temp_file_path.exists():
                 try:
                     temp_file_path.unlink()
@@ -142,36 +534,38 @@ class ConversationService:
     
     def create_conversation(self, initial_specialty: str = "internal_medicine") -> InteractiveConversation:
         """Create a new conversation."""
-        conversation_id = generate_id()
+        conversation = self._new_conversation(initial_specialty)
+        
+        self._cache_conversation(conversation)
+        self._save_conversation(conversation.conversation_id, conversation)
+        
+        return conversation
+    
+    def _new_conversation(self, initial_specialty: str) -> InteractiveConversation:
+        """Build a conversation with its welcome message; the caller caches and saves it."""
         conversation = InteractiveConversation(
-            conversation_id=conversation_id,
+            conversation_id=generate_id(),
             active_specialty=initial_specialty,
             all_specialties=[initial_specialty]
         )
         
         # Add welcome message
         conversation.add_message(
-            content=f"Bienvenido a la consulta médica interactiva. Estás hablando con un especialista en {initial_specialty}. "
-                   f"¿En qué puedo ayudarte hoy? (El sistema automáticamente te dirigirá al especialista más adecuado según tu consulta)",
+            content=WELCOME_MESSAGE_TEMPLATE.format(specialty=initial_specialty),
             sender="system"
         )
         
-        self.conversations[conversation_id] = conversation
-        self._save_conversation(conversation_id)
-        
         return conversation
     
     async def create_conversation_with_triage(self, initial_query: str = None) -> InteractiveConversation:
         """Create a new conversation with initial triage to determine the best specialty."""
-        conversation_id = generate_id()
-        
         # Default to internal_medicine if no initial query
         initial_specialty = "internal_medicine"
         
         # If there's an initial query, use triage to determine the best specialty
         if initial_query:
             try:
-                specialty_classification = await self.llm_service.classify_specialty(initial_query)
+                specialty_classification = await self._classify_specialty(initial_query)
                 recommended_specialty = specialty_classification["recommended_specialty"]
                 confidence = specialty_classification["confidence"]
                 
@@ -183,18 +577,7 @@ class ConversationService:
                 logger.error(f"Error en triaje inicial: {e}")
         
         # Create the conversation with the determined specialty
-        conversation = InteractiveConversation(
-            conversation_id=conversation_id,
-            active_specialty=initial_specialty,
-            all_specialties=[initial_specialty]
-        )
-        
-        # Add welcome message
-        conversation.add_message(
-            content=f"Bienvenido a la consulta médica interactiva. Estás hablando con un especialista en {initial_specialty}. "
-                   f"¿En qué puedo ayudarte hoy? (El sistema automáticamente te dirigirá al especialista más adecuado según tu consulta)",
-            sender="system"
-        )
+        conversation = self._new_conversation(initial_specialty)
         
         # If there was an initial query, add it to the conversation as user message
         if initial_query:
@@ -206,7 +589,7 @@ class ConversationService:
                 
                 # Create context of the conversation
                 context = {
-                    "conversation_history": [conversation.messages[0].dict()]  # Only the welcome message
+                    "conversation_history": conversation._message_dicts[:1]  # Only the welcome message
                 }
                 
                 # Process the query with the advanced system
@@ -226,57 +609,132 @@ class ConversationService:
                     sender=initial_specialty
                 )
         
-        self.conversations[conversation_id] = conversation
-        self._save_conversation(conversation_id)
+        self._cache_conversation(conversation)
+        self._save_conversation(conversation.conversation_id, conversation)
         
         return conversation
     
     def get_conversation(self, conversation_id: str) -> Optional[InteractiveConversation]:
         """Get a conversation by ID. If not in memory, try to load from disk."""
         # First, check if conversation is in memory
-        if conversation_id in self.conversations:
-            return self.conversations[conversation_id]
+        conv = self.conversations.get(conversation_id)
+        if conv is not None:
+            self.conversations.move_to_end(conversation_id)
+            return conv
         
         # If not in memory, try to load from disk
-        try:
-            file_path = self.conversation_dir / f"{conversation_id}.json"
-            if file_path.exists():
-                logger.info(f"Loading conversation {conversation_id} from disk on-demand")
-                with open(file_path, 'r') as f:
-                    data = json.load(f)
-                    conv = InteractiveConversation(**data)
-                    # Add to memory cache
-                    self.conversations[conv.conversation_id] = conv
-                    logger.info(f"Successfully loaded conversation {conversation_id} from disk")
-                    return conv
-            else:
-                logger.warning(f"Conversation file {file_path} does not exist")
-                return None
-        except Exception as e:
-            logger.error(f"Error loading conversation {conversation_id} from disk: {e}")
+        logger.info(f"Loading conversation {conversation_id} from disk on-demand")
+        conv = self._load_conversation(conversation_id)
+        if conv is None:
+            logger.warning(f"Conversation {conversation_id} not found on disk")
             return None
+        
+        # Add to memory cache
+        self._cache_conversation(conv)
+        logger.info(f"Successfully loaded conversation {conversation_id} from disk")
+        return conv
+    
+    def _load_conversation(self, conversation_id: str) -> Optional[InteractiveConversation]:
+        """Read a conversation from disk, writing any save still queued for it first."""
+        # A conversation evicted with a save still queued must be written before reading it back;
+        # the writer lock keeps a flush in progress from landing between the check and the read
+        with self._write_lock:
+            if conversation_id in self._pending_saves:
+                self._flush_pending_saves()
+            return self._read_conversation(conversation_id)
+    
+    async def get_conversation_async(self, conversation_id: str) -> Optional[InteractiveConversation]:
+        """Async variant of `get_conversation` that loads from disk in a worker thread instead of on the event loop."""
+        conv = self.conversations.get(conversation_id)
+        if conv is not None:
+            self.conversations.move_to_end(conversation_id)
+            return conv
+        return await asyncio.to_thread(self.get_conversation, conversation_id)
+    
+    def _cache_conversation(self, conversation: InteractiveConversation):
+        """Keep a conversation in memory as the most recently used, evicting the least recently used ones."""
+        self._known_ids.add(conversation.conversation_id)
+        self.conversations[conversation.conversation_id] = conversation
+        self.conversations.move_to_end(conversation.conversation_id)
+        while len(self.conversations) > self.max_conversations_in_memory:
+            # Los guardados pendientes llevan su propia instantánea, así que expulsar es seguro
+            evicted_id, _ = self.conversations.popitem(last=False)
+            logger.debug(f"Evicted conversation {evicted_id} from memory")
     
     def get_all_conversations(self) -> List[InteractiveConversation]:
-        """Get all conversations."""
-        return list(self.conversations.values())
+        """Get all conversations.
+        
+        Conversations not in memory are read from disk without caching them, so listing
+        every conversation does not evict the ones in active use.
+        """
+        conversations = []
+        for conversation_id in list(self._known_ids):
+            conv = self.conversations.get(conversation_id) or self._load_conversation(conversation_id)
+            if conv is not None:
+                conversations.append(conv)
+        return conversations
     
-    async def _process_with_advanced_system(self, query: str, specialty: str = None, context: Dict = None):
-        """Process query using the advanced medical system."""
+    def get_conversation_summaries(self) -> List[Dict[str, Any]]:
+        """List every conversation from the header index (see `_index_entry`) without reading its log.
+        
+        Conversations missing from the index (legacy files, or saved right before a crash) are
+        read once to index them.
+        """
+        indexed = False
+        for conversation_id in list(self._known_ids):
+            if conversation_id in self._conversation_index:
+                continue
+            conv = self.conversations.get(conversation_id) or self._load_conversation(conversation_id)
+            if conv is None:
+                continue
+            with self._save_lock:
+                if conversation_id not in self._conversation_index:
+                    entry = self._index_entry(conv, len(conv._message_dicts))
+                    self._conversation_index[conversation_id] = entry
+                    self._index_pending[conversation_id] = entry
+                    indexed = True
+        if indexed:
+            # Let the writer persist the new entries so the next start does not read these logs again
+            self._save_event.set()
+        
+        with self._save_lock:
+            return [dict(entry) for entry in self._conversation_index.values()]
+    
+    async def _classify_specialty(self, message: str) -> Dict[str, Any]:
+        """Classify the specialty for a message, reusing cached classifications."""
+        classification = self.classification_cache.get(message)
+        if classification is None:
+            classification = await self.llm_service.classify_specialty(message)
+            self.classification_cache.put(message, classification)
+        return classification
+    
+    async def _route_with_advanced_system(self, query: str, specialty: str = None, context: Dict = None) -> ConsensusResponse:
+        """Run the advanced medical system and return its full response, including the router's decision."""
         try:
-            response = await self.medical_system.process_medical_query(
+            return await self.medical_system.process_medical_query(
                 query=query,
                 specialty=specialty,
                 medical_criteria="Interactive conversation",
                 context=context
             )
-            return response.primary_response
         except Exception as e:
             logger.error(f"Error with advanced system: {e}")
-            return f"Lo siento, he experimentado un problema técnico. ¿Podrías reformular tu consulta?"
+            return ConsensusResponse(
+                primary_specialty=specialty or "internal_medicine",
+                primary_response="Lo siento, he experimentado un problema técnico. ¿Podrías reformular tu consulta?"
+            )
+    
+    async def _process_with_advanced_system(self, query: str, specialty: str = None, context: Dict = None):
+        """Process query using the advanced medical system."""
+        response = await self._route_with_advanced_system(query, specialty, context)
+        return response.primary_response
     
     async def process_message(self, conversation_id: str, message: str) -> Optional[str]:
-        """Process a user message in a conversation."""
-        conversation = self.get_conversation(conversation_id)
+        """Process a user message in a conversation.
+        
+        The specialist's reply is added to the conversation and queued for saving before it is returned.
+        """
+        conversation = await self.get_conversation_async(conversation_id)
         if not conversation:
             logger.error(f"Conversation {conversation_id} not found")
             return None
@@ -285,134 +743,94 @@ class ConversationService:
         conversation.add_message(content=message, sender="user")
         
         try:
-            # Primero, determinar si necesitamos cambiar de especialista basado en el contenido del mensaje
-            specialty_classification = await self.llm_service.classify_specialty(message)
+            current_specialty = conversation.active_specialty
+            
+            # Si el paciente está respondiendo al especialista actual sobre el mismo tema se queda
+            # con él, así que no hace falta considerar un cambio de especialidad
+            if self._is_follow_up_message(message, conversation):
+                self.classifications_avoided += 1
+                logger.info(f"Clasificación de especialidad omitida por mensaje de seguimiento "
+                            f"({self.classifications_avoided} omitidas)")
+                
+                # Procesar la consulta con el sistema avanzado
+                response = await self._route_with_advanced_system(
+                    query=message,
+                    specialty=current_specialty,
+                    context={"conversation_history": self._windowed_history(conversation, -1)}  # Todos los mensajes excepto el actual
+                )
+                return self._add_specialist_reply(conversation_id, conversation, response)
+            
+            # El router del sistema avanzado elige especialista y este responde en la misma ejecución
+            response = await self._route_with_advanced_system(
+                query=message,
+                specialty=current_specialty,
+                context={"conversation_history": self._windowed_history(conversation, -1)}
+            )
+            
+            # Si el router confirma al especialista actual no hay cambio que decidir. Si propone otro,
+            # o no llegó a decidir (sistema de respaldo), el cambio lo decide el clasificador de
+            # especialidad, para el que está calibrado el umbral de confianza
+            if response.router_confidence is not None and response.primary_specialty == current_specialty:
+                logger.info(f"Router confirma la especialidad {current_specialty} (confianza: {response.router_confidence})")
+                return self._add_specialist_reply(conversation_id, conversation, response)
+            
+            specialty_classification = await self._classify_specialty(message)
             recommended_specialty = specialty_classification["recommended_specialty"]
             confidence = specialty_classification["confidence"]
             reasoning = specialty_classification["reasoning"]
             
-            current_specialty = conversation.active_specialty
-            
             logger.info(f"Clasificación especialidad: {recommended_specialty} (confianza: {confidence}) - Razonamiento: {reasoning}")
             
-            # Verificar si hubo cambios recientes de especialidad para evitar cambios rápidos
-            can_switch = True
-            last_switch_time = None
+            # Si el especialista recomendado es diferente al actual y hay buena confianza, hacer un cambio
+            should_switch = (recommended_specialty != current_specialty and
+                             confidence >= self.specialty_confidence_threshold)
             
-            if conversation_id in self.specialty_changes:
-                changes = self.specialty_changes[conversation_id]
-                last_switch_time = changes.get('last_switch_time')
-                switch_count = changes.get('count', 0)
+            if should_switch:
+                # Verificar si hubo cambios recientes de especialidad para evitar cambios rápidos
+                now = time.monotonic()
+                recent_switches = self.specialty_changes.get(conversation_id, ())
                 
                 # No permitir más de 2 cambios en los últimos 5 minutos
-                if last_switch_time and (datetime.now() - last_switch_time) < timedelta(minutes=5):
-                    if switch_count >= 2:
-                        can_switch = False
-                        logger.info(f"Bloqueando cambio automático de especialidad - demasiados cambios recientes")
+                if len(recent_switches) >= MAX_SPECIALTY_SWITCHES and now - recent_switches[0] < SWITCH_BLOCK_WINDOW:
+                    should_switch = False
+                    logger.info(f"Bloqueando cambio automático de especialidad - demasiados cambios recientes")
             
-            # Verificar si el paciente está proporcionando información adicional sobre el mismo tema
-            is_follow_up = self._is_follow_up_message(message, conversation)
+            if not should_switch:
+                return self._add_specialist_reply(conversation_id, conversation, response)
             
-            # Si el especialista recomendado es diferente al actual y hay buena confianza, hacer un cambio
-            # PERO NO si es una respuesta de seguimiento del mismo tema
-            if (recommended_specialty != current_specialty and 
-                confidence >= self.specialty_confidence_threshold and 
-                can_switch and 
-                not is_follow_up):
-                logger.info(f"Orquestador cambiando automáticamente de {current_specialty} a {recommended_specialty} (confianza: {confidence})")
-                
-                # Registrar el cambio de especialidad
-                now = datetime.now()
-                if conversation_id not in self.specialty_changes:
-                    self.specialty_changes[conversation_id] = {'count': 1, 'last_switch_time': now}
-                else:
-                    # Reiniciar contador si pasaron más de 10 minutos desde el último cambio
-                    if last_switch_time and (now - last_switch_time) > timedelta(minutes=10):
-                        self.specialty_changes[conversation_id] = {'count': 1, 'last_switch_time': now}
-                    else:
-                        self.specialty_changes[conversation_id]['count'] = self.specialty_changes[conversation_id].get('count', 0) + 1
-                        self.specialty_changes[conversation_id]['last_switch_time'] = now
-                
-                # Añadir mensaje del sistema explicando el cambio
-                conversation.add_message(
-                    content=f"⚕️ El orquestador médico ha determinado que un especialista en {recommended_specialty} puede responder mejor a tu consulta. Motivo: {reasoning}. Transfiriendo...",
-                    sender="system"
-                )
-                
-                # Cambiar a la nueva especialidad
-                conversation.switch_specialty(recommended_specialty)
-                
-                # Procesar con el sistema avanzado usando la nueva especialidad
-                try:
-                    # El sistema avanzado maneja automáticamente la especialidad
-                    pass  # Se procesará más abajo
-                except Exception as agent_error:
-                    logger.error(f"Error al cambiar a especialidad {recommended_specialty}: {agent_error}")
-                    # Si falla el cambio, volver a la especialidad anterior
-                    conversation.switch_specialty(current_specialty)
-                    conversation.add_message(
-                        content=f"Lo siento, no se pudo conectar con el especialista en {recommended_specialty}. Continuando con {current_specialty}.",
-                        sender="system"
-                    )
-                
-                # Crear contexto relevante
-                context = {
-                    "conversation_history": [msg.dict() for msg in conversation.messages[:-2]],  # Todos los mensajes excepto los dos últimos
-                    "previous_specialty": current_specialty,
-                    "auto_transfer": True,  # Indicar que fue un cambio automático
-                    "confidence": confidence,
-                    "reasoning": reasoning
-                }
-                
-                # Generar respuesta del nuevo especialista usando sistema avanzado
-                try:
-                    specialist_message = await self._process_with_advanced_system(
-                        query=message,
-                        specialty=recommended_specialty,
-                        context=context
-                    )
-                except Exception as agent_response_error:
-                    logger.error(f"Error al procesar consulta con {recommended_specialty}: {agent_response_error}")
-                    specialist_message = f"Como especialista en {recommended_specialty}, me gustaría responder a tu consulta, pero estoy experimentando algunas dificultades técnicas. ¿Podrías reformular tu pregunta?"
-                
-                # Añadir respuesta del especialista
-                conversation.add_message(content=specialist_message, sender=recommended_specialty)
-                
-                # Guardar conversación actualizada
-                self._save_conversation(conversation_id)
-                
-                return specialist_message
-            else:
-                # Si no hay cambio de especialidad, proceder con sistema avanzado
-                specialty = conversation.active_specialty
-                
-                # Crear contexto de la conversación
-                context = {
-                    "conversation_history": [msg.dict() for msg in conversation.messages[:-1]]  # Todos los mensajes excepto el actual
-                }
-                
-                # Procesar la consulta con el sistema avanzado
-                try:
-                    agent_message = await self._process_with_advanced_system(
-                        query=message,
-                        specialty=specialty,
-                        context=context
-                    )
-                except Exception as agent_error:
-                    logger.error(f"Error al procesar consulta con {specialty}: {agent_error}")
-                    agent_message = f"Lo siento, como especialista en {specialty}, estoy experimentando algunas dificultades para procesar tu consulta. ¿Podrías reformular tu pregunta o intentarlo de nuevo más tarde?"
-                
-                # Añadir respuesta del especialista
-                conversation.add_message(content=agent_message, sender=specialty)
-                
-                # Guardar conversación actualizada
-                self._save_conversation(conversation_id)
-                
-                return agent_message
+            logger.info(f"Orquestador cambiando automáticamente de {current_specialty} a {recommended_specialty} (confianza: {confidence})")
+            
+            # Registrar el cambio de especialidad
+            self._record_specialty_switch(conversation_id, now)
+            
+            # Añadir mensaje del sistema explicando el cambio
+            conversation.add_message(
+                content=f"⚕️ El orquestador médico ha determinado que un especialista en {recommended_specialty} puede responder mejor a tu consulta. Motivo: {reasoning}. Transfiriendo...",
+                sender="system"
+            )
+            
+            # Cambiar a la nueva especialidad
+            conversation.switch_specialty(recommended_specialty)
+            
+            # Crear contexto relevante
+            context = {
+                "conversation_history": self._windowed_history(conversation, -2),  # Todos los mensajes excepto los dos últimos
+                "previous_specialty": current_specialty,
+                "auto_transfer": True,  # Indicar que fue un cambio automático
+                "confidence": confidence,
+                "reasoning": reasoning
+            }
+            
+            # Los cambios son poco frecuentes: el nuevo especialista responde de nuevo con el contexto del traspaso
+            response = await self._route_with_advanced_system(
+                query=message,
+                specialty=recommended_specialty,
+                context=context
+            )
+            return self._add_specialist_reply(conversation_id, conversation, response)
             
         except Exception as e:
-            logger.error(f"Error processing message in conversation {conversation_id}: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception(f"Error processing message in conversation {conversation_id}: {e}")
             
             specialty = conversation.active_specialty
             
@@ -420,10 +838,72 @@ class ConversationService:
             conversation.add_message(content=error_message, sender=specialty)
             
             # Guardar conversación incluso en caso de error
-            self._save_conversation(conversation_id)
+            self._save_conversation(conversation_id, conversation)
             
             return error_message
     
+    def _add_specialist_reply(self, conversation_id: str, conversation: InteractiveConversation,
+                              response: ConsensusResponse) -> str:
+        """Añadir la respuesta con la especialidad que la redactó, encolar el guardado y devolverla."""
+        conversation.add_message(content=response.primary_response, sender=response.primary_specialty)
+        self._save_conversation(conversation_id, conversation)
+        return response.primary_response
+    
+    def _record_specialty_switch(self, conversation_id: str, now: float):
+        """Registrar un cambio automático de especialidad y olvidar las conversaciones sin cambios recientes."""
+        switches = self.specialty_changes.pop(conversation_id, None) or deque(maxlen=MAX_SPECIALTY_SWITCHES)
+        switches.append(now)
+        self.specialty_changes[conversation_id] = switches
+        
+        # Una conversación cuyo último cambio queda fuera de la ventana ya no puede bloquear ninguno
+        while self.specialty_changes:
+            oldest_id, oldest_switches = next(iter(self.specialty_changes.items()))
+            if now - oldest_switches[-1] < SWITCH_BLOCK_WINDOW:
+                break
+            del self.specialty_changes[oldest_id]
+    
+    def _windowed_history(self, conversation: InteractiveConversation, end: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Historial para el LLM limitado a los últimos `history_window` mensajes.
+        
+        Los mensajes anteriores a la ventana no se descartan del todo: lo que contaron los
+        pacientes se condensa en una sola entrada de tamaño acotado al principio, de modo que
+        los síntomas iniciales siguen disponibles sin que el prompt crezca con cada turno.
+        """
+        history = conversation._message_dicts[:end]
+        cutoff = len(history) - self.history_window
+        if cutoff <= 0:
+            return history
+        return [self._older_history_summary(conversation, cutoff)] + history[cutoff:]
+    
+    def _older_history_summary(self, conversation: InteractiveConversation, cutoff: int) -> Dict[str, Any]:
+        """Entrada que resume los mensajes del paciente anteriores a `cutoff`.
+        
+        Se actualiza de forma incremental cuando la ventana avanza y no supera `history_summary_chars`:
+        conserva el primer mensaje (el motivo de consulta) y los más recientes que quepan.
+        """
+        cached = conversation._history_summary
+        if cached is not None and cached[0] == cutoff:
+            return cached[2]
+        
+        # Solo hay que añadir los mensajes que acaban de salir de la ventana
+        start, pieces = (cached[0], cached[1]) if cached is not None and cached[0] < cutoff else (0, [])
+        for msg in conversation._message_dicts[start:cutoff]:
+            if msg['sender'] == 'user':
+                pieces.append(msg['content'][:self.history_summary_message_chars])
+        
+        size = sum(map(len, pieces)) + 3 * (len(pieces) - 1)
+        while len(pieces) > 2 and size > self.history_summary_chars:
+            size -= len(pieces.pop(1)) + 3
+        
+        summary = {
+            # Remitente propio para que los agentes lo presenten como resumen y no como un mensaje del paciente
+            "sender": HISTORY_SUMMARY_SENDER,
+            "content": " | ".join(pieces),
+            "timestamp": conversation._message_dicts[cutoff - 1]['timestamp'],
+        }
+        conversation._history_summary = (cutoff, pieces, summary)
+        return summary
+    
     def _is_follow_up_message(self, message: str, conversation: InteractiveConversation) -> bool:
         """Detectar si el mensaje es una respuesta de seguimiento al mismo tema médico"""
         
@@ -431,55 +911,36 @@ class ConversationService:
         if len(conversation.messages) < 2:
             return False
         
-        # Obtener los últimos mensajes del especialista
-        recent_specialist_messages = []
-        for msg in reversed(conversation.messages[-5:]):  # Últimos 5 mensajes
-            if msg.sender == conversation.active_specialty:
-                recent_specialist_messages.append(msg.content.lower())
-                if len(recent_specialist_messages) >= 2:  # Solo necesitamos los últimos 2
-                    break
-        
-        if not recent_specialist_messages:
+        # Último mensaje del especialista entre los 5 más recientes
+        last_specialist_message = next(
+            (msg for msg in reversed(conversation.messages[-5:]) if msg.sender == conversation.active_specialty),
+            None
+        )
+        if last_specialist_message is None:
             return False
         
-        # Palabras clave que indican que el especialista está pidiendo información adicional
-        follow_up_indicators = [
-            "podrías describirme", "me gustaría preguntarte", "necesito que me des",
-            "¿podrías", "¿has notado", "¿tienes", "¿existe", "¿hay algo",
-            "más información", "más detalles", "cuéntame más", "dime si",
-            "responde", "pregunta", "información adicional"
-        ]
-        
-        # Verificar si el último mensaje del especialista contenía solicitud de información
-        last_specialist_message = recent_specialist_messages[0]
-        specialist_asking_for_info = any(indicator in last_specialist_message for indicator in follow_up_indicators)
-        
-        # Palabras clave que indican que el paciente está respondiendo/proporcionando información
-        patient_response_indicators = [
-            "es un dolor", "tengo", "siento", "me duele", "principalemnte", "principalmente",
-            "no tengo", "sí", "no", "desde hace", "hace", "cuando", "al", "con",
-            "irrada", "irradia", "hacia", "en", "también", "además", "pero",
-            "vision borrosa", "visión", "trabajo", "pantalla", "nada mas", "nada más"
-        ]
-        
-        message_lower = message.lower()
-        patient_providing_info = any(indicator in message_lower for indicator in patient_response_indicators)
-        
-        # Es follow-up si:
-        # 1. El especialista pidió información Y el paciente está respondiendo
-        # 2. O si el mensaje es muy corto (típico de respuestas)
-        is_short_response = len(message.split()) <= 10
-        
-        is_follow_up = (specialist_asking_for_info and patient_providing_info) or is_short_response
-        
-        if is_follow_up:
+        # Un mensaje muy corto (típico de respuestas) es follow-up sin necesidad de analizar el texto,
+        # pero solo una vez que el especialista activo ya ha respondido
+        if len(message.split()) <= 10:
             logger.info(f"Detectado mensaje de seguimiento - evitando cambio de especialidad")
+            return True
+        
+        # Si no, es follow-up si el especialista pidió información Y el paciente está respondiendo
+        if FOLLOW_UP_INDICATORS_RE.search(last_specialist_message.content_lower) is None:
+            return False
+        
+        # El mensaje del usuario ya está en el historial; reutilizar su versión en minúsculas
+        last_message = conversation.messages[-1]
+        message_lower = last_message.content_lower if last_message.content == message else message.lower()
+        if PATIENT_RESPONSE_INDICATORS_RE.search(message_lower) is None:
+            return False
         
-        return is_follow_up
+        logger.info(f"Detectado mensaje de seguimiento - evitando cambio de especialidad")
+        return True
     
     async def switch_specialty(self, conversation_id: str, new_specialty: str) -> Optional[str]:
         """Switch the specialty in a conversation."""
-        conversation = self.get_conversation(conversation_id)
+        conversation = await self.get_conversation_async(conversation_id)
         if not conversation:
             logger.error(f"Conversation {conversation_id} not found")
             return None
@@ -491,7 +952,7 @@ class ConversationService:
             
             # Create a summary of the conversation for context
             context = {
-                "conversation_history": [msg.dict() for msg in conversation.messages],
+                "conversation_history": self._windowed_history(conversation),
                 "previous_specialty": old_specialty,
                 "manual_transfer": True  # Indicar que fue un cambio manual
             }
@@ -513,8 +974,9 @@ class ConversationService:
             # Add the new specialist's greeting
             conversation.add_message(content=agent_message, sender=new_specialty)
             
-            # Save the updated conversation
-            self._save_conversation(conversation_id)
+            # Save the updated conversation; manual transfers are flushed before returning
+            self._save_conversation(conversation_id, conversation)
+            await self.flush()
             
             return agent_message
             
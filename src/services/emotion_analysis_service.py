@@ -3,13 +3,17 @@ Servicio de análisis emocional avanzado con NLP.
 Detecta emociones mixtas, contradictorias y fluctuaciones en tiempo real.
 """
 
+import asyncio
 import logging
+import math
 import re
+import threading
 from datetime import datetime
-from typing import Dict, List, Tuple, Optional, Any
-from collections import Counter, defaultdict
-import statistics
+from typing import Deque, Dict, List, Tuple, Optional, Any
+from collections import Counter, OrderedDict, deque
+from bisect import bisect_left
 
+from src.utils.running_stats import RunningStats
 from src.models.psychology_models import (
     EmotionalState, EmotionCategory, LongitudinalDataPoint,
     PsychologyDataManager
@@ -18,17 +22,65 @@ from src.models.psychology_models import (
 # Configurar logging
 logger = logging.getLogger(__name__)
 
+# Tres o más mayúsculas seguidas en el texto original (gritar)
+UPPERCASE_RUN_RE = re.compile(r'[A-ZÁÉÍÓÚÜÑ]{3,}')
+
+# Caracteres que se eliminan al preprocesar, y su equivalente como tabla de borrado para Latin-1
+SPECIAL_CHARS_RE = re.compile(r'[^\w\s.,;:!?()]')
+LATIN1_SPECIAL_CHARS = bytes(code for code in range(256) if SPECIAL_CHARS_RE.match(chr(code)))
+
+# Conectores presentes en todos los patrones de contradicción del tipo "X pero Y"
+CONTRADICTION_CONNECTORS = r'pero|sin embargo|aunque'
+
+# Estados emocionales que se conservan por sesión (los más antiguos se descartan)
+SESSION_HISTORY_CAPACITY = 512
+
 
 class AdvancedEmotionAnalyzer:
     """Analizador de emociones con capacidades NLP avanzadas."""
     
+    # Lexicón, modificadores y patrones compilados: son de sólo lectura, así que se construyen
+    # una vez (con la primera instancia) y se comparten entre todas
+    _shared_tables: Optional[Dict[str, Any]] = None
+    
     def __init__(self):
         """Inicializar el analizador de emociones."""
+        tables = AdvancedEmotionAnalyzer._shared_tables
+        if tables is None:
+            tables = AdvancedEmotionAnalyzer._shared_tables = self._build_shared_tables()
+        self.__dict__.update(tables)
+        # Resultados de análisis por (texto normalizado, texto en mayúsculas) (LRU)
+        self.analysis_cache_size = 1024
+        self._analysis_cache: "OrderedDict[Tuple[str, bool], Dict[str, Any]]" = OrderedDict()
+        # Historial acotado a los últimos SESSION_HISTORY_CAPACITY estados
+        self.session_emotional_history: Deque[EmotionalState] = deque(maxlen=SESSION_HISTORY_CAPACITY)
+        # Columnas del historial (valencia, intensidad, emoción primaria) para recorrerlo sin acceder a atributos
+        self._history_valence: Deque[float] = deque(maxlen=SESSION_HISTORY_CAPACITY)
+        self._history_intensity: Deque[float] = deque(maxlen=SESSION_HISTORY_CAPACITY)
+        # Estadísticos de las columnas anteriores, mantenidos al añadir y al descartar estados
+        self._valence_stats = RunningStats()
+        self._intensity_stats = RunningStats()
+        self._history_emotion: Deque[EmotionCategory] = deque(maxlen=SESSION_HISTORY_CAPACITY)
+        self._history_contradiction_mask: Deque[int] = deque(maxlen=SESSION_HISTORY_CAPACITY)
+        
+    def _build_shared_tables(self) -> Dict[str, Any]:
+        """Construir las tablas de sólo lectura del analizador (ver `_shared_tables`)."""
         self.emotion_lexicon = self._load_emotion_lexicon()
+        self.emotion_matcher, self.nested_emotion_words = self._build_emotion_matcher()
         self.contradiction_patterns = self._load_contradiction_patterns()
+        self.contradiction_groups = self._group_contradiction_patterns()
         self.intensity_modifiers = self._load_intensity_modifiers()
-        self.session_emotional_history = []
-        
+        self.modifier_matcher = re.compile(
+            "(?=(" + "|".join(map(re.escape, sorted(self.intensity_modifiers, key=len, reverse=True))) + "))"
+        )
+        # Prioridad de cada modificador cuando varios caen cerca de la misma palabra (orden del diccionario)
+        self.modifier_rank = {mod_word: rank for rank, mod_word in enumerate(self.intensity_modifiers)}
+        self.trigger_patterns = self._load_trigger_patterns()
+        # Un bit por tipo de contradicción, en el orden de los patrones
+        self.contradiction_types = list(dict.fromkeys(p['type'] for p in self.contradiction_patterns))
+        self.contradiction_bits = {c_type: 1 << bit for bit, c_type in enumerate(self.contradiction_types)}
+        return dict(self.__dict__)
+    
     def _load_emotion_lexicon(self) -> Dict[str, Dict[str, Any]]:
         """Cargar lexicón de emociones expandido."""
         return {
@@ -71,35 +123,76 @@ class AdvancedEmotionAnalyzer:
             'contradictorio': {'category': EmotionCategory.AMBIVALENCE, 'valence': 0, 'arousal': 65}
         }
     
+    def _build_emotion_matcher(self) -> Tuple["re.Pattern", Dict[str, List[Tuple[str, int]]]]:
+        """Compilar el lexicón en una sola expresión que encuentra todas sus palabras en una pasada.
+        
+        El lookahead prueba cada posición del texto, y las palabras más largas van primero;
+        las palabras del lexicón contenidas dentro de otras (p. ej. 'triste' en 'tristeza')
+        se registran aparte junto con su desplazamiento para no perder esas coincidencias.
+        """
+        words = sorted(self.emotion_lexicon, key=len, reverse=True)
+        matcher = re.compile("(?=(" + "|".join(map(re.escape, words)) + "))")
+        
+        nested = {}
+        for word in words:
+            nested[word] = [
+                (other, word.find(other)) for other in words
+                if other != word and other in word
+            ]
+        return matcher, nested
+    
     def _load_contradiction_patterns(self) -> List[Dict[str, Any]]:
-        """Cargar patrones de contradicción emocional."""
-        return [
+        """Cargar patrones de contradicción emocional (con su regex ya compilada).
+        
+        `requires` es un fragmento que toda coincidencia del patrón contiene: si no aparece
+        en el texto, el patrón (con sus `.*` costosos al fallar) no se llega a ejecutar.
+        """
+        patterns = [
             {
                 'pattern': r'(feliz|contento|alegre).*(pero|sin embargo|aunque).*(triste|deprimido|mal)',
                 'type': 'joy_sadness_contradiction',
+                'requires': CONTRADICTION_CONNECTORS,
                 'emotions': [EmotionCategory.JOY, EmotionCategory.SADNESS]
             },
             {
                 'pattern': r'(tranquilo|relajado|calm[ao]).*(pero|sin embargo|aunque).*(nervioso|ansioso|preocupado)',
                 'type': 'calm_anxiety_contradiction',
+                'requires': CONTRADICTION_CONNECTORS,
                 'emotions': [EmotionCategory.CONTENTMENT, EmotionCategory.ANXIETY]
             },
             {
                 'pattern': r'(bien|mejor).*(pero|sin embargo|aunque).*(mal|peor|horrible)',
                 'type': 'positive_negative_contradiction',
+                'requires': CONTRADICTION_CONNECTORS,
                 'emotions': [EmotionCategory.JOY, EmotionCategory.SADNESS]
             },
             {
                 'pattern': r'(amo|quiero|adoro).*(pero|sin embargo|aunque).*(odio|detesto|no soporto)',
                 'type': 'love_hate_contradiction',
+                'requires': CONTRADICTION_CONNECTORS,
                 'emotions': [EmotionCategory.JOY, EmotionCategory.ANGER]
             },
             {
                 'pattern': r'me siento (.*) y (.*) a la vez',
                 'type': 'simultaneous_emotions',
+                'requires': r' a la vez',
                 'emotions': []  # Se detectan dinámicamente
             }
         ]
+        for pattern_data in patterns:
+            pattern_data['regex'] = re.compile(pattern_data['pattern'], re.IGNORECASE)
+        return patterns
+    
+    def _group_contradiction_patterns(self) -> List[Tuple["re.Pattern", List[Tuple["re.Pattern", str, List[EmotionCategory]]]]]:
+        """Agrupar patrones de contradicción consecutivos que requieren el mismo fragmento (conserva el orden)."""
+        groups = []
+        last_requires = None
+        for pattern_data in self.contradiction_patterns:
+            if pattern_data['requires'] != last_requires:
+                last_requires = pattern_data['requires']
+                groups.append((re.compile(last_requires, re.IGNORECASE), []))
+            groups[-1][1].append((pattern_data['regex'], pattern_data['type'], pattern_data['emotions']))
+        return groups
     
     def _load_intensity_modifiers(self) -> Dict[str, float]:
         """Cargar modificadores de intensidad emocional."""
@@ -127,14 +220,75 @@ class AdvancedEmotionAnalyzer:
             'apenas': 0.4
         }
     
+    def _load_trigger_patterns(self) -> List["re.Pattern"]:
+        """Cargar patrones compilados para extraer triggers emocionales.
+        
+        Se mantienen como patrones separados: cada uno empieza por un literal que el motor de
+        `re` busca directamente, lo que resulta más rápido que una única alternativa combinada.
+        """
+        trigger_patterns = [
+            r'cuando (.*?)[.,]',
+            r'porque (.*?)[.,]',
+            r'después de (.*?)[.,]',
+            r'antes de (.*?)[.,]',
+            r'si (.*?)[.,]',
+            r'me recuerda a (.*?)[.,]',
+            r'me hace pensar en (.*?)[.,]'
+        ]
+        return [re.compile(pattern, re.IGNORECASE) for pattern in trigger_patterns]
+    
     def analyze_emotional_content(self, text: str, timestamp: datetime = None) -> EmotionalState:
         """Analizar contenido emocional completo de un texto."""
         if timestamp is None:
             timestamp = datetime.now()
         
-        # Preprocesar texto
+        # Preprocesar texto; las mayúsculas se pierden al normalizar, así que se miran antes
         text_normalized = self._preprocess_text(text)
+        shouting = UPPERCASE_RUN_RE.search(text) is not None
+        
+        # El análisis sólo depende del texto normalizado: los mensajes repetidos reutilizan el resultado
+        cache_key = (text_normalized, shouting)
+        analysis = self._analysis_cache.get(cache_key)
+        if analysis is None:
+            analysis = self._compute_emotional_analysis(text_normalized, shouting)
+            self._analysis_cache[cache_key] = analysis
+            if len(self._analysis_cache) > self.analysis_cache_size:
+                self._analysis_cache.popitem(last=False)
+        else:
+            self._analysis_cache.move_to_end(cache_key)
+        
+        # Crear estado emocional (con listas propias: el resultado cacheado se comparte)
+        emotional_state = EmotionalState(
+            timestamp=timestamp,
+            primary_emotion=analysis['primary_emotion'],
+            secondary_emotions=list(analysis['secondary_emotions']),
+            intensity=analysis['intensity'],
+            valence=analysis['valence'],
+            arousal=analysis['arousal'],
+            mixed_emotions=analysis['mixed_emotions'],
+            contradictory_emotions=list(analysis['contradictory_emotions']),
+            contradiction_mask=analysis['contradiction_mask'],
+            confidence=analysis['confidence'],
+            triggers=list(analysis['triggers'])
+        )
         
+        # Agregar a historial de sesión para tracking
+        if len(self._history_valence) == SESSION_HISTORY_CAPACITY:
+            # El estado más antiguo sale de la ventana
+            self._valence_stats.remove(self._history_valence[0])
+            self._intensity_stats.remove(self._history_intensity[0])
+        self._valence_stats.add(emotional_state.valence)
+        self._intensity_stats.add(emotional_state.intensity)
+        self.session_emotional_history.append(emotional_state)
+        self._history_valence.append(emotional_state.valence)
+        self._history_intensity.append(emotional_state.intensity)
+        self._history_emotion.append(emotional_state.primary_emotion)
+        self._history_contradiction_mask.append(emotional_state.contradiction_mask)
+        
+        return emotional_state
+    
+    def _compute_emotional_analysis(self, text_normalized: str, shouting: bool = False) -> Dict[str, Any]:
+        """Calcular los campos del estado emocional de un texto ya normalizado (sin efectos secundarios)."""
         # Detectar emociones presentes
         detected_emotions = self._detect_emotions(text_normalized)
         
@@ -142,57 +296,62 @@ class AdvancedEmotionAnalyzer:
         contradictions = self._detect_contradictions(text_normalized)
         
         # Calcular intensidad total
-        intensity = self._calculate_intensity(text_normalized, detected_emotions)
+        intensity = self._calculate_intensity(text_normalized, detected_emotions, shouting)
         
         # Calcular valencia y arousal promedio
         valence, arousal = self._calculate_valence_arousal(detected_emotions)
         
-        # Determinar emoción primaria
-        primary_emotion = self._determine_primary_emotion(detected_emotions)
-        
-        # Detectar emociones secundarias
-        secondary_emotions = self._determine_secondary_emotions(detected_emotions, primary_emotion)
+        # Determinar emoción primaria y emociones secundarias
+        primary_emotion, secondary_emotions = self._determine_primary_and_secondary(detected_emotions)
         
         # Detectar triggers emocionales
         triggers = self._extract_emotional_triggers(text_normalized)
         
-        # Crear estado emocional
-        emotional_state = EmotionalState(
-            timestamp=timestamp,
-            primary_emotion=primary_emotion,
-            secondary_emotions=secondary_emotions,
-            intensity=intensity,
-            valence=valence,
-            arousal=arousal,
-            mixed_emotions=len(detected_emotions) > 1,
-            contradictory_emotions=[c['type'] for c in contradictions],
-            confidence=self._calculate_confidence(detected_emotions, contradictions),
-            triggers=triggers
-        )
-        
-        # Agregar a historial de sesión para tracking
-        self.session_emotional_history.append(emotional_state)
-        
-        return emotional_state
+        return {
+            'primary_emotion': primary_emotion,
+            'secondary_emotions': tuple(secondary_emotions),
+            'intensity': intensity,
+            'valence': valence,
+            'arousal': arousal,
+            'mixed_emotions': len(detected_emotions) > 1,
+            'contradictory_emotions': tuple(c['type'] for c in contradictions),
+            'contradiction_mask': self._contradiction_mask(contradictions),
+            'confidence': self._calculate_confidence(detected_emotions, contradictions),
+            'triggers': tuple(triggers)
+        }
     
     def _preprocess_text(self, text: str) -> str:
         """Preprocesar texto para análisis."""
         # Convertir a minúsculas
         text = text.lower()
         
-        # Remover caracteres especiales pero mantener puntuación relevante
-        text = re.sub(r'[^\w\s.,;:!?()]', '', text)
-        
-        return text
+        # Remover caracteres especiales pero mantener puntuación relevante.
+        # Casi todos los mensajes caben en Latin-1 (incluye tildes y ñ): ahí basta con bytes.translate
+        try:
+            encoded = text.encode('latin-1')
+        except UnicodeEncodeError:
+            return SPECIAL_CHARS_RE.sub('', text)
+        return encoded.translate(None, LATIN1_SPECIAL_CHARS).decode('latin-1')
     
     def _detect_emotions(self, text: str) -> List[Dict[str, Any]]:
         """Detectar emociones presentes en el texto."""
+        # Primera aparición de cada palabra del lexicón, en una sola pasada sobre el texto
+        modifier_hits = self._find_modifier_hits(text)
+        first_positions = {}
+        for match in self.emotion_matcher.finditer(text):
+            word, position = match.group(1), match.start()
+            for found, offset in [(word, 0)] + self.nested_emotion_words[word]:
+                if position + offset < first_positions.get(found, len(text)):
+                    first_positions[found] = position + offset
+        
         detected = []
         
+        # Mantener el orden del lexicón: decide el desempate de la emoción primaria
         for word, emotion_data in self.emotion_lexicon.items():
-            if word in text:
+            position = first_positions.get(word)
+            if position is not None:
                 # Calcular intensidad basada en modificadores cercanos
-                intensity_modifier = self._find_intensity_modifier(text, word)
+                intensity_modifier = self._find_intensity_modifier(text, word, position, modifier_hits)
                 
                 detected.append({
                     'emotion': emotion_data['category'],
@@ -200,47 +359,80 @@ class AdvancedEmotionAnalyzer:
                     'base_valence': emotion_data['valence'],
                     'base_arousal': emotion_data['arousal'],
                     'intensity_modifier': intensity_modifier,
-                    'position': text.find(word)
+                    'position': position
                 })
         
         return detected
     
-    def _find_intensity_modifier(self, text: str, emotion_word: str) -> float:
+    def _find_modifier_hits(self, text: str) -> Tuple[List[int], List[str]]:
+        """Posiciones de inicio (ordenadas) y palabras de todos los modificadores presentes en el texto."""
+        starts, words = [], []
+        for match in self.modifier_matcher.finditer(text):
+            starts.append(match.start())
+            words.append(match.group(1))
+        return starts, words
+    
+    def _find_intensity_modifier(self, text: str, emotion_word: str, word_position: Optional[int] = None,
+                                 modifier_hits: Optional[Tuple[List[int], List[str]]] = None) -> float:
         """Encontrar modificadores de intensidad cerca de la palabra emocional."""
-        word_position = text.find(emotion_word)
-        
-        # Buscar en un rango de 20 caracteres antes de la palabra
+        if word_position is None:
+            word_position = text.find(emotion_word)
+        if modifier_hits is None:
+            modifier_hits = self._find_modifier_hits(text)
+        starts, words = modifier_hits
+        
+        # Buscar en un rango de 20 caracteres antes de la palabra: modificadores que empiecen
+        # y terminen dentro de ese rango
         search_start = max(0, word_position - 20)
-        search_text = text[search_start:word_position]
-        
-        modifier = 1.0
-        for mod_word, mod_value in self.intensity_modifiers.items():
-            if mod_word in search_text:
-                modifier = mod_value
-                break
+        candidates = [
+            words[i] for i in range(bisect_left(starts, search_start), bisect_left(starts, word_position))
+            if starts[i] + len(words[i]) <= word_position
+        ]
         
-        return modifier
+        if not candidates:
+            return 1.0
+        return self.intensity_modifiers[min(candidates, key=self.modifier_rank.__getitem__)]
     
     def _detect_contradictions(self, text: str) -> List[Dict[str, Any]]:
         """Detectar contradicciones emocionales en el texto."""
         contradictions = []
         
-        for pattern_data in self.contradiction_patterns:
-            matches = re.finditer(pattern_data['pattern'], text, re.IGNORECASE)
-            
-            for match in matches:
-                contradiction = {
-                    'type': pattern_data['type'],
-                    'text_match': match.group(),
-                    'emotions': pattern_data['emotions'],
-                    'position': match.start()
-                }
-                contradictions.append(contradiction)
+        # Cada patrón se recorre por separado: las contradicciones de distintos tipos pueden solaparse
+        for prefilter, group in self.contradiction_groups:
+            if prefilter.search(text) is None:
+                continue
+            for regex, contradiction_type, emotions in group:
+                for match in regex.finditer(text):
+                    contradiction = {
+                        'type': contradiction_type,
+                        'text_match': match.group(),
+                        'emotions': emotions,
+                        'position': match.start()
+                    }
+                    contradictions.append(contradiction)
         
         return contradictions
     
-    def _calculate_intensity(self, text: str, detected_emotions: List[Dict]) -> float:
-        """Calcular intensidad emocional general."""
+    def _contradiction_mask(self, contradictions: List[Dict[str, Any]]) -> int:
+        """Codificar los tipos de contradicción detectados como máscara de bits (ver `contradiction_bits`)."""
+        mask = 0
+        for contradiction in contradictions:
+            mask |= self.contradiction_bits[contradiction['type']]
+        return mask
+    
+    def get_session_contradiction_types(self) -> List[str]:
+        """Tipos de contradicción aparecidos en la sesión, en el orden de los patrones."""
+        session_mask = 0
+        for mask in self._history_contradiction_mask:
+            session_mask |= mask
+        return [c_type for c_type in self.contradiction_types if session_mask & self.contradiction_bits[c_type]]
+    
+    def _calculate_intensity(self, text: str, detected_emotions: List[Dict], shouting: bool = False) -> float:
+        """Calcular intensidad emocional general.
+        
+        `text` es el texto normalizado (en minúsculas); `shouting` indica si el original
+        contenía texto en mayúsculas.
+        """
         if not detected_emotions:
             return 0.0
         
@@ -254,7 +446,7 @@ class AdvancedEmotionAnalyzer:
         final_intensity = base_intensity * modifier_avg
         
         # Detectar signos de alta intensidad (mayúsculas, signos de exclamación)
-        if re.search(r'[A-Z]{3,}', text):  # Texto en mayúsculas
+        if shouting:  # Texto en mayúsculas
             final_intensity *= 1.2
         
         exclamation_count = text.count('!')
@@ -268,61 +460,48 @@ class AdvancedEmotionAnalyzer:
         if not detected_emotions:
             return 0.0, 50.0
         
-        valences = []
-        arousals = []
-        
-        for emotion in detected_emotions:
-            # Ajustar valencia y arousal por modificadores de intensidad
-            adjusted_valence = emotion['base_valence'] * emotion['intensity_modifier']
-            adjusted_arousal = emotion['base_arousal'] * emotion['intensity_modifier']
-            
-            valences.append(adjusted_valence)
-            arousals.append(adjusted_arousal)
-        
-        avg_valence = statistics.mean(valences)
-        avg_arousal = statistics.mean(arousals)
+        # Ajustar valencia y arousal por modificadores de intensidad; fsum mantiene la precisión
+        # de statistics.mean sin su aritmética exacta con fracciones
+        count = len(detected_emotions)
+        avg_valence = math.fsum(e['base_valence'] * e['intensity_modifier'] for e in detected_emotions) / count
+        avg_arousal = math.fsum(e['base_arousal'] * e['intensity_modifier'] for e in detected_emotions) / count
         
         # Normalizar arousal a 0-100
         avg_arousal = max(0, min(100, avg_arousal))
         
         return avg_valence, avg_arousal
     
-    def _determine_primary_emotion(self, detected_emotions: List[Dict]) -> EmotionCategory:
-        """Determinar la emoción primaria."""
+    def _determine_primary_and_secondary(self, detected_emotions: List[Dict]) -> Tuple[EmotionCategory, List[EmotionCategory]]:
+        """Determinar la emoción primaria y hasta 3 emociones secundarias."""
         if not detected_emotions:
-            return EmotionCategory.CONTENTMENT
+            return EmotionCategory.CONTENTMENT, []
         
-        # Priorizar por intensidad modificada
-        primary = max(detected_emotions, key=lambda x: x['intensity_modifier'])
-        return primary['emotion']
-    
-    def _determine_secondary_emotions(self, detected_emotions: List[Dict], 
-                                    primary_emotion: EmotionCategory) -> List[EmotionCategory]:
-        """Determinar emociones secundarias."""
-        secondary = []
+        # Priorizar por intensidad modificada (a igualdad, la primera detectada)
+        primary_data = detected_emotions[0]
+        for emotion_data in detected_emotions:
+            if emotion_data['intensity_modifier'] > primary_data['intensity_modifier']:
+                primary_data = emotion_data
+        primary_emotion = primary_data['emotion']
         
+        # Secundarias: el resto de categorías en orden de detección, limitadas a 3
+        secondary = []
         for emotion_data in detected_emotions:
-            if emotion_data['emotion'] != primary_emotion:
+            if emotion_data['emotion'] is not primary_emotion:
                 secondary.append(emotion_data['emotion'])
+                if len(secondary) == 3:
+                    break
         
-        # Limitar a máximo 3 emociones secundarias
-        return secondary[:3]
+        return primary_emotion, secondary
     
     def _extract_emotional_triggers(self, text: str) -> List[str]:
         """Extraer posibles triggers emocionales del texto."""
-        trigger_patterns = [
-            r'cuando (.*?)[.,]',
-            r'porque (.*?)[.,]',
-            r'después de (.*?)[.,]',
-            r'antes de (.*?)[.,]',
-            r'si (.*?)[.,]',
-            r'me recuerda a (.*?)[.,]',
-            r'me hace pensar en (.*?)[.,]'
-        ]
+        # Todos los patrones terminan en '.' o ',': sin ellos no hace falta recorrer el texto
+        if '.' not in text and ',' not in text:
+            return []
         
         triggers = []
-        for pattern in trigger_patterns:
-            matches = re.finditer(pattern, text, re.IGNORECASE)
+        for pattern in self.trigger_patterns:
+            matches = pattern.finditer(text)
             for match in matches:
                 trigger = match.group(1).strip()
                 if len(trigger) > 3:  # Filtrar triggers muy cortos
@@ -354,20 +533,27 @@ class AdvancedEmotionAnalyzer:
         
         fluctuations = []
         
-        for i in range(1, len(self.session_emotional_history)):
-            prev_state = self.session_emotional_history[i-1]
-            curr_state = self.session_emotional_history[i]
-            
+        # Copias en lista: el acceso por índice a un deque no es O(1)
+        valences = list(self._history_valence)
+        intensities = list(self._history_intensity)
+        emotions = list(self._history_emotion)
+        states = None
+        for i in range(1, len(valences)):
             # Calcular cambio en valencia
-            valence_change = curr_state.valence - prev_state.valence
+            valence_change = valences[i] - valences[i-1]
             
             # Calcular cambio en intensidad
-            intensity_change = curr_state.intensity - prev_state.intensity
+            intensity_change = intensities[i] - intensities[i-1]
             
             # Detectar cambio de emoción primaria
-            emotion_change = prev_state.primary_emotion != curr_state.primary_emotion
+            emotion_change = emotions[i-1] is not emotions[i]
             
             if abs(valence_change) > 20 or abs(intensity_change) > 15 or emotion_change:
+                # Sólo los cambios significativos necesitan los estados completos
+                if states is None:
+                    states = list(self.session_emotional_history)
+                prev_state = states[i-1]
+                curr_state = states[i]
                 fluctuation = {
                     'timestamp': curr_state.timestamp.isoformat(),
                     'type': 'significant_change',
@@ -394,11 +580,8 @@ class AdvancedEmotionAnalyzer:
         if len(self.session_emotional_history) < 3:
             return 'insufficient_data'
         
-        valence_values = [state.valence for state in self.session_emotional_history]
-        intensity_values = [state.intensity for state in self.session_emotional_history]
-        
-        valence_std = statistics.stdev(valence_values)
-        intensity_std = statistics.stdev(intensity_values)
+        valence_std = self._valence_stats.stdev()
+        intensity_std = self._intensity_stats.stdev()
         
         # Clasificar estabilidad
         if valence_std < 15 and intensity_std < 15:
@@ -420,18 +603,22 @@ class AdvancedEmotionAnalyzer:
         
         mixed_emotions_rate = mixed_emotions_count / total_states
         
-        # Identificar combinaciones comunes de emociones
-        emotion_combinations = defaultdict(int)
+        # Identificar combinaciones comunes de emociones (se cuentan pares y sólo se formatean los 5 primeros).
+        # Las claves usan los valores de las categorías: el hash de un str está cacheado, el de un Enum
+        # se calcula en Python en cada acceso
+        emotion_combinations = Counter()
         
         for state in self.session_emotional_history:
             if state.mixed_emotions and state.secondary_emotions:
                 primary = state.primary_emotion.value
                 for secondary in state.secondary_emotions:
-                    combination = f"{primary}_{secondary.value}"
-                    emotion_combinations[combination] += 1
+                    emotion_combinations[(primary, secondary.value)] += 1
         
-        # Ordenar por frecuencia
-        common_patterns = sorted(emotion_combinations.items(), key=lambda x: x[1], reverse=True)[:5]
+        # Ordenar por frecuencia (a igual frecuencia, por orden de aparición)
+        common_patterns = [
+            (f"{primary}_{secondary}", count)
+            for (primary, secondary), count in emotion_combinations.most_common(5)
+        ]
         
         return {
             'mixed_emotions_rate': mixed_emotions_rate,
@@ -441,7 +628,13 @@ class AdvancedEmotionAnalyzer:
     
     def reset_session_history(self):
         """Reiniciar historial de sesión para nueva consulta."""
-        self.session_emotional_history = []
+        self.session_emotional_history.clear()
+        self._history_valence.clear()
+        self._history_intensity.clear()
+        self._valence_stats.reset()
+        self._intensity_stats.reset()
+        self._history_emotion.clear()
+        self._history_contradiction_mask.clear()
         logger.info("Historial emocional de sesión reiniciado")
 
 
@@ -452,18 +645,26 @@ class EmotionAnalysisService:
         """Inicializar servicio de análisis emocional."""
         self.analyzer = AdvancedEmotionAnalyzer()
         self.session_data = {}
+        # Estados de cada sesión ya serializados (paralelo a session_data): los estados no cambian una vez creados
+        self.session_data_dicts = {}
+        # El analizador guarda caché e historial: las llamadas desde hilos (ver la versión async) se serializan
+        self._analysis_lock = threading.Lock()
         
     def analyze_message_emotions(self, message: str, session_id: str) -> Dict[str, Any]:
         """Analizar emociones de un mensaje específico."""
         try:
-            # Analizar estado emocional
-            emotional_state = self.analyzer.analyze_emotional_content(message)
-            
-            # Almacenar en datos de sesión
-            if session_id not in self.session_data:
-                self.session_data[session_id] = []
-            
-            self.session_data[session_id].append(emotional_state)
+            with self._analysis_lock:
+                # Analizar estado emocional
+                emotional_state = self.analyzer.analyze_emotional_content(message)
+                
+                # Almacenar en datos de sesión
+                if session_id not in self.session_data:
+                    self.session_data[session_id] = deque(maxlen=SESSION_HISTORY_CAPACITY)
+                    self.session_data_dicts[session_id] = deque(maxlen=SESSION_HISTORY_CAPACITY)
+                
+                emotional_state_dict = emotional_state.to_dict()
+                self.session_data[session_id].append(emotional_state)
+                self.session_data_dicts[session_id].append(emotional_state_dict)
             
             # Crear punto de datos longitudinal
             longitudinal_point = LongitudinalDataPoint(
@@ -475,11 +676,11 @@ class EmotionAnalysisService:
             )
             
             return {
-                'emotional_state': emotional_state.to_dict(),
+                'emotional_state': emotional_state_dict,
                 'longitudinal_data': longitudinal_point.to_dict(),
                 'analysis_metadata': {
                     'mixed_emotions_detected': emotional_state.mixed_emotions,
-                    'contradictions_found': len(emotional_state.contradictory_emotions) > 0,
+                    'contradictions_found': emotional_state.contradiction_mask != 0,
                     'confidence_level': emotional_state.confidence,
                     'triggers_identified': len(emotional_state.triggers)
                 }
@@ -489,24 +690,36 @@ class EmotionAnalysisService:
             logger.error(f"Error analyzing message emotions: {str(e)}")
             return {'error': str(e)}
     
+    async def aanalyze_message_emotions(self, message: str, session_id: str) -> Dict[str, Any]:
+        """Versión asíncrona de `analyze_message_emotions`.
+        
+        El análisis se ejecuta en un hilo, así que puede esperarse junto a otras llamadas lentas
+        (por ejemplo `MedicalImageAnalyzer.analyze_images_batch`) con `asyncio.gather`.
+        """
+        return await asyncio.to_thread(self.analyze_message_emotions, message, session_id)
+    
     def get_session_emotional_analysis(self, session_id: str) -> Dict[str, Any]:
         """Obtener análisis emocional completo de la sesión."""
         try:
-            # Analizar fluctuaciones
-            fluctuations = self.analyzer.analyze_session_emotional_fluctuations()
-            
-            # Detectar patrones de emociones mixtas
-            mixed_patterns = self.analyzer.detect_mixed_emotions_patterns()
-            
-            # Análisis longitudinal de la sesión
-            session_states = self.session_data.get(session_id, [])
+            with self._analysis_lock:
+                # Analizar fluctuaciones
+                fluctuations = self.analyzer.analyze_session_emotional_fluctuations()
+                
+                # Detectar patrones de emociones mixtas
+                mixed_patterns = self.analyzer.detect_mixed_emotions_patterns()
+                
+                contradiction_types = self.analyzer.get_session_contradiction_types()
+                
+                # Análisis longitudinal de la sesión
+                session_journey = list(self.session_data_dicts.get(session_id, []))
             
             return {
                 'session_id': session_id,
-                'total_emotional_states': len(session_states),
+                'total_emotional_states': len(session_journey),
                 'fluctuation_analysis': fluctuations,
                 'mixed_emotions_analysis': mixed_patterns,
-                'session_emotional_journey': [state.to_dict() for state in session_states],
+                'contradiction_types_detected': contradiction_types,
+                'session_emotional_journey': session_journey,
                 'generated_at': datetime.now().isoformat()
             }
             
@@ -516,7 +729,9 @@ class EmotionAnalysisService:
     
     def reset_session(self, session_id: str):
         """Reiniciar datos de sesión."""
-        if session_id in self.session_data:
-            del self.session_data[session_id]
-        self.analyzer.reset_session_history()
+        with self._analysis_lock:
+            if session_id in self.session_data:
+                del self.session_data[session_id]
+                del self.session_data_dicts[session_id]
+            self.analyzer.reset_session_history()
         logger.info(f"Session {session_id} emotional data reset") 
\ No newline at end of file
@@ -1,65 +1,331 @@
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient
+import httpx
 import json
 import asyncio
-from typing import Dict, List, Any, Optional
+from typing import AsyncIterator, Dict, List, Any, Optional, Tuple
 import logging
 import os
 import time
 import hashlib
+import copy
+import orjson
+import re
+import sqlite3
+import statistics
+import threading
+import unicodedata
+from collections import OrderedDict, deque
+from pathlib import Path
 from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 
-from src.config.config import GROQ_API_KEY, OPENAI_API_KEY, LLM_MODEL, DEFAULT_TEMPERATURE, MAX_TOKENS, LLM_PROVIDER
+from src.config.config import (
+    GROQ_API_KEY, OPENAI_API_KEY, LLM_MODEL, DEFAULT_TEMPERATURE, MAX_TOKENS, LLM_PROVIDER,
+    LLM_CACHE_DB, LLM_CACHE_TTL
+)
 
 logger = logging.getLogger(__name__)
 
+# Cualquier carácter que no sea letra, dígito o espacio se ignora al comparar mensajes
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+# Clave de LLMResponseCache: (system_prompt, user_prompt, temperature)
+CacheKey = Tuple[str, str, float]
+
+# Caracteres que delatan un texto en español (en ambas cajas, sin pasar el texto a minúsculas)
+_SPANISH_MARKERS = frozenset("áéíóúñ¿¡ÁÉÍÓÚÑ")
+
+OFFLINE_RESPONSE_ES = """Lo siento, actualmente estoy experimentando problemas de conectividad con los servicios de IA. 
+
+Por favor:
+- Verifica tu conexión a internet
+- Intenta nuevamente en unos minutos
+- Si el problema persiste, contacta al administrador del sistema
+
+IMPORTANTE: Si tienes una emergencia médica, llama al 911 o acude al hospital más cercano inmediatamente.
+
+Para consultas no urgentes, puedes intentar reformular tu pregunta cuando el servicio esté disponible."""
+
+OFFLINE_RESPONSE_EN = """I'm sorry, I'm currently experiencing connectivity issues with AI services.
+
+Please:
+- Check your internet connection  
+- Try again in a few minutes
+- If the problem persists, contact the system administrator
+
+IMPORTANT: If you have a medical emergency, call 911 or go to the nearest hospital immediately.
+
+For non-urgent questions, you can try rephrasing your question when the service is available."""
+
+# Un cliente por proveedor compartido por todas las instancias de LLMService, sobre un
+# único pool de conexiones keep-alive amplio para las llamadas concurrentes desde el executor
+HTTP_POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+_shared_http_client: Optional[httpx.Client] = None
+_shared_clients: Dict[str, OpenAI] = {}
+_shared_clients_lock = threading.Lock()
+
+def _get_shared_http_client() -> httpx.Client:
+    """Devolver el pool HTTP compartido, creándolo la primera vez (se asume el lock tomado)."""
+    global _shared_http_client
+    if _shared_http_client is None:
+        _shared_http_client = DefaultHttpxClient(limits=HTTP_POOL_LIMITS)
+    return _shared_http_client
+
+# Métricas de tiempo de respuesta: peso de la última muestra en la EWMA y muestras
+# recientes que se conservan para los percentiles
+RESPONSE_TIME_EWMA_ALPHA = 0.1
+RESPONSE_TIME_WINDOW = 512
+
+# Segundos que el circuit breaker de LLMService permanece abierto tras un error de red
+CONNECTIVITY_BREAKER_COOLDOWN = 30.0
+
 class LLMResponseCache:
-    """Sistema de cache simple para respuestas LLM."""
+    """
+    Sistema de cache para respuestas LLM.
+    
+    Un LRU en memoria delante de una base SQLite opcional (`db_path`): las respuestas
+    sobreviven a los reinicios y se comparten entre procesos del mismo servidor.
     
-    def __init__(self, max_size: int = 100):
-        self.cache: Dict[str, Dict[str, Any]] = {}
+    Seguro entre hilos: las rutas Flask usan un event loop por hilo sobre el mismo servicio.
+    """
+    
+    def __init__(self, max_size: int = 100, db_path: Optional[Path] = None, ttl: float = LLM_CACHE_TTL,
+                 namespace: str = ""):
+        # Respuestas ordenadas por último uso: la primera entrada es la que se expulsa
+        self.cache: "OrderedDict[CacheKey, str]" = OrderedDict()
         self.max_size = max_size
-        self.access_times: Dict[str, float] = {}
+        self.ttl = ttl
+        # Se incluye en las claves de la base (p. ej. proveedor y modelo), para que un cambio de
+        # modelo no sirva respuestas persistidas del anterior tras reiniciar
+        self.namespace = namespace
+        self._lock = threading.Lock()  # protege `cache`
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._open_db(db_path)
     
-    def _get_key(self, system_prompt: str, user_prompt: str, temperature: float) -> str:
-        """Generar clave de cache basada en los prompts."""
-        content = f"{system_prompt}|{user_prompt}|{temperature}"
-        return hashlib.md5(content.encode()).hexdigest()
+    def _open_db(self, db_path: Path):
+        """Abrir (o crear) la base de respuestas persistidas; si falla se sigue sólo en memoria."""
+        try:
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(db_path), timeout=5.0, check_same_thread=False, isolation_level=None)
+            # WAL: lectores y escritores de varios procesos no se bloquean; NORMAL evita un fsync por escritura
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key BLOB PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            self._db = db
+            logger.info(f"Persistent LLM cache at {db_path}")
+        except sqlite3.Error as e:
+            logger.error(f"Error opening persistent LLM cache at {db_path}: {e}")
+    
+    def _db_key(self, key: CacheKey) -> bytes:
+        """Clave compacta para la base (los prompts completos sólo viven en memoria)."""
+        system_prompt, user_prompt, temperature = key
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(self.namespace.encode())
+        hasher.update(b"\x00")
+        hasher.update(system_prompt.encode())
+        hasher.update(b"\x00")
+        hasher.update(user_prompt.encode())
+        hasher.update(b"\x00")
+        hasher.update(repr(temperature).encode())
+        return hasher.digest()
+    
+    def _remember(self, key: CacheKey, response: str):
+        """Guardar una respuesta en el LRU en memoria."""
+        with self._lock:
+            self.cache[key] = response
+            self.cache.move_to_end(key)
+            
+            # Limpiar cache si está lleno: expulsar la entrada usada hace más tiempo
+            oldest_key = None
+            if len(self.cache) > self.max_size:
+                oldest_key, _ = self.cache.popitem(last=False)
+        if oldest_key is not None:
+            logger.debug(f"Evicted oldest cache entry: {self._key_label(oldest_key)}...")
+    
+    def _get_key(self, system_prompt: str, user_prompt: str, temperature: float) -> CacheKey:
+        """Generar clave de cache basada en los prompts.
+        
+        La propia tupla es la clave: el dict compara los prompts directamente y el hash de cada
+        str se calcula una vez y queda guardado en el objeto (el system prompt suele ser el mismo),
+        en lugar de concatenar los prompts y pasarlos por MD5 en cada consulta.
+        """
+        return (system_prompt, user_prompt, temperature)
+    
+    @staticmethod
+    def _key_label(key: CacheKey) -> str:
+        """Identificador corto de una clave para los logs (sin volcar los prompts)."""
+        return f"{hash(key) & 0xffffffff:08x}"
     
     def get(self, system_prompt: str, user_prompt: str, temperature: float) -> Optional[str]:
         """Obtener respuesta del cache si existe."""
         key = self._get_key(system_prompt, user_prompt, temperature)
         
-        if key in self.cache:
-            self.access_times[key] = time.time()
-            logger.debug(f"Cache hit for key: {key[:8]}...")
-            return self.cache[key]["response"]
+        with self._lock:
+            response = self.cache.get(key)
+            if response is not None:
+                self.cache.move_to_end(key)
+        if response is not None:
+            logger.debug(f"Cache hit for key: {self._key_label(key)}...")
+            return response
+        
+        if self._db is None:
+            return None
+        try:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT response FROM responses WHERE key = ? AND created_at >= ?",
+                    (self._db_key(key), time.time() - self.ttl)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading persistent LLM cache: {e}")
+            return None
+        if row is None:
+            return None
         
-        return None
+        logger.debug(f"Persistent cache hit for key: {self._key_label(key)}...")
+        self._remember(key, row[0])
+        return row[0]
     
     def set(self, system_prompt: str, user_prompt: str, temperature: float, response: str):
         """Almacenar respuesta en cache."""
         key = self._get_key(system_prompt, user_prompt, temperature)
         
-        # Limpiar cache si está lleno
-        if len(self.cache) >= self.max_size:
-            self._evict_oldest()
+        self._remember(key, response)
+        logger.debug(f"Cache stored for key: {self._key_label(key)}...")
         
-        self.cache[key] = {
-            "response": response,
-            "timestamp": time.time()
-        }
-        self.access_times[key] = time.time()
-        logger.debug(f"Cache stored for key: {key[:8]}...")
-    
-    def _evict_oldest(self):
-        """Eliminar la entrada más antigua del cache."""
-        if not self.access_times:
+        if self._db is None:
             return
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                    (self._db_key(key), response, time.time())
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Error writing persistent LLM cache: {e}")
+    
+    def clear(self) -> int:
+        """Vaciar el cache (también la parte persistida). Devuelve las entradas eliminadas en memoria."""
+        with self._lock:
+            removed = len(self.cache)
+            self.cache.clear()
+        if self._db is not None:
+            try:
+                with self._db_lock:
+                    self._db.execute("DELETE FROM responses")
+            except sqlite3.Error as e:
+                logger.error(f"Error clearing persistent LLM cache: {e}")
+        return removed
+
+class ClassificationCache:
+    """
+    Cache de clasificaciones de especialidad por mensaje.
+    
+    Solo coincidencia exacta sobre el mensaje normalizado: una similitud entre bolsas de
+    palabras confundiría mensajes que difieren en una negación ("no tengo dolor de pecho").
+    Se persiste en disco de forma diferida.
+    """
+    
+    def __init__(self, path: Optional[Path] = None, max_size: int = 512, ttl: float = 3600.0):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> {"result": clasificación, "timestamp": epoch}, de la menos a la más recientemente usada
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        
+        if self.path:
+            self._load()
+    
+    @staticmethod
+    def _normalize(message: str) -> str:
+        """Normalizar mensaje: minúsculas, sin acentos ni puntuación y con espacios colapsados."""
+        decomposed = unicodedata.normalize("NFKD", message.lower())
+        without_accents = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+        return " ".join(_PUNCTUATION_RE.sub(" ", without_accents).split())
+    
+    @staticmethod
+    def _get_key(normalized: str) -> str:
+        """Generar clave de cache para un mensaje normalizado."""
+        return hashlib.sha1(normalized.encode()).hexdigest()
+    
+    def get(self, message: str) -> Optional[Dict[str, Any]]:
+        """Obtener una clasificación cacheada para el mensaje, si existe."""
+        key = self._get_key(self._normalize(message))
+        now = time.time()
+        
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if now - entry["timestamp"] < self.ttl:
+                    self.hits += 1
+                    self._touch(key)
+                    return copy.deepcopy(entry["result"])
+                self._remove(key)
             
-        oldest_key = min(self.access_times.keys(), key=lambda k: self.access_times[k])
-        del self.cache[oldest_key]
-        del self.access_times[oldest_key]
-        logger.debug(f"Evicted oldest cache entry: {oldest_key[:8]}...")
+            self.misses += 1
+            return None
+    
+    def put(self, message: str, result: Dict[str, Any]):
+        """Almacenar la clasificación de un mensaje."""
+        key = self._get_key(self._normalize(message))
+        
+        with self._lock:
+            self._remove(key)
+            if len(self.entries) >= self.max_size:
+                # Los aciertos reinsertan su entrada al final: la primera clave es la usada hace más tiempo
+                self._remove(next(iter(self.entries)))
+            self.entries[key] = {"result": copy.deepcopy(result), "timestamp": time.time()}
+            self._dirty = True
+    
+    def _touch(self, key: str):
+        """Marcar una entrada como la más recientemente usada (se asume el lock tomado)."""
+        self.entries[key] = self.entries.pop(key)
+    
+    def _remove(self, key: str):
+        """Eliminar una entrada (se asume el lock tomado)."""
+        if self.entries.pop(key, None) is not None:
+            self._dirty = True
+    
+    def _load(self):
+        """Cargar las entradas persistidas que no hayan expirado."""
+        try:
+            if not self.path.exists():
+                return
+            with open(self.path, 'rb') as f:
+                data = orjson.loads(f.read())
+            now = time.time()
+            live = [(key, entry) for key, entry in data.items() if now - entry.get("timestamp", 0) < self.ttl]
+            # El fichero guarda el orden LRU: conservar solo las `max_size` usadas más recientemente
+            for key, entry in live[-self.max_size:]:
+                self.entries[key] = {"result": entry["result"], "timestamp": entry["timestamp"]}
+            logger.info(f"Loaded {len(self.entries)} cached specialty classifications")
+        except Exception as e:
+            logger.error(f"Error loading classification cache from {self.path}: {e}")
+    
+    def flush(self):
+        """Persistir el cache si cambió desde la última escritura."""
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            snapshot = dict(self.entries)
+            self._dirty = False
+        try:
+            temp_path = self.path.with_suffix('.tmp')
+            with open(temp_path, 'wb') as f:
+                f.write(orjson.dumps(snapshot))
+            temp_path.replace(self.path)
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"Error saving classification cache to {self.path}: {e}")
 
 class LLMService:
     """Service to handle interactions with LLM models."""
@@ -74,14 +340,26 @@ class LLMService:
         self.total_requests = 0
         self.total_tokens_used = 0
         self.average_response_time = 0.0
+        self.response_time_ewma = 0.0
         self.error_count = 0
+        self._response_time_sum = 0.0
+        self._response_times = deque(maxlen=RESPONSE_TIME_WINDOW)
+        
+        # Circuit breaker de conectividad: 0.0 = cerrado (no se comprueba nada); si no,
+        # instante (time.monotonic) hasta el que se responde offline sin llamar a la API
+        self._breaker_open_until = 0.0
         
         # Sistema de cache
-        self.cache = LLMResponseCache()
+        self.cache = LLMResponseCache(
+            db_path=Path(LLM_CACHE_DB) if LLM_CACHE_DB else None,
+            namespace=f"{self.provider}:{self.model}"
+        )
         
         # Validar y configurar cliente
         self._validate_api_keys()
         self.client = self._initialize_client()
+        # Pool HTTP del cliente, para que otros clientes (p. ej. MedicalImageAnalyzer) lo reutilicen
+        self.http_client = _shared_http_client
         
         logger.info(f"LLMService initialized with provider: {self.provider}, model: {model}")
         
@@ -95,22 +373,36 @@ class LLMService:
             raise ValueError("GROQ_API_KEY environment variable is required but not set")
         
     def _initialize_client(self):
-        """Initialize the OpenAI client configured to use the appropriate API."""
-        try:
-            if self.provider == "groq":
-                return OpenAI(
-                    api_key=GROQ_API_KEY,
-                    base_url="https://api.groq.com/openai/v1",
-                    timeout=60.0
-                )
-            else:  # Default to OpenAI
-                return OpenAI(
-                    api_key=OPENAI_API_KEY,
-                    timeout=60.0
-                )
-        except Exception as e:
-            logger.error(f"Failed to initialize client: {e}")
-            raise
+        """
+        Return the OpenAI client configured to use the appropriate API.
+        
+        The client is created once per provider and shared by every LLMService instance, on
+        a single HTTP connection pool, so connections stay warm across services.
+        """
+        with _shared_clients_lock:
+            client = _shared_clients.get(self.provider)
+            if client is not None:
+                return client
+            try:
+                http_client = _get_shared_http_client()
+                if self.provider == "groq":
+                    client = OpenAI(
+                        api_key=GROQ_API_KEY,
+                        base_url="https://api.groq.com/openai/v1",
+                        timeout=60.0,
+                        http_client=http_client
+                    )
+                else:  # Default to OpenAI
+                    client = OpenAI(
+                        api_key=OPENAI_API_KEY,
+                        timeout=60.0,
+                        http_client=http_client
+                    )
+            except Exception as e:
+                logger.error(f"Failed to initialize client: {e}")
+                raise
+            _shared_clients[self.provider] = client
+            return client
     
     @retry(
         wait=wait_exponential(multiplier=2, min=4, max=20),
@@ -123,74 +415,196 @@ class LLMService:
                           temperature: Optional[float] = None,
                           use_cache: bool = True) -> str:
         """Generate a response from the LLM based on system and user prompts with retry logic."""
+        parts = [part async for part in self.generate_response_stream(system_prompt, user_prompt, temperature, use_cache)]
+        return "".join(parts)
+    
+    async def generate_response_stream(self,
+                                       system_prompt: str,
+                                       user_prompt: str,
+                                       temperature: Optional[float] = None,
+                                       use_cache: bool = True) -> AsyncIterator[str]:
+        """
+        Generate a response as a stream of text fragments, as the model produces them.
+        
+        Cached and offline responses are yielded as a single fragment; the full text is only
+        cached once the stream has completed. `generate_response` joins this stream.
+        """
         start_time = time.time()
         temp = temperature if temperature is not None else self.temperature
         
+        # Verificar cache primero
+        if use_cache:
+            cached_response = self.cache.get(system_prompt, user_prompt, temp)
+            if cached_response:
+                logger.debug("Returning cached response")
+                yield cached_response
+                return
+        
+        # Sin llamar a la API mientras el circuit breaker esté abierto
+        if not await self._connectivity_available():
+            yield self._get_offline_response(user_prompt)
+            return
+        
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        # OpenAI sólo informa del uso de tokens en streaming si se pide, en el último fragmento
+        extra_options = {"stream_options": {"include_usage": True}} if self.provider == "openai" else {}
+        loop = asyncio.get_running_loop()
+        parts: List[str] = []
+        usage_chunk = None
+        stream = None
+        
         try:
-            # Verificar cache primero
-            if use_cache:
-                cached_response = self.cache.get(system_prompt, user_prompt, temp)
-                if cached_response:
-                    logger.debug("Returning cached response")
-                    return cached_response
-            
-            # Verificar conectividad antes de hacer llamada costosa
-            if not await self._check_connectivity():
-                return self._get_offline_response(user_prompt)
-            
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-
-            async def call_api():
-                loop = asyncio.get_event_loop()
-                response = await loop.run_in_executor(
-                    None,
-                    lambda: self.client.chat.completions.create(
-                        model=self.model,
-                        messages=messages,
-                        temperature=temp,
-                        max_tokens=MAX_TOKENS
-                    )
+            stream = await loop.run_in_executor(
+                None,
+                lambda: self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=temp,
+                    max_tokens=MAX_TOKENS,
+                    stream=True,
+                    **extra_options
                 )
-                return response
-            
-            # Ejecutar llamada a API
-            response = await call_api()
-            result = response.choices[0].message.content
-            
-            # Actualizar métricas
-            response_time = time.time() - start_time
-            self._update_metrics(response, response_time)
-            
-            # Guardar en cache
-            if use_cache:
-                self.cache.set(system_prompt, user_prompt, temp, result)
-            
-            logger.debug(f"LLM response generated in {response_time:.2f}s")
-            return result
-
+            )
+            chunks = iter(stream)
+            while True:
+                # El cliente es síncrono: cada fragmento se espera en un hilo para no bloquear el loop
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                if getattr(chunk, 'usage', None):
+                    usage_chunk = chunk
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    parts.append(content)
+                    yield content
+        
         except Exception as e:
             self.error_count += 1
             logger.error(f"Error generating LLM response: {e}")
             
             # Intentar respuesta offline antes de fallar completamente
-            if "Connection" in str(e) or "network" in str(e).lower():
-                logger.warning("Network error detected, attempting offline response")
-                return self._get_offline_response(user_prompt)
+            if self._is_network_error(e):
+                self._open_breaker()
+                # La respuesta offline sólo tiene sentido si aún no se entregó nada
+                if not parts:
+                    logger.warning("Network error detected, attempting offline response")
+                    yield self._get_offline_response(user_prompt)
+                    return
             
             raise RuntimeError(f"Failed to generate response from LLM: {str(e)}")
+        
+        finally:
+            # Devolver la conexión al pool también si el consumidor deja de leer o se cancela
+            if stream is not None:
+                stream.close()
+        
+        # Actualizar métricas
+        response_time = time.time() - start_time
+        self._update_metrics(usage_chunk, response_time)
+        
+        # Guardar en cache
+        if use_cache:
+            self.cache.set(system_prompt, user_prompt, temp, "".join(parts))
+        
+        logger.debug(f"LLM response generated in {response_time:.2f}s")
+    
+    async def submit_batch(self, requests: List[Dict[str, Any]]) -> str:
+        """
+        Submit non-urgent completions through the provider's Batch API (24h window, lower cost).
+        
+        Each request is a dict with `custom_id`, `system_prompt`, `user_prompt` and optionally
+        `temperature`. Returns the batch id; use `poll_batch` / `get_batch_results` to collect.
+        """
+        lines = []
+        for request in requests:
+            body = {
+                "model": self.model,
+                "messages": [
+                    {"role": "system", "content": request["system_prompt"]},
+                    {"role": "user", "content": request["user_prompt"]}
+                ],
+                "temperature": request.get("temperature", self.temperature),
+                "max_tokens": MAX_TOKENS
+            }
+            lines.append(orjson.dumps({
+                "custom_id": str(request["custom_id"]),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }))
+        payload = b"\n".join(lines) + b"\n"
+        
+        def submit():
+            input_file = self.client.files.create(file=("batch_requests.jsonl", payload), purpose="batch")
+            return self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+        
+        batch = await asyncio.to_thread(submit)
+        logger.info(f"Submitted LLM batch {batch.id} with {len(requests)} requests")
+        return batch.id
+    
+    async def poll_batch(self, batch_id: str) -> Dict[str, Any]:
+        """Return the status of a submitted batch (`status` is 'completed' once results are ready)."""
+        batch = await asyncio.to_thread(self.client.batches.retrieve, batch_id)
+        counts = getattr(batch, "request_counts", None)
+        return {
+            "batch_id": batch.id,
+            "status": batch.status,
+            "completed": getattr(counts, "completed", None),
+            "failed": getattr(counts, "failed", None),
+            "total": getattr(counts, "total", None),
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id
+        }
+    
+    async def get_batch_results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        """
+        Download the results of a completed batch.
+        
+        Returns `custom_id -> response text`; requests that failed map to None.
+        """
+        status = await self.poll_batch(batch_id)
+        if status["status"] != "completed":
+            raise RuntimeError(f"Batch {batch_id} is not completed (status: {status['status']})")
+        
+        results: Dict[str, Optional[str]] = {}
+        for file_id in (status["output_file_id"], status["error_file_id"]):
+            if not file_id:
+                continue
+            content = await asyncio.to_thread(self.client.files.content, file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+                else:
+                    results.setdefault(record["custom_id"], None)
+        
+        logger.info(f"Collected {len(results)} results from LLM batch {batch_id}")
+        return results
     
     def _update_metrics(self, response, response_time: float):
         """Actualizar métricas de performance."""
         self.total_requests += 1
         
-        # Actualizar tiempo promedio de respuesta
-        if self.average_response_time == 0:
-            self.average_response_time = response_time
+        # Media real (suma / número de peticiones) y EWMA para la tendencia reciente
+        self._response_time_sum += response_time
+        self.average_response_time = self._response_time_sum / self.total_requests
+        if self.total_requests == 1:
+            self.response_time_ewma = response_time
         else:
-            self.average_response_time = (self.average_response_time + response_time) / 2
+            self.response_time_ewma += RESPONSE_TIME_EWMA_ALPHA * (response_time - self.response_time_ewma)
+        self._response_times.append(response_time)
         
         # Contar tokens si está disponible
         if hasattr(response, 'usage') and response.usage:
@@ -222,8 +636,8 @@ class LLMService:
             # Limpiar respuesta para asegurar JSON válido
             response = self._clean_json_response(response)
             
-            # Parse JSON response
-            classification = json.loads(response)
+            # Parse JSON response (orjson.JSONDecodeError es subclase de json.JSONDecodeError)
+            classification = orjson.loads(response)
             
             # Validar campos requeridos
             classification = self._validate_classification_response(classification)
@@ -238,6 +652,25 @@ class LLMService:
             logger.error(f"Error in specialty classification: {e}")
             raise RuntimeError(f"Failed to classify medical specialty: {str(e)}")
     
+    async def classify_specialty_batch(self, queries: List[str], max_concurrency: int = 10) -> List[Dict[str, Any]]:
+        """
+        Classify several queries concurrently, one request per distinct query.
+        
+        Each query keeps its own prompt and cache entry (so results match `classify_specialty`);
+        at most `max_concurrency` requests are in flight. Raises like `classify_specialty` if any fails.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def classify(query: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.classify_specialty(query)
+        
+        # Las consultas repetidas se clasifican una sola vez
+        distinct_queries = list(dict.fromkeys(queries))
+        classifications = await asyncio.gather(*(classify(query) for query in distinct_queries))
+        by_query = dict(zip(distinct_queries, classifications))
+        return [copy.deepcopy(by_query[query]) for query in queries]
+    
     def _clean_json_response(self, response: str) -> str:
         """Limpiar respuesta para asegurar JSON válido."""
         response = response.strip()
@@ -276,10 +709,20 @@ class LLMService:
     
     def get_performance_metrics(self) -> Dict[str, Any]:
         """Obtener métricas de performance del servicio LLM."""
+        # Percentiles sobre las últimas RESPONSE_TIME_WINDOW respuestas
+        if len(self._response_times) >= 2:
+            cuts = statistics.quantiles(self._response_times, n=20, method="inclusive")
+            p50, p95 = cuts[9], cuts[18]
+        else:
+            p50 = p95 = self._response_times[0] if self._response_times else 0.0
+        
         return {
             "total_requests": self.total_requests,
             "total_tokens_used": self.total_tokens_used,
             "average_response_time": round(self.average_response_time, 3),
+            "response_time_ewma": round(self.response_time_ewma, 3),
+            "response_time_p50": round(p50, 3),
+            "response_time_p95": round(p95, 3),
             "error_count": self.error_count,
             "error_rate": round(self.error_count / max(1, self.total_requests) * 100, 2),
             "cache_stats": {
@@ -292,9 +735,7 @@ class LLMService:
     
     def clear_cache(self):
         """Limpiar el cache de respuestas."""
-        cache_size = len(self.cache.cache)
-        self.cache.cache.clear()
-        self.cache.access_times.clear()
+        cache_size = self.cache.clear()
         logger.info(f"Cleared LLM cache, removed {cache_size} entries")
     
     def reset_metrics(self):
@@ -302,7 +743,10 @@ class LLMService:
         self.total_requests = 0
         self.total_tokens_used = 0
         self.average_response_time = 0.0
+        self.response_time_ewma = 0.0
         self.error_count = 0
+        self._response_time_sum = 0.0
+        self._response_times.clear()
         logger.info("LLM performance metrics reset")
     
     async def health_check(self) -> Dict[str, Any]:
@@ -335,18 +779,47 @@ class LLMService:
                 "metrics": self.get_performance_metrics()
             }
     
+    @staticmethod
+    def _is_network_error(error: Exception) -> bool:
+        """Indica si un error de la API se debe a problemas de red."""
+        message = str(error)
+        return "Connection" in message or "network" in message.lower()
+    
+    def _open_breaker(self):
+        """Abrir el circuit breaker: responder offline durante CONNECTIVITY_BREAKER_COOLDOWN segundos."""
+        self._breaker_open_until = time.monotonic() + CONNECTIVITY_BREAKER_COOLDOWN
+        logger.warning(f"LLM connectivity breaker opened for {CONNECTIVITY_BREAKER_COOLDOWN:.0f}s")
+    
+    async def _connectivity_available(self) -> bool:
+        """
+        Circuit breaker delante de `_check_connectivity`.
+        
+        Mientras no haya errores de red no se hace ninguna comprobación. Tras un error se
+        responde offline hasta que pasa el cooldown; entonces una sola petición comprueba
+        la conectividad (las demás siguen offline) y cierra el breaker o lo reabre.
+        """
+        if not self._breaker_open_until:
+            return True
+        if time.monotonic() < self._breaker_open_until:
+            return False
+        
+        # Reservar la comprobación para esta petición
+        self._breaker_open_until = time.monotonic() + CONNECTIVITY_BREAKER_COOLDOWN
+        if await self._check_connectivity():
+            self._breaker_open_until = 0.0
+            logger.info("LLM connectivity restored, breaker closed")
+            return True
+        self._open_breaker()
+        return False
+    
     async def _check_connectivity(self) -> bool:
         """Verificar conectividad básica con la API."""
         try:
             # Test simple de conectividad
             loop = asyncio.get_event_loop()
             
-            # Timeout muy corto para test rápido
-            test_client = OpenAI(
-                api_key=self.client.api_key,
-                base_url=self.client.base_url if hasattr(self.client, 'base_url') else None,
-                timeout=5.0  # Timeout muy corto
-            )
+            # Mismo cliente (y conexiones) con un timeout muy corto para test rápido
+            test_client = self.client.with_options(timeout=5.0)
             
             await loop.run_in_executor(
                 None,
@@ -362,30 +835,7 @@ class LLMService:
         """Generar respuesta offline cuando no hay conectividad."""
         
         # Detectar idioma
-        is_spanish = any(char in user_prompt.lower() for char in ["á", "é", "í", "ó", "ú", "ñ", "¿", "¡"])
-        
-        if is_spanish:
-            offline_response = """Lo siento, actualmente estoy experimentando problemas de conectividad con los servicios de IA. 
-
-Por favor:
-- Verifica tu conexión a internet
-- Intenta nuevamente en unos minutos
-- Si el problema persiste, contacta al administrador del sistema
-
-IMPORTANTE: Si tienes una emergencia médica, llama al 911 o acude al hospital más cercano inmediatamente.
-
-Para consultas no urgentes, puedes intentar reformular tu pregunta cuando el servicio esté disponible."""
-        else:
-            offline_response = """I'm sorry, I'm currently experiencing connectivity issues with AI services.
-
-Please:
-- Check your internet connection  
-- Try again in a few minutes
-- If the problem persists, contact the system administrator
-
-IMPORTANT: If you have a medical emergency, call 911 or go to the nearest hospital immediately.
-
-For non-urgent questions, you can try rephrasing your question when the service is available."""
+        is_spanish = not _SPANISH_MARKERS.isdisjoint(user_prompt)
         
         logger.info("Returned offline response due to connectivity issues")
-        return offline_response 
\ No newline at end of file
+        return OFFLINE_RESPONSE_ES if is_spanish else OFFLINE_RESPONSE_EN
@@ -3,14 +3,24 @@ Servicio de seguimiento longitudinal y predicción de crisis.
 Analiza evolución emocional, patrones temporales y predice episodios de crisis.
 """
 
+import copy
 import logging
 import statistics
+import threading
+import time
+from bisect import bisect_left
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import islice
+from operator import attrgetter
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any, Tuple
-from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Any, Tuple
+from collections import OrderedDict, defaultdict, deque
 import numpy as np
-from dataclasses import asdict
 
+from src.utils.running_stats import RunningStats
 from src.models.psychology_models import (
     LongitudinalDataPoint, TemporalPattern, CrisisRiskAssessment,
     EmotionalState, EmotionCategory, ComprehensivePsychProfile
@@ -20,79 +30,349 @@ from src.models.psychology_models import (
 logger = logging.getLogger(__name__)
 
 
+# Desviación (relativa a la media) por debajo de la cual una serie se considera plana:
+# con aritmética de coma flotante una serie constante puede dar una desviación de ~1e-15
+FLAT_RELATIVE_TOLERANCE = 1e-9
+
+# Puntos de datos longitudinales que se conservan por usuario
+MAX_POINTS_PER_USER = 1000
+
+# Datos de evolución calculados que se reutilizan mientras el usuario no registre puntos nuevos:
+# segundos de validez (el período se mide desde "ahora") y número de usuarios guardados
+ANALYSIS_CACHE_TTL = 300.0
+ANALYSIS_CACHE_SIZE = 256
+
+# Usuarios a partir de los cuales batch_analyze reparte el cálculo entre procesos: por debajo,
+# serializar los puntos (como mucho MAX_POINTS_PER_USER por usuario) cuesta más que el cálculo
+BATCH_PROCESS_MIN_USERS = 64
+
+# Etiquetas de horas, días de la semana (0=Monday) y meses (1=Enero) usadas en los patrones
+HOUR_LABELS = tuple(f"{hour}:00" for hour in range(24))
+WEEKDAY_NAMES = ('Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo')
+MONTH_NAMES = (
+    'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
+    'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'
+)
+
+# Un bit por categoría emocional, para acumular en un entero las emociones vistas
+EMOTION_BITS = {emotion: 1 << i for i, emotion in enumerate(EmotionCategory)}
+
+
+# Identificador entero de cada tipo de métrica, asignado al registrar el primer punto de ese tipo
+# y compartido por todos los análisis (`METRIC_NAMES[METRIC_IDS[nombre]] == nombre`)
+METRIC_IDS: Dict[str, int] = {}
+METRIC_NAMES: List[str] = []
+_metric_ids_lock = threading.Lock()
+
+
+def _metric_id(metric_type: str) -> int:
+    """Identificador entero del tipo de métrica (se asigna la primera vez que aparece)."""
+    metric_id = METRIC_IDS.get(metric_type)
+    if metric_id is None:
+        with _metric_ids_lock:
+            metric_id = METRIC_IDS.get(metric_type)
+            if metric_id is None:
+                metric_id = len(METRIC_NAMES)
+                METRIC_NAMES.append(metric_type)
+                METRIC_IDS[metric_type] = metric_id
+    return metric_id
+
+
+# Pool de procesos compartido por todos los análisis por lotes (se crea al primer uso)
+_analysis_pool: Optional[ProcessPoolExecutor] = None
+_analysis_pool_lock = threading.Lock()
+
+
+def _get_analysis_pool() -> ProcessPoolExecutor:
+    """Pool de procesos para batch_analyze.
+    
+    Usa 'spawn': el proceso web ya tiene hilos en marcha y un fork heredaría sus locks en
+    cualquier estado, con riesgo de bloqueos en los procesos hijos.
+    """
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is None:
+            _analysis_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+        return _analysis_pool
+
+
+def _discard_analysis_pool(pool: ProcessPoolExecutor) -> None:
+    """Olvidar un pool roto (p. ej. si murió un proceso) para que el siguiente lote cree otro."""
+    global _analysis_pool
+    with _analysis_pool_lock:
+        if _analysis_pool is pool:
+            _analysis_pool = None
+    pool.shutdown(wait=False)
+
+
+def _mean_and_stdev(values) -> Tuple[float, float]:
+    """Media y desviación estándar muestral de una colección de valores (al menos dos)."""
+    arr = np.fromiter(values, dtype=np.float64, count=len(values))
+    mean = float(arr.mean())
+    std_dev = float(arr.std(ddof=1))
+    if std_dev <= FLAT_RELATIVE_TOLERANCE * max(1.0, abs(mean)):
+        std_dev = 0.0
+    return mean, std_dev
+
+
+def _time_span(data_points) -> timedelta:
+    """Diferencia entre el último y el primer timestamp de los puntos (no vacíos), en una sola pasada."""
+    it = iter(data_points)
+    tmin = tmax = next(it).timestamp
+    for dp in it:
+        t = dp.timestamp
+        if t < tmin:
+            tmin = t
+        elif t > tmax:
+            tmax = t
+    return tmax - tmin
+
+
+@lru_cache(maxsize=64)
+def _centered_index(n: int) -> np.ndarray:
+    """Índices 0..n-1 centrados en su media (solo lectura; se reutilizan entre series de igual longitud)."""
+    index = np.arange(n, dtype=np.float64) - (n - 1) / 2
+    index.flags.writeable = False
+    return index
+
+
+class _PointColumns:
+    """Puntos longitudinales de un análisis en columnas (NumPy) en lugar de una lista de objetos.
+    
+    Las métricas se numeran por orden de primera aparición (`metrics[metric_ids[i]]`).
+    """
+    
+    __slots__ = ('metrics', 'metric_ids', 'values', 'timestamps')
+    
+    def __init__(self, data_points: List[LongitudinalDataPoint]):
+        n = len(data_points)
+        global_ids = np.fromiter((_metric_id(dp.metric_type) for dp in data_points), dtype=np.intp, count=n)
+        self.values = np.fromiter((dp.value for dp in data_points), dtype=np.float64, count=n)
+        self.timestamps = np.array([dp.timestamp for dp in data_points], dtype='datetime64[us]')
+        
+        # Renumerar las métricas del lote de 0 en adelante, por orden de primera aparición
+        present, first_seen = np.unique(global_ids, return_index=True)
+        order = present[np.argsort(first_seen)]
+        local_ids = np.empty(len(METRIC_NAMES), dtype=np.intp)
+        local_ids[order] = np.arange(order.size)
+        self.metric_ids = local_ids[global_ids]
+        self.metrics = [METRIC_NAMES[metric_id] for metric_id in order.tolist()]
+    
+    def bucket_averages(self, buckets: np.ndarray, n_buckets: int) -> List[Dict[int, float]]:
+        """Promedio por métrica y cubeta (hora, día...), en el orden en que aparece cada cubeta."""
+        keys = self.metric_ids * n_buckets + buckets
+        size = len(self.metrics) * n_buckets
+        sums = np.bincount(keys, weights=self.values, minlength=size)
+        counts = np.bincount(keys, minlength=size)
+        present, first_seen = np.unique(keys, return_index=True)
+        
+        averages: List[Dict[int, float]] = [{} for _ in self.metrics]
+        for key in present[np.argsort(first_seen)].tolist():
+            metric_id, bucket = divmod(key, n_buckets)
+            averages[metric_id][bucket] = float(sums[key] / counts[key])
+        return averages
+
+
 class EmotionalEvolutionAnalyzer:
     """Analizador de evolución emocional a lo largo del tiempo."""
     
     def __init__(self):
         """Inicializar analizador de evolución emocional."""
-        self.data_points = defaultdict(list)  # Por usuario
-        self.analysis_cache = {}
+        # Por usuario; se conservan solo los últimos MAX_POINTS_PER_USER (los más antiguos se descartan)
+        self.data_points: Dict[str, Deque[LongitudinalDataPoint]] = defaultdict(
+            lambda: deque(maxlen=MAX_POINTS_PER_USER))
+        # Por usuario: ((período, nº de puntos), instante de caducidad, resultado) (LRU)
+        self.analysis_cache: "OrderedDict[str, Tuple[Tuple[int, int], float, Dict[str, Any]]]" = OrderedDict()
+        # Media y varianza por usuario y métrica de los puntos conservados, mantenidas al añadir
+        # y al descartar puntos para no recorrer el historial en cada consulta
+        self._running_stats: Dict[str, Dict[str, RunningStats]] = defaultdict(lambda: defaultdict(RunningStats))
+        # Usuarios cuyos puntos no llegaron en orden cronológico (los demás ya están ordenados)
+        self._out_of_order_users = set()
         
     def add_data_point(self, user_id: str, data_point: LongitudinalDataPoint):
         """Añadir punto de datos longitudinal."""
-        self.data_points[user_id].append(data_point)
-        
-        # Mantener solo los últimos 1000 puntos por usuario
-        if len(self.data_points[user_id]) > 1000:
-            self.data_points[user_id] = self.data_points[user_id][-1000:]
+        # Asignar ya el identificador de la métrica, para que los análisis solo tengan que consultarlo
+        _metric_id(data_point.metric_type)
+        points = self.data_points[user_id]
+        running = self._running_stats[user_id]
+        if points and data_point.timestamp < points[-1].timestamp:
+            self._out_of_order_users.add(user_id)
+        if len(points) == points.maxlen:
+            # El deque descarta el punto más antiguo al añadir: quitarlo también de los estadísticos
+            evicted = points[0]
+            running[evicted.metric_type].remove(evicted.value)
+        points.append(data_point)
+        running[data_point.metric_type].add(data_point.value)
         
         # Invalidar cache para este usuario
-        if user_id in self.analysis_cache:
-            del self.analysis_cache[user_id]
+        self.analysis_cache.pop(user_id, None)
+    
+    def get_metric_summary(self, user_id: str) -> Dict[str, Dict[str, float]]:
+        """Recuento, media y desviación estándar por métrica de los puntos conservados del usuario, en O(1) por métrica."""
+        return {
+            metric: {
+                'count': rs.count,
+                'mean': rs.mean,
+                'std_dev': rs.stdev() if rs.count > 1 else 0.0
+            }
+            for metric, rs in self._running_stats.get(user_id, {}).items()
+            if rs.count
+        }
+    
+    def points_since(self, user_id: str, cutoff_date: datetime) -> List[LongitudinalDataPoint]:
+        """Puntos conservados del usuario con timestamp >= cutoff_date, en orden de llegada."""
+        points = self.data_points.get(user_id)
+        if not points:
+            return []
+        if user_id in self._out_of_order_users:
+            return [dp for dp in points if dp.timestamp >= cutoff_date]
+        # Puntos en orden cronológico: búsqueda binaria del primero dentro del período
+        start = bisect_left(points, cutoff_date, key=attrgetter('timestamp'))
+        return list(islice(points, start, None))
     
     def generate_evolution_chart_data(self, user_id: str, 
                                     time_period_days: int = 30) -> Dict[str, Any]:
         """Generar datos para gráfico de evolución emocional."""
         try:
-            if user_id not in self.data_points:
-                return {'error': 'No data available for user'}
-            
-            # Filtrar datos por período de tiempo
-            cutoff_date = datetime.now() - timedelta(days=time_period_days)
-            filtered_points = [
-                dp for dp in self.data_points[user_id]
-                if dp.timestamp >= cutoff_date
-            ]
-            
-            if not filtered_points:
-                return {'error': 'No data in specified time period'}
+            result, job = self._prepare_chart_data(user_id, time_period_days)
+            if job is None:
+                return result
             
-            # Organizar datos por métrica
-            metrics_data = defaultdict(list)
-            timestamps = []
-            
-            for point in filtered_points:
-                timestamps.append(point.timestamp.isoformat())
-                metrics_data[point.metric_type].append({
-                    'timestamp': point.timestamp.isoformat(),
-                    'value': point.value,
-                    'context': point.context,
-                    'source': point.source
-                })
-            
-            # Calcular estadísticas básicas
-            stats = self._calculate_evolution_statistics(filtered_points)
-            
-            # Detectar tendencias
-            trends = self._detect_trends(filtered_points)
-            
-            return {
-                'user_id': user_id,
-                'time_period_days': time_period_days,
-                'total_data_points': len(filtered_points),
-                'metrics_data': dict(metrics_data),
-                'unique_timestamps': sorted(list(set(timestamps))),
-                'statistics': stats,
-                'trends': trends,
-                'generated_at': datetime.now().isoformat()
-            }
+            cache_key, filtered_points, summary = job
+            stats, trends = _evolution_stats_and_trends(filtered_points, summary)
+            return self._finish_chart_data(user_id, time_period_days, cache_key, filtered_points, stats, trends)
             
         except Exception as e:
             logger.error(f"Error generating evolution chart data: {str(e)}")
             return {'error': str(e)}
     
-    def _calculate_evolution_statistics(self, data_points: List[LongitudinalDataPoint]) -> Dict[str, Any]:
-        """Calcular estadísticas de evolución emocional."""
+    def batch_analyze(self, user_ids: List[str], time_period_days: int = 30) -> Dict[str, Dict[str, Any]]:
+        """Generar los datos de evolución de varios usuarios (p. ej. en procesos nocturnos).
+        
+        Equivale a `generate_evolution_chart_data` por usuario. Si hay al menos
+        BATCH_PROCESS_MIN_USERS usuarios sin resultado en cache, sus estadísticas y tendencias
+        se calculan en paralelo en el pool de procesos compartido.
+        """
+        results: Dict[str, Dict[str, Any]] = {}
+        jobs = {}
+        for user_id in user_ids:
+            try:
+                result, job = self._prepare_chart_data(user_id, time_period_days)
+            except Exception as e:
+                logger.error(f"Error generating evolution chart data: {str(e)}")
+                result, job = {'error': str(e)}, None
+            if job is None:
+                results[user_id] = result
+            else:
+                jobs[user_id] = job
+        
+        futures = {}
+        if len(jobs) >= BATCH_PROCESS_MIN_USERS:
+            pool = _get_analysis_pool()
+            try:
+                futures = {
+                    user_id: pool.submit(_evolution_stats_and_trends, filtered_points, summary)
+                    for user_id, (_, filtered_points, summary) in jobs.items()
+                }
+            except BrokenProcessPool as e:
+                logger.error(f"Analysis process pool unavailable, computing inline: {str(e)}")
+                _discard_analysis_pool(pool)
+                futures = {}
+        
+        for user_id, (cache_key, filtered_points, summary) in jobs.items():
+            try:
+                if user_id in futures:
+                    stats, trends = futures[user_id].result()
+                else:
+                    stats, trends = _evolution_stats_and_trends(filtered_points, summary)
+                results[user_id] = self._finish_chart_data(
+                    user_id, time_period_days, cache_key, filtered_points, stats, trends
+                )
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    _discard_analysis_pool(pool)
+                logger.error(f"Error generating evolution chart data: {str(e)}")
+                results[user_id] = {'error': str(e)}
+        
+        return {user_id: results[user_id] for user_id in user_ids}
+    
+    def _prepare_chart_data(self, user_id: str, time_period_days: int):
+        """Resultado ya disponible (cache o error) o, si hay que calcularlo, (clave de cache, puntos, resumen)."""
+        if user_id not in self.data_points:
+            return {'error': 'No data available for user'}, None
+        
+        cache_key = (time_period_days, len(self.data_points[user_id]))
+        cached = self.analysis_cache.get(user_id)
+        if cached is not None and cached[0] == cache_key and time.monotonic() < cached[1]:
+            self.analysis_cache.move_to_end(user_id)
+            # Copia: quien reciba el resultado puede modificarlo sin alterar la entrada guardada
+            return copy.deepcopy(cached[2]), None
+        
+        # Filtrar datos por período de tiempo
+        cutoff_date = datetime.now() - timedelta(days=time_period_days)
+        filtered_points = self.points_since(user_id, cutoff_date)
+        
+        if not filtered_points:
+            return {'error': 'No data in specified time period'}, None
+        
+        # Si el período abarca todo el historial conservado, la media y la desviación
+        # salen de los estadísticos acumulados
+        summary = (self.get_metric_summary(user_id)
+                   if len(filtered_points) == len(self.data_points[user_id]) else None)
+        return None, (cache_key, filtered_points, summary)
+    
+    def _finish_chart_data(self, user_id: str, time_period_days: int, cache_key: Tuple[int, int],
+                           filtered_points: List[LongitudinalDataPoint],
+                           stats: Dict[str, Any], trends: Dict[str, Any]) -> Dict[str, Any]:
+        """Montar (y guardar en cache) los datos del gráfico a partir de estadísticas y tendencias."""
+        # Organizar datos por métrica (cada timestamp se formatea una sola vez: las métricas
+        # de un mismo estado emocional comparten timestamp)
+        metrics_data = defaultdict(list)
+        iso_timestamps: Dict[datetime, str] = {}
+        
+        for point in filtered_points:
+            timestamp = iso_timestamps.get(point.timestamp)
+            if timestamp is None:
+                timestamp = iso_timestamps[point.timestamp] = point.timestamp.isoformat()
+            metrics_data[point.metric_type].append({
+                'timestamp': timestamp,
+                'value': point.value,
+                'context': point.context,
+                'source': point.source
+            })
+        
+        # Timestamps distintos en orden: si los puntos llegaron en orden cronológico,
+        # el orden de inserción en iso_timestamps ya es el correcto
+        unique_timestamps = list(iso_timestamps.values())
+        if user_id in self._out_of_order_users:
+            unique_timestamps.sort()
+        
+        result = {
+            'user_id': user_id,
+            'time_period_days': time_period_days,
+            'total_data_points': len(filtered_points),
+            'metrics_data': dict(metrics_data),
+            'unique_timestamps': unique_timestamps,
+            'statistics': stats,
+            'trends': trends,
+            'generated_at': datetime.now().isoformat()
+        }
+        
+        self.analysis_cache[user_id] = (cache_key, time.monotonic() + ANALYSIS_CACHE_TTL, copy.deepcopy(result))
+        self.analysis_cache.move_to_end(user_id)
+        if len(self.analysis_cache) > ANALYSIS_CACHE_SIZE:
+            self.analysis_cache.popitem(last=False)
+        
+        return result
+    
+    @staticmethod
+    def _calculate_evolution_statistics(data_points: List[LongitudinalDataPoint],
+                                        summary: Optional[Dict[str, Dict[str, float]]] = None) -> Dict[str, Any]:
+        """Calcular estadísticas de evolución emocional.
+        
+        `summary` (ver `get_metric_summary`) aporta la media y la desviación de cada métrica
+        cuando `data_points` son todos los puntos conservados del usuario.
+        """
         
         stats = {
             'by_metric': {},
@@ -107,8 +387,7 @@ class EmotionalEvolutionAnalyzer:
             return stats
         
         # Calcular span temporal
-        timestamps = [dp.timestamp for dp in data_points]
-        time_span = max(timestamps) - min(timestamps)
+        time_span = _time_span(data_points)
         stats['overall']['time_span_days'] = time_span.days
         
         if time_span.days > 0:
@@ -121,19 +400,27 @@ class EmotionalEvolutionAnalyzer:
         
         for metric, values in metrics_values.items():
             if values:
+                arr = np.fromiter(values, dtype=np.float64, count=len(values))
+                running = summary.get(metric) if summary else None
+                if running is None:
+                    running = {
+                        'mean': float(arr.mean()),
+                        'std_dev': float(arr.std(ddof=1)) if len(values) > 1 else 0.0
+                    }
                 stats['by_metric'][metric] = {
                     'count': len(values),
-                    'mean': statistics.mean(values),
-                    'median': statistics.median(values),
-                    'std_dev': statistics.stdev(values) if len(values) > 1 else 0.0,
-                    'min': min(values),
-                    'max': max(values),
-                    'range': max(values) - min(values)
+                    'mean': running['mean'],
+                    'median': float(np.median(arr)),
+                    'std_dev': running['std_dev'],
+                    'min': float(arr.min()),
+                    'max': float(arr.max()),
+                    'range': float(np.ptp(arr))
                 }
         
         return stats
     
-    def _detect_trends(self, data_points: List[LongitudinalDataPoint]) -> Dict[str, Any]:
+    @staticmethod
+    def _detect_trends(data_points: List[LongitudinalDataPoint]) -> Dict[str, Any]:
         """Detectar tendencias en los datos longitudinales."""
         
         trends = {
@@ -157,7 +444,7 @@ class EmotionalEvolutionAnalyzer:
             values = [pair[1] for pair in time_value_pairs]
             
             # Calcular tendencia usando regresión lineal simple
-            trend_score = self._calculate_linear_trend(values)
+            trend_score = EmotionalEvolutionAnalyzer._calculate_linear_trend(values)
             trends['by_metric'][metric] = {
                 'trend_score': trend_score,
                 'direction': 'improving' if trend_score > 5 else 'declining' if trend_score < -5 else 'stable',
@@ -168,7 +455,7 @@ class EmotionalEvolutionAnalyzer:
         
         # Tendencia general
         if trend_scores:
-            overall_trend_score = statistics.mean(trend_scores)
+            overall_trend_score = statistics.fmean(trend_scores)
             if overall_trend_score > 5:
                 trends['overall_trend'] = 'improving'
             elif overall_trend_score < -5:
@@ -178,27 +465,27 @@ class EmotionalEvolutionAnalyzer:
         
         return trends
     
-    def _calculate_linear_trend(self, values: List[float]) -> float:
+    @staticmethod
+    def _calculate_linear_trend(values: List[float]) -> float:
         """Calcular tendencia lineal de una serie de valores."""
-        n = len(values)
+        v = np.asarray(values, dtype=np.float64)
+        n = v.size
         if n < 2:
             return 0.0
         
-        # Calcular pendiente usando mínimos cuadrados
-        x = list(range(n))
-        x_mean = statistics.mean(x)
-        y_mean = statistics.mean(values)
-        
-        numerator = sum((x[i] - x_mean) * (values[i] - y_mean) for i in range(n))
-        denominator = sum((x[i] - x_mean) ** 2 for i in range(n))
-        
-        if denominator == 0:
-            return 0.0
-        
-        slope = numerator / denominator
+        # Pendiente por mínimos cuadrados en forma cerrada: con x centrado, sum(x - x̄) = 0,
+        # así que el numerador es x_c · y y el denominador sum(x_c²) = n(n² - 1) / 12
+        slope = float(_centered_index(n) @ v) / (n * (n * n - 1) / 12)
         
         # Normalizar pendiente a escala -100 a 100
-        return slope * (100 / max(abs(max(values) - min(values)), 1))
+        return slope * (100 / max(abs(float(np.ptp(v))), 1))
+
+
+def _evolution_stats_and_trends(data_points: List[LongitudinalDataPoint],
+                                summary: Optional[Dict[str, Dict[str, float]]]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Estadísticas y tendencias de evolución de un usuario (función de módulo: se ejecuta en otros procesos)."""
+    return (EmotionalEvolutionAnalyzer._calculate_evolution_statistics(data_points, summary),
+            EmotionalEvolutionAnalyzer._detect_trends(data_points))
 
 
 class TemporalPatternDetector:
@@ -213,18 +500,19 @@ class TemporalPatternDetector:
         """Analizar patrones temporales en los datos."""
         
         patterns = []
+        columns = _PointColumns(data_points)
         
         # Detectar patrones diarios
-        daily_patterns = self._detect_daily_patterns(data_points)
+        daily_patterns = self._detect_daily_patterns(columns)
         patterns.extend(daily_patterns)
         
         # Detectar patrones semanales
-        weekly_patterns = self._detect_weekly_patterns(data_points)
+        weekly_patterns = self._detect_weekly_patterns(columns)
         patterns.extend(weekly_patterns)
         
         # Detectar patrones estacionales (si hay suficientes datos)
-        if self._has_sufficient_data_for_seasonal(data_points):
-            seasonal_patterns = self._detect_seasonal_patterns(data_points)
+        if self._has_sufficient_data_for_seasonal(columns):
+            seasonal_patterns = self._detect_seasonal_patterns(columns)
             patterns.extend(seasonal_patterns)
         
         # Almacenar patrones detectados
@@ -232,34 +520,21 @@ class TemporalPatternDetector:
         
         return patterns
     
-    def _detect_daily_patterns(self, data_points: List[LongitudinalDataPoint]) -> List[TemporalPattern]:
+    def _detect_daily_patterns(self, columns: _PointColumns) -> List[TemporalPattern]:
         """Detectar patrones diarios (horas del día)."""
         
         patterns = []
         
-        # Agrupar por hora del día
-        hourly_data = defaultdict(lambda: defaultdict(list))
-        
-        for dp in data_points:
-            hour = dp.timestamp.hour
-            hourly_data[dp.metric_type][hour].append(dp.value)
+        # Promedios por métrica y hora del día
+        hours = columns.timestamps.astype('datetime64[h]').astype(np.int64) % 24
+        averages_by_metric = columns.bucket_averages(hours, 24)
         
-        for metric, hours_data in hourly_data.items():
-            if len(hours_data) < 3:  # Necesitamos al menos 3 horas diferentes
-                continue
-            
-            # Calcular promedios por hora
-            hour_averages = {}
-            for hour, values in hours_data.items():
-                if values:
-                    hour_averages[hour] = statistics.mean(values)
-            
-            if len(hour_averages) < 3:
+        for metric_id, (metric, hour_averages) in enumerate(zip(columns.metrics, averages_by_metric)):
+            if len(hour_averages) < 3:  # Necesitamos al menos 3 horas diferentes
                 continue
             
             # Encontrar picos y valles
-            peak_hours = self._find_peaks(hour_averages)
-            low_hours = self._find_lows(hour_averages)
+            peak_hours, low_hours = self._find_peaks_and_lows(hour_averages)
             
             if peak_hours or low_hours:
                 confidence = min(1.0, len(hour_averages) / 24)  # Más horas = más confianza
@@ -269,45 +544,36 @@ class TemporalPatternDetector:
                     metric=metric,
                     pattern_description=f"Patrón diario en {metric}",
                     confidence=confidence,
-                    peak_times=[f"{hour}:00" for hour in peak_hours],
-                    low_times=[f"{hour}:00" for hour in low_hours],
+                    peak_times=[HOUR_LABELS[hour] for hour in peak_hours],
+                    low_times=[HOUR_LABELS[hour] for hour in low_hours],
                     trend_direction=self._determine_trend_direction(hour_averages),
-                    statistical_significance=self._calculate_significance(hours_data)
+                    statistical_significance=self._calculate_significance(
+                        columns.values[columns.metric_ids == metric_id], list(hour_averages.values()))
                 )
                 patterns.append(pattern)
         
         return patterns
     
-    def _detect_weekly_patterns(self, data_points: List[LongitudinalDataPoint]) -> List[TemporalPattern]:
+    def _detect_weekly_patterns(self, columns: _PointColumns) -> List[TemporalPattern]:
         """Detectar patrones semanales (días de la semana)."""
         
         patterns = []
         
-        # Agrupar por día de la semana
-        weekly_data = defaultdict(lambda: defaultdict(list))
+        # Promedios por métrica y día de la semana (0=Monday, 6=Sunday; el 1970-01-01 fue jueves)
+        weekdays = (columns.timestamps.astype('datetime64[D]').astype(np.int64) + 3) % 7
+        averages_by_metric = columns.bucket_averages(weekdays, 7)
         
-        for dp in data_points:
-            weekday = dp.timestamp.weekday()  # 0=Monday, 6=Sunday
-            weekly_data[dp.metric_type][weekday].append(dp.value)
-        
-        weekday_names = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
-        
-        for metric, days_data in weekly_data.items():
-            if len(days_data) < 3:  # Necesitamos al menos 3 días diferentes
+        for metric, day_averages in zip(columns.metrics, averages_by_metric):
+            if len(day_averages) < 3:  # Necesitamos al menos 3 días diferentes
                 continue
             
-            # Calcular promedios por día
-            day_averages = {}
-            for day, values in days_data.items():
-                if values:
-                    day_averages[day] = statistics.mean(values)
-            
-            if len(day_averages) < 3:
+            # Encontrar patrones de fin de semana vs días laborables (hacen falta ambos)
+            weekday_values = [avg for day, avg in day_averages.items() if day < 5]
+            weekend_values = [avg for day, avg in day_averages.items() if day >= 5]
+            if not weekday_values or not weekend_values:
                 continue
-            
-            # Encontrar patrones de fin de semana vs días laborables
-            weekday_avg = statistics.mean([avg for day, avg in day_averages.items() if day < 5])
-            weekend_avg = statistics.mean([avg for day, avg in day_averages.items() if day >= 5])
+            weekday_avg = statistics.fmean(weekday_values)
+            weekend_avg = statistics.fmean(weekend_values)
             
             if abs(weekday_avg - weekend_avg) > 10:  # Diferencia significativa
                 confidence = min(1.0, len(day_averages) / 7)
@@ -318,13 +584,14 @@ class TemporalPatternDetector:
                 else:
                     pattern_desc += " (mayor en fines de semana)"
                 
+                overall_avg = statistics.fmean(day_averages.values())
                 pattern = TemporalPattern(
                     pattern_type="weekly",
                     metric=metric,
                     pattern_description=pattern_desc,
                     confidence=confidence,
-                    peak_times=[weekday_names[day] for day, avg in day_averages.items() if avg > statistics.mean(day_averages.values())],
-                    low_times=[weekday_names[day] for day, avg in day_averages.items() if avg < statistics.mean(day_averages.values())],
+                    peak_times=[WEEKDAY_NAMES[day] for day, avg in day_averages.items() if avg > overall_avg],
+                    low_times=[WEEKDAY_NAMES[day] for day, avg in day_averages.items() if avg < overall_avg],
                     trend_direction="variable",
                     statistical_significance=abs(weekday_avg - weekend_avg) / max(weekday_avg, weekend_avg)
                 )
@@ -332,34 +599,17 @@ class TemporalPatternDetector:
         
         return patterns
     
-    def _detect_seasonal_patterns(self, data_points: List[LongitudinalDataPoint]) -> List[TemporalPattern]:
+    def _detect_seasonal_patterns(self, columns: _PointColumns) -> List[TemporalPattern]:
         """Detectar patrones estacionales (meses del año)."""
         
         patterns = []
         
-        # Agrupar por mes
-        monthly_data = defaultdict(lambda: defaultdict(list))
+        # Promedios por métrica y mes (1-12; la cubeta 0 queda vacía)
+        months = columns.timestamps.astype('datetime64[M]').astype(np.int64) % 12 + 1
+        averages_by_metric = columns.bucket_averages(months, 13)
         
-        for dp in data_points:
-            month = dp.timestamp.month
-            monthly_data[dp.metric_type][month].append(dp.value)
-        
-        month_names = [
-            'Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
-            'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre'
-        ]
-        
-        for metric, months_data in monthly_data.items():
-            if len(months_data) < 6:  # Necesitamos al menos 6 meses
-                continue
-            
-            # Calcular promedios por mes
-            month_averages = {}
-            for month, values in months_data.items():
-                if values:
-                    month_averages[month] = statistics.mean(values)
-            
-            if len(month_averages) < 6:
+        for metric, month_averages in zip(columns.metrics, averages_by_metric):
+            if len(month_averages) < 6:  # Necesitamos al menos 6 meses
                 continue
             
             # Detectar estacionalidad (invierno vs verano)
@@ -370,8 +620,8 @@ class TemporalPatternDetector:
             summer_values = [avg for month, avg in month_averages.items() if month in summer_months]
             
             if winter_values and summer_values:
-                winter_avg = statistics.mean(winter_values)
-                summer_avg = statistics.mean(summer_values)
+                winter_avg = statistics.fmean(winter_values)
+                summer_avg = statistics.fmean(summer_values)
                 
                 if abs(winter_avg - summer_avg) > 15:  # Diferencia estacional significativa
                     confidence = min(1.0, len(month_averages) / 12)
@@ -382,13 +632,14 @@ class TemporalPatternDetector:
                     else:
                         pattern_desc += " (mayor en verano)"
                     
+                    overall_avg = statistics.fmean(month_averages.values())
                     pattern = TemporalPattern(
                         pattern_type="seasonal",
                         metric=metric,
                         pattern_description=pattern_desc,
                         confidence=confidence,
-                        peak_times=[month_names[month-1] for month, avg in month_averages.items() if avg > statistics.mean(month_averages.values())],
-                        low_times=[month_names[month-1] for month, avg in month_averages.items() if avg < statistics.mean(month_averages.values())],
+                        peak_times=[MONTH_NAMES[month-1] for month, avg in month_averages.items() if avg > overall_avg],
+                        low_times=[MONTH_NAMES[month-1] for month, avg in month_averages.items() if avg < overall_avg],
                         trend_direction="cyclical",
                         statistical_significance=abs(winter_avg - summer_avg) / max(winter_avg, summer_avg)
                     )
@@ -396,35 +647,35 @@ class TemporalPatternDetector:
         
         return patterns
     
-    def _has_sufficient_data_for_seasonal(self, data_points: List[LongitudinalDataPoint]) -> bool:
+    def _has_sufficient_data_for_seasonal(self, columns: _PointColumns) -> bool:
         """Verificar si hay suficientes datos para análisis estacional."""
-        if not data_points:
+        if not len(columns.timestamps):
             return False
         
-        timestamps = [dp.timestamp for dp in data_points]
-        time_span = max(timestamps) - min(timestamps)
-        
-        return time_span.days >= 180  # Al menos 6 meses de datos
-    
-    def _find_peaks(self, hour_averages: Dict[int, float]) -> List[int]:
-        """Encontrar horas pico en los datos."""
-        if len(hour_averages) < 3:
-            return []
-        
-        values = list(hour_averages.values())
-        threshold = statistics.mean(values) + (statistics.stdev(values) if len(values) > 1 else 0)
-        
-        return [hour for hour, avg in hour_averages.items() if avg > threshold]
+        # Al menos 6 meses de datos
+        return np.ptp(columns.timestamps) >= np.timedelta64(180, 'D')
     
-    def _find_lows(self, hour_averages: Dict[int, float]) -> List[int]:
-        """Encontrar horas bajas en los datos."""
+    def _find_peaks_and_lows(self, hour_averages: Dict[int, float]) -> Tuple[List[int], List[int]]:
+        """Encontrar horas pico (por encima de media + desviación) y bajas (por debajo de media - desviación)."""
         if len(hour_averages) < 3:
-            return []
-        
-        values = list(hour_averages.values())
-        threshold = statistics.mean(values) - (statistics.stdev(values) if len(values) > 1 else 0)
-        
-        return [hour for hour, avg in hour_averages.items() if avg < threshold]
+            return [], []
+        
+        # Media y desviación se calculan una sola vez para ambos umbrales
+        mean, std_dev = _mean_and_stdev(hour_averages.values())
+        if std_dev == 0:
+            # Perfil plano: ninguna hora destaca
+            return [], []
+        peak_threshold = mean + std_dev
+        low_threshold = mean - std_dev
+        
+        peaks = []
+        lows = []
+        for hour, avg in hour_averages.items():
+            if avg > peak_threshold:
+                peaks.append(hour)
+            elif avg < low_threshold:
+                lows.append(hour)
+        return peaks, lows
     
     def _determine_trend_direction(self, time_averages: Dict[int, float]) -> str:
         """Determinar dirección de tendencia."""
@@ -439,8 +690,8 @@ class TemporalPatternDetector:
         second_half = values[len(values)//2:]
         
         if first_half and second_half:
-            first_avg = statistics.mean(first_half)
-            second_avg = statistics.mean(second_half)
+            first_avg = statistics.fmean(first_half)
+            second_avg = statistics.fmean(second_half)
             
             if second_avg > first_avg * 1.1:
                 return "improving"
@@ -449,26 +700,20 @@ class TemporalPatternDetector:
         
         return "stable"
     
-    def _calculate_significance(self, data_groups: Dict[int, List[float]]) -> float:
-        """Calcular significancia estadística de los patrones."""
-        all_values = []
-        for values in data_groups.values():
-            all_values.extend(values)
-        
-        if len(all_values) < 3:
+    def _calculate_significance(self, values: np.ndarray, group_means: List[float]) -> float:
+        """Calcular significancia estadística de los patrones (`values` son todos los valores agrupados)."""
+        if len(values) < 3:
             return 0.0
         
-        overall_std = statistics.stdev(all_values)
+        _, overall_std = _mean_and_stdev(values)
         if overall_std == 0:
             return 0.0
         
         # Calcular variabilidad entre grupos vs dentro de grupos
-        group_means = [statistics.mean(values) for values in data_groups.values() if values]
-        
         if len(group_means) < 2:
             return 0.0
         
-        between_group_var = statistics.stdev(group_means)
+        _, between_group_var = _mean_and_stdev(group_means)
         significance = between_group_var / overall_std
         
         return min(1.0, significance)
@@ -480,7 +725,17 @@ class CrisisPredictionEngine:
     def __init__(self):
         """Inicializar motor de predicción de crisis."""
         self.risk_indicators = self._load_risk_indicators()
+        # Orden de los indicadores en las matrices de scores y sus pesos como vector
+        self._indicator_names = tuple(self.risk_indicators)
+        self._indicator_weights = np.array(
+            [indicator['weight'] for indicator in self.risk_indicators.values()], dtype=np.float64)
         self.prediction_history = defaultdict(list)
+        # Última evaluación por usuario junto con la firma de los datos con que se calculó
+        self._assessment_cache: Dict[str, Tuple[Tuple, CrisisRiskAssessment]] = {}
+        
+    def invalidate_assessment(self, user_id: str) -> None:
+        """Descartar la última evaluación guardada del usuario (p. ej. al registrar datos nuevos)."""
+        self._assessment_cache.pop(user_id, None)
         
     def _load_risk_indicators(self) -> Dict[str, Dict[str, Any]]:
         """Cargar indicadores de riesgo para predicción de crisis."""
@@ -521,86 +776,136 @@ class CrisisPredictionEngine:
                           recent_data: List[LongitudinalDataPoint],
                           emotional_states: List[EmotionalState],
                           temporal_patterns: List[TemporalPattern]) -> CrisisRiskAssessment:
-        """Evaluar riesgo de crisis basado en datos recientes."""
+        """Evaluar riesgo de crisis basado en datos recientes.
         
-        try:
-            assessment_id = f"crisis_assessment_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            
-            # Calcular scores de riesgo
-            risk_scores = self._calculate_risk_scores(recent_data, emotional_states, temporal_patterns)
-            
-            # Calcular score total ponderado
-            total_risk_score = sum(
-                score * self.risk_indicators[indicator]['weight']
-                for indicator, score in risk_scores.items()
-                if indicator in self.risk_indicators
-            )
-            
-            # Determinar nivel de riesgo
-            risk_level = self._determine_risk_level(total_risk_score)
-            
-            # Identificar factores de riesgo específicos
-            risk_factors = self._identify_risk_factors(recent_data, emotional_states, risk_scores)
-            
-            # Identificar factores protectores
-            protective_factors = self._identify_protective_factors(recent_data, emotional_states)
-            
-            # Generar acciones inmediatas recomendadas
-            immediate_actions = self._generate_immediate_actions(risk_level, risk_factors)
-            
-            # Calcular confianza en la predicción
-            confidence = self._calculate_prediction_confidence(
-                len(recent_data), len(emotional_states), temporal_patterns
-            )
-            
-            assessment = CrisisRiskAssessment(
-                assessment_id=assessment_id,
-                session_id=user_id,
-                risk_level=risk_level,
-                risk_score=total_risk_score,
-                risk_factors=risk_factors,
-                protective_factors=protective_factors,
-                immediate_actions=immediate_actions,
-                confidence=confidence
-            )
-            
-            # Almacenar en historial
-            self.prediction_history[user_id].append(assessment)
-            
-            return assessment
+        Si no ha llegado nada nuevo desde la última evaluación del usuario, se devuelve esa misma.
+        """
+        return self.batch_assess_crisis_risk([(user_id, recent_data, emotional_states, temporal_patterns)])[0]
+    
+    def batch_assess_crisis_risk(
+        self,
+        users_data: List[Tuple[str, List[LongitudinalDataPoint], List[EmotionalState], List[TemporalPattern]]]
+    ) -> List[CrisisRiskAssessment]:
+        """Evaluar el riesgo de crisis de varios usuarios a la vez.
+        
+        `users_data` contiene tuplas (user_id, recent_data, emotional_states, temporal_patterns), como
+        los argumentos de `assess_crisis_risk`. Los scores de todos los usuarios se acotan a 0-100 y se
+        ponderan juntos como una matriz (usuarios x indicadores).
+        """
+        assessments: List[Optional[CrisisRiskAssessment]] = [None] * len(users_data)
+        pending = []  # (posición, firma, scores sin acotar)
+        
+        for position, (user_id, recent_data, emotional_states, temporal_patterns) in enumerate(users_data):
+            try:
+                signature = (
+                    len(recent_data), recent_data[-1].timestamp if recent_data else None,
+                    len(emotional_states), emotional_states[-1].valence if emotional_states else None,
+                    len(temporal_patterns)
+                )
+                cached = self._assessment_cache.get(user_id)
+                if cached is not None and cached[0] == signature:
+                    assessments[position] = cached[1]
+                    continue
+                
+                # Calcular scores de riesgo
+                risk_scores = self._calculate_risk_scores(recent_data, emotional_states, temporal_patterns)
+                pending.append((position, signature, [risk_scores.get(name, 0.0) for name in self._indicator_names]))
+            except Exception as e:
+                assessments[position] = self._failed_assessment(user_id, e)
+        
+        if pending:
+            # Acotar scores y calcular el score total ponderado de todos los usuarios de una vez
+            score_matrix = np.clip(np.array([scores for _, _, scores in pending], dtype=np.float64), 0.0, 100.0)
+            total_scores = score_matrix @ self._indicator_weights
             
-        except Exception as e:
-            logger.error(f"Error in crisis risk assessment: {str(e)}")
-            return CrisisRiskAssessment(
-                assessment_id="error",
-                session_id=user_id,
-                risk_level="unknown",
-                risk_score=0.0,
-                confidence=0.0
-            )
+            for (position, signature, _), scores, total_risk_score in zip(
+                    pending, score_matrix.tolist(), total_scores.tolist()):
+                user_id, recent_data, emotional_states, temporal_patterns = users_data[position]
+                try:
+                    assessment = self._build_assessment(
+                        user_id, recent_data, emotional_states, temporal_patterns,
+                        dict(zip(self._indicator_names, scores)), total_risk_score
+                    )
+                    self._assessment_cache[user_id] = (signature, assessment)
+                    assessments[position] = assessment
+                except Exception as e:
+                    assessments[position] = self._failed_assessment(user_id, e)
+        
+        return assessments
+    
+    def _build_assessment(self, user_id: str,
+                          recent_data: List[LongitudinalDataPoint],
+                          emotional_states: List[EmotionalState],
+                          temporal_patterns: List[TemporalPattern],
+                          risk_scores: Dict[str, float],
+                          total_risk_score: float) -> CrisisRiskAssessment:
+        """Construir (y guardar en el historial) la evaluación a partir de los scores ya calculados."""
+        assessment_id = f"crisis_assessment_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        
+        # Determinar nivel de riesgo
+        risk_level = self._determine_risk_level(total_risk_score)
+        
+        # Identificar factores de riesgo específicos
+        risk_factors = self._identify_risk_factors(recent_data, emotional_states, risk_scores)
+        
+        # Identificar factores protectores
+        protective_factors = self._identify_protective_factors(recent_data, emotional_states)
+        
+        # Generar acciones inmediatas recomendadas
+        immediate_actions = self._generate_immediate_actions(risk_level, risk_factors)
+        
+        # Calcular confianza en la predicción
+        confidence = self._calculate_prediction_confidence(
+            len(recent_data), len(emotional_states), temporal_patterns
+        )
+        
+        assessment = CrisisRiskAssessment(
+            assessment_id=assessment_id,
+            session_id=user_id,
+            risk_level=risk_level,
+            risk_score=total_risk_score,
+            risk_factors=risk_factors,
+            protective_factors=protective_factors,
+            immediate_actions=immediate_actions,
+            confidence=confidence
+        )
+        
+        # Almacenar en historial
+        self.prediction_history[user_id].append(assessment)
+        
+        return assessment
+    
+    def _failed_assessment(self, user_id: str, error: Exception) -> CrisisRiskAssessment:
+        """Evaluación de reserva cuando falla el cálculo para un usuario."""
+        logger.error(f"Error in crisis risk assessment: {str(error)}")
+        return CrisisRiskAssessment(
+            assessment_id="error",
+            session_id=user_id,
+            risk_level="unknown",
+            risk_score=0.0,
+            confidence=0.0
+        )
     
     def _calculate_risk_scores(self, data_points: List[LongitudinalDataPoint],
                              emotional_states: List[EmotionalState],
                              patterns: List[TemporalPattern]) -> Dict[str, float]:
-        """Calcular scores de riesgo para diferentes indicadores."""
+        """Calcular scores de riesgo para diferentes indicadores (sin acotar a 0-100)."""
         
         scores = {}
         
-        # Score de intensidad emocional
+        # Scores de intensidad emocional y de valencia negativa (últimos 10 estados, en una pasada)
         if emotional_states:
-            recent_intensities = [es.intensity for es in emotional_states[-10:]]  # Últimos 10
-            avg_intensity = statistics.mean(recent_intensities)
-            scores['emotional_intensity'] = min(100.0, avg_intensity)
+            recent_states = emotional_states[-10:]
+            intensity_sum = 0.0
+            valence_sum = 0.0
+            for es in recent_states:
+                intensity_sum += es.intensity
+                valence_sum += es.valence
+            scores['emotional_intensity'] = intensity_sum / len(recent_states)
+            # Convertir valencia negativa a score de riesgo (se acota a 0-100 al ponderar)
+            scores['negative_valence'] = -valence_sum / len(recent_states)
         else:
             scores['emotional_intensity'] = 0.0
-        
-        # Score de valencia negativa
-        if emotional_states:
-            recent_valences = [es.valence for es in emotional_states[-10:]]
-            avg_valence = statistics.mean(recent_valences)
-            # Convertir valencia negativa a score de riesgo (0-100)
-            scores['negative_valence'] = max(0.0, min(100.0, -avg_valence))
-        else:
             scores['negative_valence'] = 0.0
         
         # Score de disrupción de patrones
@@ -644,10 +949,8 @@ class CrisisPredictionEngine:
             return 0.0
         
         # Calcular timestamps para frecuencia
-        recent_days = (max(dp.timestamp for dp in recent_points) - 
-                      min(dp.timestamp for dp in recent_points)).days or 1
-        older_days = (max(dp.timestamp for dp in older_points) - 
-                     min(dp.timestamp for dp in older_points)).days or 1
+        recent_days = _time_span(recent_points).days or 1
+        older_days = _time_span(older_points).days or 1
         
         recent_freq = len(recent_points) / recent_days
         older_freq = len(older_points) / older_days
@@ -664,26 +967,18 @@ class CrisisPredictionEngine:
         if len(emotional_states) < 5:
             return 0.0
         
-        # Buscar secuencias de estados negativos consecutivos
-        negative_sequences = []
-        current_sequence = 0
-        
-        for state in emotional_states:
-            if state.valence < -20:  # Estado negativo
-                current_sequence += 1
-            else:
-                if current_sequence > 0:
-                    negative_sequences.append(current_sequence)
-                current_sequence = 0
-        
-        if current_sequence > 0:
-            negative_sequences.append(current_sequence)
-        
-        if not negative_sequences:
+        # Buscar secuencias de estados negativos consecutivos (codificación por tramos:
+        # los cambios de la máscara marcan dónde empieza y dónde termina cada secuencia)
+        valences = np.fromiter((es.valence for es in emotional_states), dtype=np.float64,
+                               count=len(emotional_states))
+        negative = (valences < -20).astype(np.int8)  # Estado negativo
+        edges = np.diff(negative, prepend=0, append=0)
+        starts = np.flatnonzero(edges == 1)
+        if not starts.size:
             return 0.0
         
         # Score basado en la secuencia más larga
-        max_sequence = max(negative_sequences)
+        max_sequence = int((np.flatnonzero(edges == -1) - starts).max())
         
         if max_sequence >= 5:
             return 80.0
@@ -730,16 +1025,20 @@ class CrisisPredictionEngine:
         
         # Factores específicos de estados emocionales
         if emotional_states:
-            recent_emotions = [es.primary_emotion for es in emotional_states[-5:]]
+            # Emociones recientes (como máscara de bits) y emociones contradictorias, en una sola pasada
+            recent_mask = 0
+            contradictory_count = 0
+            for es in emotional_states[-5:]:
+                recent_mask |= EMOTION_BITS[es.primary_emotion]
+                if es.contradictory_emotions:
+                    contradictory_count += 1
             
-            if EmotionCategory.ANXIETY in recent_emotions:
+            if recent_mask & EMOTION_BITS[EmotionCategory.ANXIETY]:
                 risk_factors.append("Presencia reciente de ansiedad")
             
-            if EmotionCategory.ANGER in recent_emotions:
+            if recent_mask & EMOTION_BITS[EmotionCategory.ANGER]:
                 risk_factors.append("Episodios de ira recientes")
             
-            # Buscar emociones contradictorias
-            contradictory_count = sum(1 for es in emotional_states[-5:] if es.contradictory_emotions)
             if contradictory_count >= 2:
                 risk_factors.append("Emociones contradictorias frecuentes")
         
@@ -758,8 +1057,9 @@ class CrisisPredictionEngine:
                 protective_factors.append("Presencia de emociones positivas recientes")
             
             # Buscar estabilidad emocional
+            # (con un solo estado no hay variabilidad que medir)
             recent_intensities = [es.intensity for es in emotional_states[-10:]]
-            if recent_intensities and statistics.stdev(recent_intensities) < 15:
+            if len(recent_intensities) > 1 and _mean_and_stdev(recent_intensities)[1] < 15:
                 protective_factors.append("Estabilidad emocional general")
             
             # Buscar evidencia de regulación emocional
@@ -885,6 +1185,7 @@ class LongitudinalTrackingService:
             # Añadir a análisis de evolución
             for dp in data_points:
                 self.evolution_analyzer.add_data_point(user_id, dp)
+            self.crisis_predictor.invalidate_assessment(user_id)
             
             return {
                 'user_id': user_id,
@@ -911,13 +1212,8 @@ class LongitudinalTrackingService:
                 return evolution_data
             
             # Extraer puntos de datos para análisis de patrones
-            data_points = []
-            if user_id in self.evolution_analyzer.data_points:
-                cutoff_date = datetime.now() - timedelta(days=time_period_days)
-                data_points = [
-                    dp for dp in self.evolution_analyzer.data_points[user_id]
-                    if dp.timestamp >= cutoff_date
-                ]
+            cutoff_date = datetime.now() - timedelta(days=time_period_days)
+            data_points = self.evolution_analyzer.points_since(user_id, cutoff_date)
             
             # Detectar patrones temporales
             temporal_patterns = self.pattern_detector.analyze_temporal_patterns(user_id, data_points)
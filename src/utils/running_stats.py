@@ -0,0 +1,35 @@
+import math
+
+
+class RunningStats:
+    """Media y varianza de una ventana de valores, actualizadas en O(1) (algoritmo de Welford)."""
+    
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Suma de cuadrados de las desviaciones respecto a la media
+    
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+    
+    def remove(self, value: float) -> None:
+        """Quitar un valor añadido antes (el que sale de la ventana)."""
+        if self.count <= 1:
+            self.reset()
+            return
+        self.count -= 1
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.m2 = max(0.0, self.m2 - delta * (value - self.mean))
+    
+    def stdev(self) -> float:
+        """Desviación estándar muestral (como statistics.stdev); requiere al menos 2 valores."""
+        return math.sqrt(self.m2 / (self.count - 1))
+    
+    def reset(self) -> None:
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
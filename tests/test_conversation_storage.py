@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Tests del almacenamiento de conversaciones en logs JSONL.
+Verifica la compactación, los anexos posteriores, la recuperación tras escrituras
+interrumpidas, la lectura de los formatos anteriores (.json y .jsonl sin "base")
+y el índice de cabeceras usado para listar las consultas.
+"""
+
+import sys
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+# Add the parent directory to the path so we can import from src
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orjson
+
+from src.models.data_models import InteractiveConversation
+from src.services.conversation_service import ConversationService
+
+
+class _UnusedMedicalSystem:
+    """Sistema médico de relleno: las pruebas de almacenamiento no procesan consultas."""
+
+
+class _UnusedLLMService:
+    """Servicio LLM de relleno: las pruebas de almacenamiento no clasifican mensajes."""
+
+
+def _storage_service(directory: Path) -> ConversationService:
+    """Servicio sobre `directory`, inicializado como en producción pero sin el sistema médico ni el hilo de escritura.
+    
+    Se crea sin pasar por el singleton; los guardados se escriben al llamar a `_flush_pending_saves`.
+    """
+    service = object.__new__(ConversationService)
+    service._initialize(
+        conversation_dir=directory,
+        medical_system=_UnusedMedicalSystem(),
+        llm_service=_UnusedLLMService(),
+        start_writer=False
+    )
+    # Compactar pronto para ejercitar la compactación con pocos guardados
+    service.log_compact_after = 4
+    return service
+
+
+def _new_conversation(message_count: int) -> InteractiveConversation:
+    """Conversación con `message_count` mensajes alternando paciente y especialista."""
+    conversation = InteractiveConversation(
+        conversation_id="conv-test",
+        active_specialty="cardiology",
+        all_specialties=["cardiology"]
+    )
+    for i in range(message_count):
+        conversation.add_message(content=f"mensaje {i}", sender="user" if i % 2 == 0 else "cardiology")
+    return conversation
+
+
+def _save(service: ConversationService, conversation: InteractiveConversation):
+    """Encolar y escribir un guardado de inmediato."""
+    assert service._save_conversation(conversation.conversation_id, conversation)
+    assert service._flush_pending_saves(force_sync=True) == 1
+
+
+def _contents(conversation: InteractiveConversation):
+    return [message.content for message in conversation.messages]
+
+
+def _reload(directory: Path, conversation_id: str) -> InteractiveConversation:
+    """Leer la conversación con un servicio nuevo, como tras reiniciar el proceso."""
+    conversation = _storage_service(directory)._read_conversation(conversation_id)
+    assert conversation is not None
+    return conversation
+
+
+def _run_in_tmp_dir(test):
+    """Ejecutar un test sobre un directorio temporal que se borra al terminar."""
+    directory = Path(tempfile.mkdtemp(prefix="conversations-"))
+    try:
+        test(directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_round_trip_after_compaction():
+    """Una conversación compactada se lee igual que se guardó."""
+    def run(directory: Path):
+        service = _storage_service(directory)
+        conversation = _new_conversation(5)
+        conversation.switch_specialty("neurology")
+        _save(service, conversation)
+
+        assert (directory / "conv-test.jsonl.gz").exists()
+        assert not (directory / "conv-test.jsonl").exists()
+
+        loaded = _reload(directory, "conv-test")
+        assert _contents(loaded) == _contents(conversation)
+        assert loaded.active_specialty == "neurology"
+        assert loaded.all_specialties == ["cardiology", "neurology"]
+        assert loaded.created_at == conversation.created_at
+    _run_in_tmp_dir(run)
+
+
+def test_append_after_compaction():
+    """Los guardados posteriores se anexan a la cola y una nueva compactación la absorbe."""
+    def run(directory: Path):
+        service = _storage_service(directory)
+        conversation = _new_conversation(3)
+        _save(service, conversation)
+
+        conversation.add_message(content="mensaje 3", sender="user")
+        _save(service, conversation)
+
+        tail_path = directory / "conv-test.jsonl"
+        assert tail_path.exists()
+        with open(tail_path, 'rb') as f:
+            records = [orjson.loads(line) for line in f]
+        assert records[0] == {"base": 3}
+        assert _contents(_reload(directory, "conv-test")) == _contents(conversation)
+
+        # Al acumular `log_compact_after` cabeceras (una del cuerpo y el resto en la cola) el
+        # siguiente guardado reescribe el cuerpo y borra la cola
+        for i in range(4, 4 + service.log_compact_after - 1):
+            conversation.add_message(content=f"mensaje {i}", sender="user")
+            _save(service, conversation)
+        assert not tail_path.exists()
+        assert _contents(_reload(directory, "conv-test")) == _contents(conversation)
+
+        conversation.add_message(content="último", sender="cardiology")
+        _save(service, conversation)
+        assert _contents(_reload(directory, "conv-test")) == _contents(conversation)
+    _run_in_tmp_dir(run)
+
+
+def test_crash_between_body_rename_and_tail_unlink():
+    """Una cola que sobrevive a la compactación no duplica los mensajes ya incluidos en el cuerpo."""
+    def run(directory: Path):
+        service = _storage_service(directory)
+        conversation = _new_conversation(3)
+        _save(service, conversation)
+        conversation.add_message(content="mensaje 3", sender="user")
+        _save(service, conversation)
+
+        # Simular la caída: la compactación renombra el cuerpo nuevo pero la cola no llega a borrarse
+        tail_path = directory / "conv-test.jsonl"
+        stale_tail = tail_path.read_bytes()
+        conversation.add_message(content="mensaje 4", sender="cardiology")
+        assert service._compact_conversation_log("conv-test", {
+            "header": conversation.header_dict(),
+            "messages": conversation._message_dicts,
+            "count": len(conversation._message_dicts)
+        })
+        tail_path.write_bytes(stale_tail)
+
+        assert _contents(_reload(directory, "conv-test")) == _contents(conversation)
+    _run_in_tmp_dir(run)
+
+
+def test_torn_last_line():
+    """Una última línea incompleta se descarta y el siguiente guardado reescribe el log."""
+    def run(directory: Path):
+        service = _storage_service(directory)
+        conversation = _new_conversation(3)
+        _save(service, conversation)
+        conversation.add_message(content="mensaje 3", sender="user")
+        _save(service, conversation)
+
+        tail_path = directory / "conv-test.jsonl"
+        with open(tail_path, 'ab') as f:
+            f.write(b'{"message": {"content": "mensaje 4", "sen')
+
+        reader = _storage_service(directory)
+        loaded = reader._read_conversation("conv-test")
+        assert loaded is not None
+        assert _contents(loaded) == _contents(conversation)
+        assert "conv-test" not in reader._log_state
+
+        # El siguiente guardado compacta en lugar de anexar detrás de la línea rota
+        loaded.add_message(content="mensaje 4", sender="cardiology")
+        _save(reader, loaded)
+        assert not tail_path.exists()
+        assert _contents(_reload(directory, "conv-test")) == _contents(loaded)
+    _run_in_tmp_dir(run)
+
+
+def test_load_legacy_json():
+    """Las instantáneas .json anteriores se leen y el primer guardado las sustituye por el log."""
+    def run(directory: Path):
+        conversation = _new_conversation(4)
+        legacy_path = directory / "conv-test.json"
+        legacy_path.write_bytes(orjson.dumps(conversation.dict()))
+
+        service = _storage_service(directory)
+        assert "conv-test" in service._index_conversations()
+        loaded = service._read_conversation("conv-test")
+        assert loaded is not None
+        assert _contents(loaded) == _contents(conversation)
+
+        loaded.add_message(content="mensaje 4", sender="user")
+        _save(service, loaded)
+        assert not legacy_path.exists()
+        assert _contents(_reload(directory, "conv-test")) == _contents(loaded)
+    _run_in_tmp_dir(run)
+
+
+def test_load_legacy_jsonl():
+    """Un log .jsonl sin cuerpo comprimido ni registro "base" se lee completo."""
+    def run(directory: Path):
+        conversation = _new_conversation(4)
+        records = [{"header": conversation.header_dict()}]
+        records.extend({"message": message} for message in conversation._message_dicts)
+        conversation.add_message(content="mensaje 4", sender="user")
+        records.append({"message": conversation._message_dicts[-1]})
+        records.append({"header": conversation.header_dict()})
+        (directory / "conv-test.jsonl").write_bytes(
+            b"".join(orjson.dumps(record) + b"\n" for record in records)
+        )
+
+        service = _storage_service(directory)
+        assert "conv-test" in service._index_conversations()
+        loaded = service._read_conversation("conv-test")
+        assert loaded is not None
+        assert _contents(loaded) == _contents(conversation)
+
+        loaded.add_message(content="mensaje 5", sender="cardiology")
+        _save(service, loaded)
+        assert _contents(_reload(directory, "conv-test")) == _contents(loaded)
+    _run_in_tmp_dir(run)
+
+
+def test_conversation_index_listing():
+    """El listado sale del índice de cabeceras sin leer los logs; los logs sin entrada se indexan una vez."""
+    def run(directory: Path):
+        service = _storage_service(directory)
+        conversation = _new_conversation(3)
+        _save(service, conversation)
+        conversation.add_message(content="mensaje 3", sender="user")
+        _save(service, conversation)
+
+        # Un log anterior al índice
+        legacy = _new_conversation(2)
+        legacy.conversation_id = "conv-legacy"
+        (directory / "conv-legacy.json").write_bytes(orjson.dumps(legacy.dict()))
+
+        reader = _storage_service(directory)
+        assert (directory / "_index.jsonl").exists()
+        assert "_index" not in reader._known_ids
+
+        def unexpected_read(conversation_id):
+            raise AssertionError(f"{conversation_id} no debería leerse para listar")
+
+        summaries = {entry["conversation_id"]: entry for entry in reader.get_conversation_summaries()}
+        assert summaries["conv-test"]["message_count"] == 4
+        assert summaries["conv-test"]["preview"] == "mensaje 0"
+        assert summaries["conv-test"]["created_at"] == conversation.created_at.isoformat()
+        assert summaries["conv-legacy"]["message_count"] == 2
+
+        # Tras persistir la entrada del log anterior, un proceso nuevo lista sin leer ningún log
+        reader._flush_pending_saves(force_sync=True)
+        restarted = _storage_service(directory)
+        restarted._read_conversation = unexpected_read
+        assert {entry["conversation_id"]: entry["message_count"]
+                for entry in restarted.get_conversation_summaries()} == {"conv-test": 4, "conv-legacy": 2}
+    _run_in_tmp_dir(run)
+
+
+def main():
+    """Ejecutar todos los tests de almacenamiento."""
+    print("🧪 PRUEBAS DE ALMACENAMIENTO DE CONVERSACIONES")
+    print("=" * 50)
+
+    tests = [
+        test_round_trip_after_compaction,
+        test_append_after_compaction,
+        test_crash_between_body_rename_and_tail_unlink,
+        test_torn_last_line,
+        test_load_legacy_json,
+        test_load_legacy_jsonl,
+        test_conversation_index_listing
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e!r}")
+
+    print(f"\n📊 RESULTADOS: {passed}/{len(tests)} tests exitosos")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
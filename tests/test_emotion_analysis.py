@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Tests de la intensidad emocional calculada por AdvancedEmotionAnalyzer.
+Verifica que el énfasis en mayúsculas del mensaje original aumenta la intensidad,
+aunque el texto se normalice a minúsculas antes del análisis.
+"""
+
+import sys
+import os
+import math
+
+# Add the parent directory to the path so we can import from src
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.services.emotion_analysis_service import AdvancedEmotionAnalyzer
+
+
+def test_uppercase_boosts_intensity():
+    """Tres o más mayúsculas seguidas multiplican la intensidad por 1.2."""
+    analyzer = AdvancedEmotionAnalyzer()
+    calm = analyzer.analyze_emotional_content("tengo miedo")
+    shouting = analyzer.analyze_emotional_content("tengo MIEDO")
+
+    assert calm.intensity > 0
+    assert math.isclose(shouting.intensity, min(100.0, calm.intensity * 1.2))
+    assert shouting.primary_emotion == calm.primary_emotion
+
+
+def test_accented_uppercase_boosts_intensity():
+    """Las mayúsculas acentuadas también cuentan como énfasis."""
+    analyzer = AdvancedEmotionAnalyzer()
+    calm = analyzer.analyze_emotional_content("ánimo triste")
+    shouting = analyzer.analyze_emotional_content("ÁNIMO triste")
+
+    assert math.isclose(shouting.intensity, min(100.0, calm.intensity * 1.2))
+
+
+def test_capitalized_words_are_not_shouting():
+    """Una mayúscula inicial no es énfasis."""
+    analyzer = AdvancedEmotionAnalyzer()
+    calm = analyzer.analyze_emotional_content("tengo miedo")
+    capitalized = analyzer.analyze_emotional_content("Tengo Miedo")
+
+    assert capitalized.intensity == calm.intensity
+
+
+def test_cache_keeps_uppercase_apart():
+    """El mismo texto normalizado con y sin mayúsculas no comparte el resultado cacheado."""
+    analyzer = AdvancedEmotionAnalyzer()
+    shouting = analyzer.analyze_emotional_content("tengo MIEDO")
+    calm = analyzer.analyze_emotional_content("tengo miedo")
+    shouting_again = analyzer.analyze_emotional_content("tengo MIEDO")
+
+    assert calm.intensity < shouting.intensity
+    assert shouting_again.intensity == shouting.intensity
+    assert len(analyzer._analysis_cache) == 2
+
+
+def main():
+    """Ejecutar todos los tests de análisis emocional."""
+    print("🧪 PRUEBAS DE INTENSIDAD EMOCIONAL")
+    print("=" * 50)
+
+    tests = [
+        test_uppercase_boosts_intensity,
+        test_accented_uppercase_boosts_intensity,
+        test_capitalized_words_are_not_shouting,
+        test_cache_keeps_uppercase_apart
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e!r}")
+
+    print(f"\n📊 RESULTADOS: {passed}/{len(tests)} tests exitosos")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
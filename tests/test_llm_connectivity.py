@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Tests del circuit breaker de conectividad de LLMService.
+Verifica que con el breaker cerrado no se comprueba la conectividad, que un error de red
+lo abre y da respuestas offline sin llamar a la API, y que al terminar el cooldown una
+sola comprobación lo cierra o lo reabre.
+"""
+
+import sys
+import os
+import asyncio
+import time
+from types import SimpleNamespace
+
+# Add the parent directory to the path so we can import from src
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.services.llm_service import LLMService
+
+PROMPT = "Tengo fiebre desde ayer"
+
+
+class _FakeStream:
+    """Stream de la API con un único fragmento de texto."""
+
+    def __init__(self, text):
+        self.chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)]
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeClient:
+    """Cliente de la API que cuenta las peticiones y las comprobaciones de conectividad."""
+
+    def __init__(self):
+        self.network_down = False
+        self.requests = 0
+        self.probes = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.models = SimpleNamespace(list=self._list_models)
+
+    def with_options(self, **kwargs):
+        return self
+
+    def _create(self, **kwargs):
+        self.requests += 1
+        if self.network_down:
+            raise Exception("Connection error.")
+        return _FakeStream("respuesta del modelo")
+
+    def _list_models(self):
+        self.probes += 1
+        if self.network_down:
+            raise Exception("Connection error.")
+        return []
+
+
+def _service_with_fake_client():
+    service = LLMService()
+    service.client = _FakeClient()
+    return service
+
+
+def _generate(service):
+    return asyncio.run(service.generate_response("Eres un médico", PROMPT, use_cache=False))
+
+
+def test_closed_breaker_does_not_probe():
+    """Sin errores de red las peticiones van directas a la API."""
+    service = _service_with_fake_client()
+
+    assert _generate(service) == "respuesta del modelo"
+    assert _generate(service) == "respuesta del modelo"
+    assert service.client.requests == 2
+    assert service.client.probes == 0
+
+
+def test_network_error_opens_breaker():
+    """Un error de red abre el breaker y las peticiones siguientes son offline sin tocar la API."""
+    service = _service_with_fake_client()
+    service.client.network_down = True
+    offline_response = service._get_offline_response(PROMPT)
+
+    assert _generate(service) == offline_response
+    assert service._breaker_open_until > time.monotonic()
+    assert service.client.requests == 1
+
+    assert _generate(service) == offline_response
+    assert service.client.requests == 1
+    assert service.client.probes == 0
+
+
+def test_cooldown_probe_closes_breaker():
+    """Terminado el cooldown, una comprobación correcta cierra el breaker y la petición se atiende."""
+    service = _service_with_fake_client()
+    service._breaker_open_until = time.monotonic() - 1
+
+    assert _generate(service) == "respuesta del modelo"
+    assert service.client.probes == 1
+    assert service._breaker_open_until == 0.0
+
+    _generate(service)
+    assert service.client.probes == 1
+
+
+def test_cooldown_probe_reopens_breaker():
+    """Terminado el cooldown, una comprobación fallida reabre el breaker sin llamar a la API."""
+    service = _service_with_fake_client()
+    service.client.network_down = True
+    service._breaker_open_until = time.monotonic() - 1
+
+    assert _generate(service) == service._get_offline_response(PROMPT)
+    assert service.client.probes == 1
+    assert service.client.requests == 0
+    assert service._breaker_open_until > time.monotonic()
+
+
+def main():
+    """Ejecutar todos los tests del circuit breaker."""
+    print("🧪 PRUEBAS DEL CIRCUIT BREAKER DE CONECTIVIDAD")
+    print("=" * 50)
+
+    tests = [
+        test_closed_breaker_does_not_probe,
+        test_network_error_opens_breaker,
+        test_cooldown_probe_closes_breaker,
+        test_cooldown_probe_reopens_breaker
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e!r}")
+
+    print(f"\n📊 RESULTADOS: {passed}/{len(tests)} tests exitosos")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
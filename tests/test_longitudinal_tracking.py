@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Tests del seguimiento longitudinal.
+Verifica los picos y valles de los perfiles diarios (incluido el perfil plano), la
+detección semanal cuando faltan días laborables o de fin de semana y la reutilización
+de la última evaluación de riesgo de crisis mientras no lleguen datos nuevos.
+"""
+
+import sys
+import os
+from datetime import datetime, timedelta
+
+# Add the parent directory to the path so we can import from src
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.models.psychology_models import EmotionalState, EmotionCategory, LongitudinalDataPoint
+from src.services.longitudinal_tracking_service import (
+    CrisisPredictionEngine, LongitudinalTrackingService, TemporalPatternDetector
+)
+
+MONDAY = datetime(2026, 10, 12, 9, 0)
+
+
+def _point(timestamp: datetime, value: float, metric_type: str = "mood") -> LongitudinalDataPoint:
+    return LongitudinalDataPoint(timestamp=timestamp, metric_type=metric_type, value=value)
+
+
+def _state(timestamp: datetime, valence: float) -> EmotionalState:
+    return EmotionalState(timestamp=timestamp, primary_emotion=EmotionCategory.SADNESS,
+                          intensity=70.0, valence=valence, arousal=40.0)
+
+
+def test_flat_daily_profile_has_no_peaks_or_lows():
+    """Un perfil constante no tiene horas pico ni bajas aunque la desviación en coma flotante no sea 0."""
+    detector = TemporalPatternDetector()
+    # Con 0.1 constante NumPy da una desviación de ~1e-17 en lugar de 0
+    assert detector._find_peaks_and_lows({hour: 0.1 for hour in range(24)}) == ([], [])
+    assert detector._find_peaks_and_lows({0: 0.1, 8: 0.1, 16: 0.1}) == ([], [])
+
+    data_points = [_point(MONDAY.replace(hour=hour), 0.1) for hour in range(24)]
+    patterns = detector.analyze_temporal_patterns("user-flat", data_points)
+    assert not [pattern for pattern in patterns if pattern.pattern_type == "daily"]
+
+
+def test_daily_peaks_and_lows():
+    """Las horas por encima de media + desviación son picos y las de por debajo de media - desviación, bajas."""
+    detector = TemporalPatternDetector()
+    assert detector._find_peaks_and_lows({0: 10.0, 6: 50.0, 12: 50.0, 18: 90.0}) == ([18], [0])
+
+    data_points = [_point(MONDAY.replace(hour=hour), value)
+                   for hour, value in ((0, 10.0), (6, 50.0), (12, 50.0), (18, 90.0))]
+    daily = [pattern for pattern in detector.analyze_temporal_patterns("user-daily", data_points)
+             if pattern.pattern_type == "daily"]
+    assert len(daily) == 1
+    assert daily[0].peak_times == ["18:00"]
+    assert daily[0].low_times == ["0:00"]
+
+
+def test_weekly_without_weekend_data():
+    """Sin datos de fin de semana no hay patrón semanal ni error en el análisis."""
+    detector = TemporalPatternDetector()
+    data_points = [_point(MONDAY + timedelta(days=day), value)
+                   for day, value in ((0, 20.0), (1, 60.0), (2, 90.0), (3, 40.0))]
+
+    patterns = detector.analyze_temporal_patterns("user-weekdays", data_points)
+    assert not [pattern for pattern in patterns if pattern.pattern_type == "weekly"]
+
+
+def test_weekly_weekday_weekend_difference():
+    """Con días laborables y de fin de semana distintos se detecta el patrón semanal."""
+    detector = TemporalPatternDetector()
+    data_points = [_point(MONDAY + timedelta(days=day), value)
+                   for day, value in ((0, 30.0), (1, 30.0), (2, 30.0), (5, 70.0), (6, 70.0))]
+
+    weekly = [pattern for pattern in detector.analyze_temporal_patterns("user-week", data_points)
+              if pattern.pattern_type == "weekly"]
+    assert len(weekly) == 1
+    assert weekly[0].pattern_description.endswith("(mayor en fines de semana)")
+    assert weekly[0].peak_times == ["Sábado", "Domingo"]
+    assert weekly[0].low_times == ["Lunes", "Martes", "Miércoles"]
+
+
+def test_crisis_assessment_reused_without_new_data():
+    """La misma entrada devuelve la evaluación guardada sin volver a añadirla al historial."""
+    engine = CrisisPredictionEngine()
+    data_points = [_point(MONDAY + timedelta(hours=i), -50.0, "emotional_valence") for i in range(5)]
+    states = [_state(MONDAY + timedelta(hours=i), -50.0) for i in range(5)]
+
+    first = engine.assess_crisis_risk("user-1", data_points, states, [])
+    again = engine.assess_crisis_risk("user-1", data_points, states, [])
+    assert again is first
+    assert len(engine.prediction_history["user-1"]) == 1
+
+    data_points.append(_point(MONDAY + timedelta(hours=5), -60.0, "emotional_valence"))
+    updated = engine.assess_crisis_risk("user-1", data_points, states, [])
+    assert updated is not first
+    assert len(engine.prediction_history["user-1"]) == 2
+
+
+def test_crisis_assessment_invalidated():
+    """invalidate_assessment, y registrar datos nuevos, obligan a recalcular la evaluación."""
+    service = LongitudinalTrackingService()
+    engine = service.crisis_predictor
+    data_points = [_point(MONDAY + timedelta(hours=i), -50.0, "emotional_valence") for i in range(3)]
+    states = [_state(MONDAY + timedelta(hours=i), -50.0) for i in range(3)]
+
+    first = engine.assess_crisis_risk("user-2", data_points, states, [])
+    engine.invalidate_assessment("user-2")
+    second = engine.assess_crisis_risk("user-2", data_points, states, [])
+    assert second is not first
+
+    service.track_emotional_data("user-2", _state(MONDAY + timedelta(hours=4), -70.0))
+    assert "user-2" not in engine._assessment_cache
+    assert engine.assess_crisis_risk("user-2", data_points, states, []) is not second
+
+
+def main():
+    """Ejecutar todos los tests de seguimiento longitudinal."""
+    print("🧪 PRUEBAS DE SEGUIMIENTO LONGITUDINAL")
+    print("=" * 50)
+
+    tests = [
+        test_flat_daily_profile_has_no_peaks_or_lows,
+        test_daily_peaks_and_lows,
+        test_weekly_without_weekend_data,
+        test_weekly_weekday_weekend_difference,
+        test_crisis_assessment_reused_without_new_data,
+        test_crisis_assessment_invalidated
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e!r}")
+
+    print(f"\n📊 RESULTADOS: {passed}/{len(tests)} tests exitosos")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
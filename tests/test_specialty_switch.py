@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Tests de la decisión de cambio automático de especialidad en ConversationService.
+Verifica cuándo basta con el router del sistema avanzado, cuándo decide el clasificador
+de especialidad (umbral de confianza y límite de cambios recientes) y con qué
+especialidad se etiqueta cada respuesta.
+"""
+
+import sys
+import os
+import asyncio
+import shutil
+import tempfile
+from pathlib import Path
+
+# Add the parent directory to the path so we can import from src
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.models.data_models import ConsensusResponse
+from src.services.conversation_service import ConversationService
+
+# Mensajes de más de diez palabras para que no se traten como respuestas de seguimiento
+HEART_MESSAGE = "Desde ayer noto un dolor fuerte en el pecho que sube hacia el brazo izquierdo"
+HEAD_MESSAGE = "Llevo toda la semana con dolores de cabeza muy intensos y la vista nublada por las mañanas"
+
+
+class _FakeMedicalSystem:
+    """Sistema médico que responde con la especialidad que propone su router."""
+
+    def __init__(self, routed_specialty, router_confidence=0.9):
+        self.routed_specialty = routed_specialty
+        self.router_confidence = router_confidence
+        self.calls = []
+
+    async def process_medical_query(self, query, specialty=None, medical_criteria=None, context=None):
+        self.calls.append({"specialty": specialty, "context": context})
+        # Tras un traspaso el sistema responde con la especialidad pedida
+        if context and context.get("auto_transfer"):
+            primary_specialty = specialty
+        else:
+            primary_specialty = self.routed_specialty or specialty
+        return ConsensusResponse(
+            primary_specialty=primary_specialty,
+            primary_response=f"Respuesta de {primary_specialty}.",
+            router_confidence=self.router_confidence
+        )
+
+
+class _FakeLLMService:
+    """Servicio LLM cuyo clasificador devuelve siempre la misma recomendación."""
+
+    def __init__(self, recommended_specialty, confidence):
+        self.classification = {
+            "recommended_specialty": recommended_specialty,
+            "confidence": confidence,
+            "reasoning": "síntomas propios de la especialidad"
+        }
+        self.classified = []
+
+    async def classify_specialty(self, message):
+        self.classified.append(message)
+        return dict(self.classification)
+
+
+def _run_with_service(test, medical_system, llm_service):
+    """Ejecutar `test(service)` con un servicio sobre un directorio temporal que se borra al terminar."""
+    directory = Path(tempfile.mkdtemp(prefix="conversations-"))
+    try:
+        service = object.__new__(ConversationService)
+        service._initialize(
+            conversation_dir=directory,
+            medical_system=medical_system,
+            llm_service=llm_service,
+            start_writer=False
+        )
+        asyncio.run(test(service))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_router_confirms_current_specialty():
+    """Si el router confirma al especialista actual no se consulta el clasificador."""
+    medical_system = _FakeMedicalSystem("cardiology")
+    llm_service = _FakeLLMService("neurology", 0.99)
+
+    async def run(service):
+        conversation = service.create_conversation("cardiology")
+        reply = await service.process_message(conversation.conversation_id, HEART_MESSAGE)
+
+        assert reply == "Respuesta de cardiology."
+        assert llm_service.classified == []
+        assert len(medical_system.calls) == 1
+        assert conversation.active_specialty == "cardiology"
+        assert conversation.messages[-1].sender == "cardiology"
+    _run_with_service(run, medical_system, llm_service)
+
+
+def test_router_fallback_defers_to_classifier():
+    """Sin decisión del router (sistema de respaldo) el clasificador decide aunque la especialidad coincida."""
+    medical_system = _FakeMedicalSystem("cardiology", router_confidence=None)
+    llm_service = _FakeLLMService("neurology", 0.97)
+
+    async def run(service):
+        conversation = service.create_conversation("cardiology")
+        reply = await service.process_message(conversation.conversation_id, HEAD_MESSAGE)
+
+        assert llm_service.classified == [HEAD_MESSAGE]
+        assert conversation.active_specialty == "neurology"
+        assert reply == "Respuesta de neurology."
+    _run_with_service(run, medical_system, llm_service)
+
+
+def test_switch_above_threshold():
+    """Con confianza suficiente se cambia de especialidad, se explica el motivo y se responde con el traspaso."""
+    medical_system = _FakeMedicalSystem("neurology")
+    llm_service = _FakeLLMService("neurology", 0.97)
+
+    async def run(service):
+        conversation = service.create_conversation("cardiology")
+        reply = await service.process_message(conversation.conversation_id, HEAD_MESSAGE)
+
+        assert conversation.active_specialty == "neurology"
+        assert conversation.all_specialties == ["cardiology", "neurology"]
+
+        system_message = conversation.messages[-2]
+        assert system_message.sender == "system"
+        assert "neurology" in system_message.content
+        assert "Motivo: síntomas propios de la especialidad" in system_message.content
+
+        # El nuevo especialista responde de nuevo con el contexto del traspaso
+        assert len(medical_system.calls) == 2
+        transfer_call = medical_system.calls[-1]
+        assert transfer_call["specialty"] == "neurology"
+        assert transfer_call["context"]["previous_specialty"] == "cardiology"
+        assert transfer_call["context"]["auto_transfer"] is True
+        assert transfer_call["context"]["confidence"] == 0.97
+
+        assert reply == "Respuesta de neurology."
+        assert conversation.messages[-1].sender == "neurology"
+        assert len(service.specialty_changes[conversation.conversation_id]) == 1
+    _run_with_service(run, medical_system, llm_service)
+
+
+def test_no_switch_below_threshold():
+    """Por debajo del umbral no hay cambio y la respuesta lleva la especialidad que la redactó."""
+    medical_system = _FakeMedicalSystem("neurology")
+    llm_service = _FakeLLMService("neurology", 0.9)
+
+    async def run(service):
+        conversation = service.create_conversation("cardiology")
+        reply = await service.process_message(conversation.conversation_id, HEAD_MESSAGE)
+
+        assert conversation.active_specialty == "cardiology"
+        assert len(medical_system.calls) == 1
+        assert not any(message.sender == "system" and "Motivo" in message.content
+                       for message in conversation.messages)
+        assert reply == "Respuesta de neurology."
+        assert conversation.messages[-1].sender == "neurology"
+        assert conversation.conversation_id not in service.specialty_changes
+    _run_with_service(run, medical_system, llm_service)
+
+
+def test_recent_switches_block_another():
+    """Tras dos cambios recientes el tercero se bloquea."""
+    medical_system = _FakeMedicalSystem(None, router_confidence=None)
+    llm_service = _FakeLLMService("neurology", 0.99)
+
+    async def run(service):
+        conversation = service.create_conversation("cardiology")
+        conversation_id = conversation.conversation_id
+
+        await service.process_message(conversation_id, HEAD_MESSAGE)
+        assert conversation.active_specialty == "neurology"
+
+        llm_service.classification["recommended_specialty"] = "cardiology"
+        await service.process_message(conversation_id, HEART_MESSAGE)
+        assert conversation.active_specialty == "cardiology"
+
+        llm_service.classification["recommended_specialty"] = "neurology"
+        reply = await service.process_message(conversation_id, HEAD_MESSAGE)
+        assert conversation.active_specialty == "cardiology"
+        assert conversation.all_specialties == ["cardiology", "neurology"]
+        assert len(service.specialty_changes[conversation_id]) == 2
+        assert reply == "Respuesta de cardiology."
+    _run_with_service(run, medical_system, llm_service)
+
+
+def main():
+    """Ejecutar todos los tests de cambio de especialidad."""
+    print("🧪 PRUEBAS DE CAMBIO AUTOMÁTICO DE ESPECIALIDAD")
+    print("=" * 50)
+
+    tests = [
+        test_router_confirms_current_specialty,
+        test_router_fallback_defers_to_classifier,
+        test_switch_above_threshold,
+        test_no_switch_below_threshold,
+        test_recent_switches_block_another
+    ]
+
+    passed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+            passed += 1
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e!r}")
+
+    print(f"\n📊 RESULTADOS: {passed}/{len(tests)} tests exitosos")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)